@@ -64,11 +64,26 @@ import logging
 import argparse
 import re
 import sys
+import os
+import multiprocessing
 import shlex
+import shutil
+import hashlib
+import heapq
+import calendar
+import time
+import math
+from bisect import bisect_right
+from itertools import groupby
 import dateutil.parser as date_parser
+from datetime import datetime, timedelta
+import numpy as np
 from mpl_toolkits.mplot3d import Axes3D
 import matplotlib.pyplot as plt
 from pyspark import SparkContext
+from pyspark.rdd import portable_hash
+from pyspark.sql import SparkSession
+from pyspark.sql.types import StructType, StructField, StringType, LongType, DoubleType, TimestampType, ArrayType
 
 
 log = logging.getLogger('root')
@@ -82,49 +97,266 @@ WEB_LOG_IP_IND = 2
 WEB_LOG_URL_IND = 11
 WEB_LOG_TS_IND = 0
 
+# indices of the user agent and SSL cipher and protocol fields in web log file
+WEB_LOG_UA_IND = 12
+WEB_LOG_SSL_CIPHER_IND = 13
+WEB_LOG_SSL_PROTOCOL_IND = 14
+
+# fields of the web log (besides the IP) that the session key of a page visit is made from, by
+# --session_key: ip (the IP alone), ip_ua (IP and user agent) or fingerprint (IP and a hash of the
+# user agent and SSL cipher and protocol of the client)
+SESSION_KEY_FIELDS = {'ip': [],
+                      'ip_ua': [WEB_LOG_UA_IND],
+                      'fingerprint': [WEB_LOG_UA_IND, WEB_LOG_SSL_CIPHER_IND, WEB_LOG_SSL_PROTOCOL_IND]}
+
+# version of the (IP, timestamp, URL) output of parseElbLine() -- bump when it
+# changes so parsed input saved in the parse cache is not used any more
+PARSER_VERSION = 1
+
+# timezone attached to parsed web log timestamps. ELB always logs in UTC but
+# dateutil reports a 'Z' suffix as tzlocal() on hosts running in UTC, so take
+# whatever it returns to keep the fast timestamp path identical to it
+ELB_TZ = date_parser.parse('2015-07-22T09:00:28.019143Z').tzinfo
+
+# start of epoch for the int64 microsecond timestamps of columnar customer records
+EPOCH = datetime(1970, 1, 1, tzinfo=ELB_TZ)
+US_PER_SEC = 1000000
+
 # temp file created in local dir to show how the % of sessions with one URL
 # changes in the 5 minutes before and after time indices determined as optimal
 one_pg_sess_change_fl = 'one_pg_sess_changes.pdf'
 
+# ----------------------------------------------------------------------
+# Purpose: Split a line of the ELB web log into its fields in a single
+#   pass. Fields are separated by single spaces except for quoted fields
+#   (request and user agent) which run up to the next quote that is
+#   followed by a space or the end of the line. Quotes inside the request
+#   URL are kept as is, which is what the shlex based parser achieved by
+#   escaping them. Splitting stops once max_fields fields are found since
+#   the remaining fields are never used.
+# Input: Line of web log input file and number of fields to return
+# Output: A list of string fields. Raises ValueError if a quoted field
+#   is not terminated.
+def splitElbLine(lin, max_fields):
+
+    lfields = []
+    pos = 0
+    lin_len = len(lin)
+    while pos < lin_len and len(lfields) < max_fields:
+        if lin[pos] == ' ':
+            pos += 1
+        elif lin[pos] == '"':
+            end = lin.find('" ', pos + 1)
+            if end < 0:
+                end = lin_len - 1
+                if end <= pos or lin[end] != '"':
+                    raise ValueError('Unterminated quoted field')
+            lfields.append(lin[pos + 1:end])
+            pos = end + 2
+        else:
+            end = lin.find(' ', pos)
+            if end < 0:
+                end = lin_len
+            lfields.append(lin[pos:end])
+            pos = end + 1
+    return lfields
+
+
+# ----------------------------------------------------------------------
+# Purpose: Convert an ELB timestamp to a Python datetime. ELB always
+#   writes timestamps as e.g. 2015-07-22T09:00:28.019143Z so these are
+#   sliced directly by position. Anything else falls back to dateutil.
+#   Both paths return the same timezone aware datetime.
+# Input: ISO 8601 timestamp string
+# Output: A Python datetime object
+def parseElbTimestamp(ts_dat):
+
+    if len(ts_dat) == 27 and ts_dat[26] == 'Z' and ts_dat[19] == '.' and ts_dat[10] == 'T':
+        return datetime(int(ts_dat[0:4]), int(ts_dat[5:7]), int(ts_dat[8:10]),
+                        int(ts_dat[11:13]), int(ts_dat[14:16]), int(ts_dat[17:19]),
+                        int(ts_dat[20:26]), ELB_TZ)
+    return date_parser.parse(ts_dat)
+
+
+# ----------------------------------------------------------------------
+# Purpose: Build the session key of a page visit from its IP and the
+#   other fields of the kind of key (see SESSION_KEY_FIELDS).
+# Input: Customer IP, list of the string values of the key fields and the
+#   kind of key.
+# Output: String key starting with the IP, so it still sorts and
+#   partitions (e.g. by ip_prefix) by IP: the IP for ip, IP|user agent
+#   (spaces replaced by +, since output lines separate the key with a
+#   space) for ip_ua, and IP#<12 hex digits of the md5 of the fields>
+#   for fingerprint.
+def getSessionKey(cust_id, lkey_dat, session_key):
+
+    if session_key == 'ip_ua':
+        return cust_id + '|' + lkey_dat[0].replace(' ', '+')
+    if session_key == 'fingerprint':
+        return cust_id + '#' + hashlib.md5(u'\t'.join(lkey_dat).encode('utf-8')).hexdigest()[:12]
+    return cust_id
+
+
+# ----------------------------------------------------------------------
+# Purpose: Parse the customer IP, timestamp and URL from a line of the
+#   input file using the single pass ELB tokenizer.
+# Input: Line of web log input file, the indices of the IP, timestamp
+#   and URL fields and the kind of session key (see SESSION_KEY_FIELDS).
+# Output: A tuple of customer IP (port stripped) or session key, Python
+#   datetime object and string URL. Raises an exception if the line is
+#   malformed. Key fields missing from the end of the line are taken as
+#   '-', as ELB logs fields without a value.
+def parseElbLine(lin, ip_ind, ts_ind, url_ind, session_key='ip'):
+
+    lkey_inds = SESSION_KEY_FIELDS[session_key]
+    dat = splitElbLine(lin, max([ip_ind, ts_ind, url_ind] + lkey_inds) + 1)
+       # retrieve client IP and strip out port
+    cust_id = dat[ip_ind]
+    port_ind = cust_id.find(':')
+    if port_ind >= 0:
+        cust_id = cust_id[:port_ind]
+    if lkey_inds:
+        cust_id = getSessionKey(cust_id, [dat[k] if k < len(dat) else '-' for k in lkey_inds], session_key)
+    return cust_id, parseElbTimestamp(dat[ts_ind]), dat[url_ind]
+
+
+# ----------------------------------------------------------------------
+# Purpose: Original parser for a line of the web log based on regex,
+#   shlex and dateutil. It is much slower than parseElbLine() and is
+#   kept for comparison in benchmarks.py.
+# Input: Line of web log input file and the indices of the IP, timestamp
+#   and URL fields.
+# Output: A tuple of customer IP (port stripped), Python datetime object
+#   and string URL. Raises an exception if the line is malformed.
+def parseElbLineShlex(lin, ip_ind, ts_ind, url_ind):
+
+       # escape quote chars in url portion of line so can parse with shlex
+       # without errors.
+       # find url by doing an approximate match on 'http' keywords
+    url_pattern = 'http.*HTTP'
+    match = re.search(url_pattern , lin)
+    if match:
+        rep_str = match.group(0)
+        rep_str = rep_str.replace("\'", "\\'")
+        rep_str = rep_str.replace('\"', '\\"')
+        lin = re.sub(url_pattern , rep_str, lin)
+
+    dat = shlex.split(lin)
+       # retrieve client IP and strip out port
+    cust_id = dat[ip_ind]
+    if ':' in cust_id:
+        cust_id = cust_id[:(cust_id.index(':'))]
+       # retrieve timestamp and convert to python datetime
+       # object - assumes time in ISO 8601 format
+    dt = date_parser.parse(dat[ts_ind])
+    return cust_id, dt, dat[url_ind]
+
+
 # ----------------------------------------------------------------------
 # Purpose: Parse the customer IP, timestamp and URL from a line of the
 #   the input file
 # Input: Line of web log input file
-# Output: A tuple with the customer IP as first element and a list
+# Output: A tuple with the customer IP (or session key, see
+#   getSessionKey()) as first element and a list
 #   as the second element consisting of a single list made up of a
 #   Python datetime object and a string URL.
-#   The line is skipped if there are any errors in processing
-#   (e.g. error parsing the date)
-def getLines(lin):
+#   None if there are any errors in processing (e.g. error parsing the
+#   date), so malformed lines can be counted (see getValidLines()).
+def parseLine(lin):
 
     try :
-           # escape quote chars in url portion of line so can parse with shlex
-           # without errors.
-           # find url by doing an approximate match on 'http' keywords
-        url_pattern = 'http.*HTTP'
-        match = re.search(url_pattern , lin)
-        if match:
-            rep_str = match.group(0)
-            rep_str = rep_str.replace("\'", "\\'")
-            rep_str = rep_str.replace('\"', '\\"')
-            lin = re.sub(url_pattern , rep_str, lin)
-
-        dat = shlex.split(lin)
-           # retrieve client IP and strip out port
-        cust_id = dat[WEB_LOG_IP_IND_BC.value]
-        if ':' in cust_id:
-            cust_id = cust_id[:(cust_id.index(':'))]
-           # retrieve timestamp and convert to python datetime
-           # object - assumes time in ISO 8601 format
-        ts_dat = dat[WEB_LOG_TS_IND_BC.value]
-        dt = date_parser.parse(ts_dat)
-           # retrieve URL field
-        url_dat = dat[WEB_LOG_URL_IND_BC.value]
+        cust_id, dt, url_dat = parseElbLine(lin, WEB_LOG_IP_IND_BC.value, WEB_LOG_TS_IND_BC.value,
+                                            WEB_LOG_URL_IND_BC.value, SESSION_KEY_BC.value)
     except:
-        print 'Error : processing line : ' + str(lin)
+        return None
+
+    return (cust_id, [[dt, url_dat]])
+
+
+# ----------------------------------------------------------------------
+# Purpose: Same as parseLine() for the local engine, which counts the
+#   malformed lines of each chunk in MALFORMED_LINES_ACC (a plain int).
+# Input: Line of web log input file
+# Output: A list with the parsed line, or an empty list if the line is
+#   malformed.
+def getLines(lin):
+    global MALFORMED_LINES_ACC
+
+    rec = parseLine(lin)
+    if rec is None:
+        MALFORMED_LINES_ACC += 1
         return []
 
-    return [(cust_id, [[dt, url_dat]])];
+    return [rec]
+
+
+# ----------------------------------------------------------------------
+# Purpose: Drop the malformed lines of a parsed RDD and count them. The
+#   count is a reduction over the parsed RDD rather than an accumulator,
+#   which would count the lines of a partition again each time it is
+#   recomputed (e.g. after it is evicted from the cache).
+# Input: RDD of parsed lines, with None for each malformed line (e.g.
+#   from parseLine()).
+# Output: A tuple of the RDD of the parsed lines without the malformed
+#   ones and the number of malformed lines. The parsed RDD is persisted,
+#   so the input is only read and parsed once.
+def getValidLines(parsed_RDD):
+
+    parsed_RDD.persist()
+    num_malformed = parsed_RDD.filter(lambda rec: rec is None).count()
+    return parsed_RDD.filter(lambda rec: rec is not None), num_malformed
+
+
+# ----------------------------------------------------------------------
+# Purpose: Build the dictionary of the session keys, to encode them as
+#   compact int ids so the shuffles carry ints instead of strings.
+# Input: RDD of parsed lines from getLines()
+# Output: Sorted list of the distinct session keys. The id of a key is
+#   its index in the list, so ids sort in the same order as the keys.
+#   The list is collected to the driver, so it must fit in its memory.
+def getKeyNames(date_url_RDD):
+    return sorted(date_url_RDD.keys().distinct().collect())
+
+
+# ----------------------------------------------------------------------
+# Purpose: Replace the session keys of the parsed lines by their ids.
+# Input: RDD of parsed lines from getLines() and broadcast dict of
+#   session key to id.
+# Output: RDD of the parsed lines with the int id as key.
+def encodeKeys(date_url_RDD, key_ids_BC):
+    return date_url_RDD.map(lambda (cid, dat): (key_ids_BC.value[cid], dat))
+
+
+# ----------------------------------------------------------------------
+# Purpose: Get the session key of a key id.
+# Input: Key id and the broadcast list of session keys from
+#   getKeyNames() (None if the keys are not encoded).
+# Output: String session key (the key itself if not encoded).
+def getKeyName(cid, key_names_BC):
+    return key_names_BC.value[cid] if key_names_BC is not None else cid
+
+
+# ----------------------------------------------------------------------
+# Purpose: Replace the key ids of a RDD of (key, value) tuples by their
+#   session keys, e.g. before it is written to an output file.
+# Input: RDD of (key id, value) tuples and the broadcast list of session
+#   keys (None if the keys are not encoded).
+# Output: RDD of (session key, value) tuples.
+def decodeKeys(rdd, key_names_BC):
+
+    if key_names_BC is None:
+        return rdd
+    return rdd.map(lambda (cid, dat): (key_names_BC.value[cid], dat))
+
+
+# ----------------------------------------------------------------------
+# Purpose: Driver side version of decodeKeys() for a list of (key id,
+#   value) tuples, e.g. to print them.
+# Input: List of (key id, value) tuples and the broadcast list of session
+#   keys (or None).
+# Output: List of (session key, value) tuples.
+def decodeKeyList(lst, key_names_BC):
+    return [(getKeyName(cid, key_names_BC), dat) for cid, dat in lst]
 
 
 
@@ -160,6 +392,74 @@ def getPageDurations(lin):
     return (cid, [lurls, lts, ldurs])
 
 
+# ----------------------------------------------------------------------
+# Purpose: Partition the parsed web log by customer IP and sort it by
+#   (IP, timestamp) as part of the shuffle. Spark's external sort does
+#   the ordering so each partition can then be streamed IP by IP without
+#   ever building a customer's full list of page visits.
+# Input: RDD of parsed lines from getLines() and the number of
+#   partitions to shuffle into (None keeps the input partitioning).
+# Output: RDD with key (customer IP, Python datetime) and the string URL
+#   as value. All of an IP's records are in the same partition, in
+#   timestamp order and next to each other.
+def getSortedEvents(date_url_RDD, num_partitions):
+
+    return date_url_RDD.map(lambda (cid, dat): ((cid, dat[0][0]), dat[0][1])) \
+                       .repartitionAndSortWithinPartitions(num_partitions,
+                                                           partitionFunc=lambda key: portable_hash(key[0]))
+
+
+# ----------------------------------------------------------------------
+# Purpose: Streaming version of getPageDurations(). Determine the
+#   duration since the previous page visit for each page visit of a
+#   customer. The first visit of a customer has a duration of zero.
+# Input: Iterator over a partition of getSortedEvents() output.
+# Output: Iterator of tuples with customer IP as key and a list of the
+#   string URL, timestamp and duration (in mins) of a page visit as value.
+#   As in getPageDurations() the timestamp of every visit except a
+#   customer's first is wrapped in a list so the sessionized output is
+#   the same for both paths.
+def getPageDurationsStream(it):
+
+    prev_cid = None
+    prev_dt = None
+    for (cid, dt), url in it:
+        if cid != prev_cid:
+            yield (cid, [url, dt, 0])
+        else:
+            yield (cid, [url, [dt], (dt - prev_dt).total_seconds() / 60.0])
+        prev_cid = cid
+        prev_dt = dt
+
+
+# ----------------------------------------------------------------------
+# Purpose: Group the sorted page visits of a partition by customer IP
+#   to build the per customer record used by getPageDurations().
+# Input: Iterator over a partition of getSortedEvents() output.
+# Output: Iterator of tuples with customer IP as key and a list of
+#   timestamp and url pairs (in timestamp order) as value.
+def groupSortedEvents(it):
+
+    for cid, events in groupby(it, key=lambda ((cid, dt), url): cid):
+        yield (cid, [[dt, url] for (_, dt), url in events])
+
+
+# ----------------------------------------------------------------------
+# Purpose: Convert a customer record from getPageDurations() to the per
+#   page visit stream produced by getPageDurationsStream().
+# Input: A line of customer data with IP as key, and a list as value
+#   consisting of a list of all urls visited, a list of timestamps for
+#   each page visited, and a list of durations between page visits.
+# Output: Iterator of tuples with customer IP as key and a list of the
+#   string URL, timestamp and duration of a page visit as value.
+def iterPageDurations(lin):
+
+    cid = lin[0]
+    dat = lin[1]
+    for url, ts, dur in zip(dat[0], dat[1], dat[2]):
+        yield (cid, [url, ts, dur])
+
+
 # ----------------------------------------------------------------------
 # Purpose: Vary the session window and collect stats on the number of
 #   sessions and unique URLs in each session for a user's data for each
@@ -183,48 +483,142 @@ def getPageDurations(lin):
 #   Session windows are varied between 1 and SESSION_WINDOW_MAX_BC param
 def getSessionsURLHits(lin):
 
-    cid = lin[0]
-    dat = lin[1]
+    return next(getSessionsURLHitsStream(iterPageDurations(lin)))
 
-    lall_sess_url_hits = []
+
+# ----------------------------------------------------------------------
+# Purpose: Streaming version of getSessionsURLHits(). All session windows
+#   are handled in one pass over a customer's page visits, so the cost
+#   does not grow with the number of windows tested.
+#
+#   A page visit whose duration since the previous visit is dur starts a
+#   new session for every window <= dur and continues the open session
+#   for every larger window. The open sessions of the different windows
+#   are therefore nested and are kept as a stack of frames. Each frame
+#   holds the set of urls visited since the page visit that started it
+#   and the largest window it started a session for (its level). Levels
+#   strictly increase towards the bottom of the stack, and the open
+#   session for a window is the union of the frames from the top down to
+#   the first frame whose level is >= the window.
+#
+#   When a visit closes the sessions of windows 1 to k, the frames with
+#   level <= k are popped and merged (smaller set into larger) into the
+#   frame below them, recording the number of unique urls of the closed
+#   sessions as they are merged. A frame of level k is then pushed for
+#   the new visit. Session counts are recorded per range of windows in a
+#   difference array so each closed session costs O(1) regardless of how
+#   many windows it closes for.
+# Input: Iterator of page visits from getPageDurationsStream() with all
+#   the visits of a customer next to each other. The first visit of a
+#   customer in the partition always starts a session, even if it has a
+#   duration since an earlier visit (the first visit of a later time
+#   range of a hot IP, see getPageDurationsSkew()).
+# Output: Iterator of tuples with customer IP as key and the list of
+#   session stats for each session window as value (see
+#   getSessionsURLHits()).
+def getSessionsURLHitsStream(it):
 
     # lperiods = [0.1, 0.2]
-    lperiods = range(1, SESSION_WINDOW_MAX_BC.value)
-    for period in lperiods:
-        lsess_urls = []
-        lsession_hits = []
-        for url, dur in zip(dat[0], dat[2]):
-            # if duration between last page visited and current page
-            # is less than session period, then include url as part
-            # of current session
-            if dur < period:
-                lsess_urls.append(url)
-
-            # otherwise, record number of all previous unique url entries
-            # entries since last session as a distinct session, and
-            # re-initialize url list with current url entry to reflect
-            # a new session
-            else:
-                   # get unique # of urls and add to session hits list
-                lsession_hits.append(len(set(lsess_urls)))
-                lsess_urls= [url]
-
-        lsession_hits.append(len(set(lsess_urls)))
-
-         # create lpage_hits array with 7 entries
-         # entries 1 to 5 are counts of sessions with # of unique urls equal
-         # to the entry number, entry 6 is 6 or more urls, and entry 7 is total
-         # number of sessions
-        lpage_hits = [0] * 7
-        lpage_hits[6] += len(lsession_hits)
-        for spages in lsession_hits:
-            if spages <= 5:
-                lpage_hits[spages-1] += 1
-            else:
-                lpage_hits[5] += 1
-        lall_sess_url_hits.append(lpage_hits)
+    num_windows = SESSION_WINDOW_MAX_BC.value - 1
+    cid_cur = None
+    for cid, (url, ts, dur) in it:
+        if cid != cid_cur:
+            if cid_cur is not None:
+                closeSessionFrames(lframes, num_windows, ldiff)
+                yield (cid_cur, getWindowURLHits(ldiff))
+            cid_cur = cid
+            # the bottom frame starts a session for all windows
+            lframes = [[num_windows, set()]]
+            ldiff = [[0] * (num_windows + 1) for _ in range(6)]
+            # the bottom frame is the customer's first session, so a time
+            # range's first visit joins it rather than closing the empty frame
+            num_closed = 0
+        else:
+            # number of windows (1 min, 2 min, ...) for which the duration
+            # between last page visited and current page is not less than the
+            # session period, ie that start a new session at this page
+            num_closed = min(int(dur), num_windows)
+        if num_closed > 0:
+            closeSessionFrames(lframes, num_closed, ldiff)
+            lframes.append([num_closed, set([url])])
+        else:
+            lframes[-1][1].add(url)
+
+    if cid_cur is not None:
+        closeSessionFrames(lframes, num_windows, ldiff)
+        yield (cid_cur, getWindowURLHits(ldiff))
+
+
+# ----------------------------------------------------------------------
+# Purpose: Close the open sessions of windows 1 to num_closed by popping
+#   and merging the frames of the session stack used by
+#   getSessionsURLHitsStream().
+# Input: The stack of [level, set of urls] frames, the largest window to
+#   close sessions for and the difference array of session stats.
+# Output: None, the stack and difference array are updated in place.
+def closeSessionFrames(lframes, num_closed, ldiff):
+
+    acc_urls = set()
+    prev_level = 0
+    while lframes and lframes[-1][0] <= num_closed:
+        level, urls = lframes.pop()
+        acc_urls = mergeURLSets(acc_urls, urls)
+        # windows between the previous frame's level and this frame's level
+        # had their open session start at this frame
+        addWindowURLHits(ldiff, prev_level, level, len(acc_urls))
+        prev_level = level
+    if lframes:
+        lframes[-1][1] = mergeURLSets(lframes[-1][1], acc_urls)
+        if prev_level < num_closed:
+            addWindowURLHits(ldiff, prev_level, num_closed, len(lframes[-1][1]))
+
+
+# ----------------------------------------------------------------------
+# Purpose: Union two sets of urls by adding the smaller set to the larger.
+# Input: Two sets that are not used again by the caller.
+# Output: The union of the two sets.
+def mergeURLSets(urls_a, urls_b):
+
+    if len(urls_a) < len(urls_b):
+        urls_a, urls_b = urls_b, urls_a
+    urls_a |= urls_b
+    return urls_a
+
+
+# ----------------------------------------------------------------------
+# Purpose: Record one session for a range of session windows.
+# Input: Difference array with one list per number of unique urls
+#   (1, 2, 3, 4, 5, 6+) indexed by window, the range of windows as
+#   0 based indices [lo_ind, hi_ind) and number of unique urls in the
+#   session.
+# Output: None, the difference array is updated in place. Sessions
+#   without urls (an empty frame) are not counted.
+def addWindowURLHits(ldiff, lo_ind, hi_ind, spages):
+
+    if spages == 0:
+        return
+    bucket = min(spages, 6) - 1
+    ldiff[bucket][lo_ind] += 1
+    ldiff[bucket][hi_ind] -= 1
 
-    return (cid, lall_sess_url_hits)
+
+# ----------------------------------------------------------------------
+# Purpose: Convert the difference array of session stats to the session
+#   stats for each window.
+# Input: Difference array from addWindowURLHits()
+# Output: A list with one list of 7 entries for each window. Entries 1
+#   to 5 are counts of sessions with # of unique urls equal to the entry
+#   number, entry 6 is 6 or more urls, and entry 7 is total number of
+#   sessions.
+def getWindowURLHits(ldiff):
+
+    lall_sess_url_hits = []
+    lrunning = [0] * 6
+    for k in range(len(ldiff[0]) - 1):
+        for j in range(6):
+            lrunning[j] += ldiff[j][k]
+        lall_sess_url_hits.append(lrunning + [sum(lrunning)])
+    return lall_sess_url_hits
 
 # ----------------------------------------------------------------------
 # Purpose: Collect customer page visits into separate sessions based
@@ -238,14 +632,25 @@ def getSessionsURLHits(lin):
 #   list of urls in the session, and list of session timestamps.
 def getSessions(lin):
 
-    cid = lin[0]
-    dat = lin[1]
+    return list(getSessionsStream(iterPageDurations(lin)))
 
-    lsessions = []
-    lsess_durs = []
-    lsess_urls = []
-    lsess_ts = []
-    for url, ts, dur in zip(dat[0], dat[1], dat[2]):
+
+# ----------------------------------------------------------------------
+# Purpose: Streaming version of getSessions(). Sessions are emitted as
+#   soon as they are closed so only the current session of a customer
+#   is held in memory.
+# Input: Iterator of page visits from getPageDurationsStream() with all
+#   the visits of a customer next to each other.
+# Output: Iterator of sessions in the same format as getSessions().
+def getSessionsStream(it):
+
+    cid_cur = None
+    for cid, (url, ts, dur) in it:
+        if cid != cid_cur:
+            if cid_cur is not None:
+                yield (cid_cur, [lsess_durs, lsess_urls, lsess_ts])
+            cid_cur = cid
+            lsess_durs, lsess_urls, lsess_ts = [], [], []
           # if duration between last page visted and current page
           # is less than session period, then include duration, url
           # and timestamp as part of current session
@@ -258,34 +663,473 @@ def getSessions(lin):
           # lists with current entries to reflect a new session (duration
           # is always init to 0)
         else:
-            lsessions.append((cid, [lsess_durs, lsess_urls, lsess_ts ]))
+            yield (cid_cur, [lsess_durs, lsess_urls, lsess_ts])
             lsess_durs, lsess_urls, lsess_ts = [0], [url], [ts]
 
-    lsessions.append((cid, [lsess_durs, lsess_urls, lsess_ts]))
+    if cid_cur is not None:
+        yield (cid_cur, [lsess_durs, lsess_urls, lsess_ts])
+
+
+# ----------------------------------------------------------------------
+# Purpose: Detect hot customer IPs (e.g. load balancers and crawlers)
+#   from a sample of the parsed web log and pick time ranges to split
+#   each one's page visits into, so no partition gets much more than an
+#   average partition's share of page visits.
+# Input: RDD of parsed lines from getLines(), number of partitions,
+#   fraction of lines to sample, factor of the average page visits per
+#   partition above which an IP is hot, and max number of time ranges
+#   per hot IP.
+# Output: Dict with hot IP as key and the sorted list of Python datetimes
+#   that split its page visits into time ranges as value.
+def getHotKeySplits(date_url_RDD, num_partitions, sample_fraction, hot_factor, max_splits):
+
+    lsample = date_url_RDD.sample(False, sample_fraction, 42).map(lambda (cid, dat): (cid, dat[0][0])).collect()
+    if not lsample:
+        return {}
+    avg_per_partition = len(lsample) / float(num_partitions)
+    dsample_ts = {}
+    for cid, dt in lsample:
+        dsample_ts.setdefault(cid, []).append(dt)
+
+    dhot_splits = {}
+    for cid, lts in dsample_ts.items():
+        if len(lts) <= hot_factor * avg_per_partition:
+            continue
+        num_ranges = min(max_splits, int(math.ceil(len(lts) / avg_per_partition)))
+        lts.sort()
+        lsplits = sorted(set(lts[i * len(lts) / num_ranges] for i in range(1, num_ranges)))
+        if lsplits:
+            dhot_splits[cid] = lsplits
+    return dhot_splits
+
+
+# ----------------------------------------------------------------------
+# Purpose: Skew aware version of getSortedEvents(). Page visits of hot
+#   IPs are partitioned by time range into partitions of their own
+#   (after the num_partitions partitions of the other IPs), so the sort
+#   and sessionization of a hot IP is spread over several tasks.
+# Input: RDD of parsed lines from getLines(), number of partitions for
+#   the other IPs and the hot IP time range splits from getHotKeySplits().
+# Output: A tuple of the sorted RDD (same records as getSortedEvents()),
+#   and a dict with the partition index of each hot IP time range as key
+#   and a tuple of the IP and the number of the time range as value.
+def getSkewSortedEvents(date_url_RDD, num_partitions, dhot_splits):
+
+    dhot_base = {}
+    dhot_parts = {}
+    next_part = num_partitions
+    for cid in sorted(dhot_splits):
+        dhot_base[cid] = next_part
+        for sub in range(len(dhot_splits[cid]) + 1):
+            dhot_parts[next_part + sub] = (cid, sub)
+        next_part += len(dhot_splits[cid]) + 1
+
+    def partitionFunc(key):
+        if key[0] in dhot_base:
+            return dhot_base[key[0]] + bisect_right(dhot_splits[key[0]], key[1])
+        return portable_hash(key[0]) % num_partitions
+
+    sorted_RDD = date_url_RDD.map(lambda (cid, dat): ((cid, dat[0][0]), dat[0][1])) \
+                             .repartitionAndSortWithinPartitions(next_part, partitionFunc=partitionFunc)
+    return sorted_RDD, dhot_parts
+
+
+# ----------------------------------------------------------------------
+# Purpose: Find the timestamp of the page visit before each hot IP time
+#   range, i.e. the last page visit of the previous non empty time range
+#   of the same IP.
+# Input: Sorted RDD and dict of hot partitions from getSkewSortedEvents()
+# Output: Dict with the partition index of a time range as key and the
+#   Python datetime of the IP's previous page visit as value. The first
+#   non empty time range of each IP has no entry.
+def getSkewBoundaries(sorted_RDD, dhot_parts):
+
+    def getLastTimestamp(idx, it):
+        if idx not in dhot_parts:
+            return []
+        last_dt = None
+        for (cid, dt), url in it:
+            last_dt = dt
+        return [(idx, last_dt)] if last_dt is not None else []
+
+    dlast_ts = dict(sorted_RDD.mapPartitionsWithIndex(getLastTimestamp).collect())
+    dprev_ts = {}
+    prev = {}
+    for idx in sorted(dhot_parts):
+        cid = dhot_parts[idx][0]
+        if idx not in dlast_ts:
+            continue
+        if cid in prev:
+            dprev_ts[idx] = prev[cid]
+        prev[cid] = dlast_ts[idx]
+    return dprev_ts
+
+
+# ----------------------------------------------------------------------
+# Purpose: Skew aware version of getPageDurationsStream(). The first page
+#   visit of a hot IP time range is given the duration since the IP's
+#   previous page visit (and its timestamp is wrapped in a list) as it
+#   would have been if the IP's page visits had not been split up.
+# Input: Partition index, iterator over the partition of the sorted RDD
+#   and the dict of previous page visit timestamps from
+#   getSkewBoundaries().
+# Output: Iterator in the same format as getPageDurationsStream().
+def getPageDurationsSkew(idx, it, dprev_ts):
+
+    lvisits = getPageDurationsStream(it)
+    if idx in dprev_ts:
+        for cid, (url, dt, dur) in lvisits:
+            yield (cid, [url, [dt], (dt - dprev_ts[idx]).total_seconds() / 60.0])
+            break
+    for rec in lvisits:
+        yield rec
+
+
+# ----------------------------------------------------------------------
+# Purpose: Sessionize a partition of getPageDurationsSkew() output and tag
+#   the sessions of hot IP time ranges that may need to be stitched to
+#   the sessions of the neighbouring time ranges.
+# Input: Partition index, iterator of sessions from getSessionsStream()
+#   and the dict of hot partitions from getSkewSortedEvents().
+# Output: Iterator of tuples. Final sessions are (None, session). The first
+#   and last sessions of a hot IP time range are ((IP, time range number),
+#   [continues, first session, last session or None if there is only one]),
+#   where continues is true if the first session continues the last
+#   session of the previous time range.
+def tagSkewSessions(idx, it, dhot_parts):
+
+    if idx not in dhot_parts:
+        for sess in it:
+            yield (None, sess)
+        return
+
+    continues = True
+    first = None
+    last = None
+    for sess in it:
+        if not sess[1][0]:
+            # the first page visit started a new session, so nothing to continue
+            continues = False
+            continue
+        if first is None:
+            first = sess
+            continue
+        if last is not None:
+            yield (None, last)
+        last = sess
+    if first is not None:
+        # the first page visit of an IP's first time range has its timestamp unwrapped
+        yield (dhot_parts[idx], [continues and isinstance(first[1][2][0], list), first, last])
+
+
+# ----------------------------------------------------------------------
+# Purpose: Stitch together the sessions of a hot IP that were split at
+#   the boundaries of its time ranges.
+# Input: Iterable of (time range number, continues, first session, last
+#   session) tuples of a hot IP from tagSkewSessions().
+# Output: List of the IP's boundary sessions, with each session that
+#   spans a time range boundary merged into one.
+def stitchSkewSessions(lparts):
+
+    lsessions = []
+    pending = None
+    for sub, continues, first, last in sorted(lparts):
+        if continues and pending is not None:
+            first = (first[0], [pending[1][0] + first[1][0], pending[1][1] + first[1][1], pending[1][2] + first[1][2]])
+        elif pending is not None:
+            lsessions.append(pending)
+        if last is None:
+            pending = first
+        else:
+            lsessions.append(first)
+            pending = last
+    if pending is not None:
+        lsessions.append(pending)
     return lsessions
 
+
+# ----------------------------------------------------------------------
+# Purpose: Sessionize the output of getPageDurationsSkew() and stitch the
+#   sessions of hot IPs back together.
+# Input: RDD from getPageDurationsSkew() and the dict of hot partitions
+#   from getSkewSortedEvents().
+# Output: RDD of sessions in the same format as getSessionsStream().
+def getSkewSessions(cust_duration_RDD, dhot_parts):
+
+    tagged_RDD = cust_duration_RDD.mapPartitionsWithIndex(lambda idx, it: tagSkewSessions(idx, getSessionsStream(it), dhot_parts))
+    tagged_RDD.persist()
+    stitched_RDD = tagged_RDD.filter(lambda (key, val): key is not None) \
+                             .map(lambda ((cid, sub), val): (cid, (sub, val[0], val[1], val[2]))) \
+                             .groupByKey() \
+                             .flatMap(lambda (cid, lparts): stitchSkewSessions(lparts))
+    return tagged_RDD.filter(lambda (key, val): key is None).map(lambda (key, val): val).union(stitched_RDD)
+
+
+# ----------------------------------------------------------------------
+# Purpose: Time the sort and page duration work of each task on a sorted
+#   RDD, to show how evenly the work is spread.
+# Input: RDD from getSortedEvents() or getSkewSortedEvents()
+# Output: List of (partition index, number of page visits, secs) tuples.
+def getTaskRuntimes(sorted_RDD):
+
+    def timePartition(idx, it):
+        t_start = time.time()
+        num_visits = 0
+        for rec in getPageDurationsStream(it):
+            num_visits += 1
+        return [(idx, num_visits, time.time() - t_start)]
+
+    return sorted_RDD.mapPartitionsWithIndex(timePartition).collect()
+
+
+# ----------------------------------------------------------------------
+# Purpose: Print the distribution of task runtimes.
+# Input: Label for the run and list of task runtimes from
+#   getTaskRuntimes()
+# Output: None. The distribution is printed to std output.
+def printTaskRuntimes(label, lruntimes):
+
+    lsecs = sorted(secs for idx, num_visits, secs in lruntimes)
+    lvisits = sorted(num_visits for idx, num_visits, secs in lruntimes)
+    median_secs = lsecs[len(lsecs) / 2]
+    print '%s: %d tasks  page visits min/median/max: %d/%d/%d  secs min/median/max/total: %.2f/%.2f/%.2f/%.2f  max/median: %.1f' % \
+          (label, len(lsecs), lvisits[0], lvisits[len(lvisits) / 2], lvisits[-1], lsecs[0], median_secs, lsecs[-1],
+           sum(lsecs), lsecs[-1] / max(median_secs, 1e-6))
+
+# ----------------------------------------------------------------------
+# Purpose: Build a compact columnar record for each customer from the
+#   sorted page visits of a partition. Timestamps are held as int64
+#   microseconds since the epoch and URLs are dictionary encoded, so a
+#   customer record pickles as a few NumPy arrays instead of lists of
+#   Python datetimes and strings.
+# Input: Iterator over a partition of getSortedEvents() output.
+# Output: Iterator of tuples with customer IP as key and a list as value
+#   consisting of the list of distinct urls (the url dictionary), an
+#   int64 array of timestamps and an int32 array of url ids (indices into
+#   the url dictionary), both in timestamp order.
+def getColumnarRecords(it):
+
+    for cid, events in groupby(it, key=lambda ((cid, dt), url): cid):
+        lts = []
+        lurls = []
+        for (_, dt), url in events:
+            lts.append(getEpochMicros(dt))
+            lurls.append(url)
+        lurl_dict, url_ids = np.unique(lurls, return_inverse=True)
+        yield (cid, [lurl_dict.tolist(), np.array(lts, dtype=np.int64), url_ids.astype(np.int32)])
+
+
+# ----------------------------------------------------------------------
+# Purpose: Convert a Python datetime to microseconds since the epoch.
+# Input: A Python datetime object
+# Output: Integer number of microseconds since 1970-01-01 UTC
+def getEpochMicros(dt):
+    return calendar.timegm(dt.utctimetuple()) * US_PER_SEC + dt.microsecond
+
+
+# ----------------------------------------------------------------------
+# Purpose: Unwrap a timestamp of a session. All but a customer's first
+#   timestamp are wrapped in a list (see getPageDurations()).
+# Input: Python datetime, or a list holding it.
+# Output: Python datetime
+def getTimestamp(ts):
+    return ts[0] if isinstance(ts, list) else ts
+
+
+# ----------------------------------------------------------------------
+# Purpose: Get the start of the time bucket a timestamp falls in.
+#   Buckets are counted from the epoch (UTC), so any bucket size works
+#   and daily buckets (1440) start at midnight.
+# Input: Python datetime and the bucket size in mins.
+# Output: Python datetime of the start of the bucket.
+def getBucketStart(dt, bucket_mins):
+
+    mins = getEpochMicros(dt) // (60 * US_PER_SEC)
+    return dt - timedelta(minutes=mins % bucket_mins, seconds=dt.second, microseconds=dt.microsecond)
+
+
+# ----------------------------------------------------------------------
+# Purpose: Find the sessions in a customer's columnar record for a
+#   session window. A page visit starts a new session if the time since
+#   the previous visit is not less than the session window.
+# Input: int64 array of timestamps in microseconds (in timestamp order)
+#   and the session window in mins.
+# Output: A boolean array marking the page visits that start a session.
+def getSessionStarts(ts, session_window):
+
+    starts = np.empty(len(ts), dtype=bool)
+    starts[0] = True
+    starts[1:] = np.diff(ts) >= session_window * 60 * US_PER_SEC
+    return starts
+
+
+# ----------------------------------------------------------------------
+# Purpose: Count the unique urls of each session in a customer's
+#   columnar record.
+# Input: Boolean array of session starts from getSessionStarts(), int32
+#   array of url ids and the size of the url dictionary.
+# Output: An int array with the number of unique urls in each session.
+def getSessionUniqueURLs(starts, url_ids, num_urls):
+
+    sess_ids = np.cumsum(starts, dtype=np.int64) - 1
+    sess_urls = np.unique(sess_ids * num_urls + url_ids)
+    return np.bincount(sess_urls // num_urls, minlength=sess_ids[-1] + 1)
+
+
+# ----------------------------------------------------------------------
+# Purpose: Columnar version of getSessionsURLHits(). Each session window
+#   is handled with NumPy operations over the customer's whole record.
+# Input: A line of customer data from getColumnarRecords().
+# Output: A tuple with customer IP as key and the list of session stats
+#   for each session window as value (see getSessionsURLHits()).
+def getSessionsURLHitsColumnar(lin):
+
+    cid = lin[0]
+    lurl_dict, ts, url_ids = lin[1]
+
+    lall_sess_url_hits = []
+    for period in range(1, SESSION_WINDOW_MAX_BC.value):
+        starts = getSessionStarts(ts, period)
+        sess_hits = getSessionUniqueURLs(starts, url_ids, len(lurl_dict))
+        lpage_hits = np.bincount(np.minimum(sess_hits, 6) - 1, minlength=6).tolist()
+        lall_sess_url_hits.append(lpage_hits + [len(sess_hits)])
+
+    return (cid, lall_sess_url_hits)
+
+
 # ----------------------------------------------------------------------
-# Purpose: Calculate the full duration of each session. As a side effect,
-#   also calculate the sum of all session times and the total number of
-#   sessions using Accumulator vars.
+# Purpose: Columnar version of getSessionTime() and the unique URL count
+#   of each session. Durations and unique URL counts of all of a
+#   customer's sessions are calculated at once with NumPy.
+# Input: A line of customer data from getColumnarRecords().
+# Output: A list with one element for each session of the customer. Each
+#   element is a tuple with customer IP as key and a list as value
+#   consisting of the duration of the session (in mins) and the number of
+#   unique urls visited in the session.
+def getSessionStatsColumnar(lin):
+
+    cid = lin[0]
+    lurl_dict, ts, url_ids = lin[1]
+
+    starts = getSessionStarts(ts, SESSION_WINDOW_BC.value)
+    # durations between page visits in mins (same operations as
+    # timedelta.total_seconds() / 60.0), with the first page of a session
+    # always having a duration of 0
+    durs = np.zeros(len(ts))
+    durs[1:] = np.diff(ts) / float(US_PER_SEC) / 60.0
+    durs[starts] = 0
+    lstart_inds = np.flatnonzero(starts)
+    sess_durs = np.add.reduceat(durs, lstart_inds)
+    sess_pages = np.diff(np.append(lstart_inds, len(ts)))
+    sess_hits = getSessionUniqueURLs(starts, url_ids, len(lurl_dict))
+
+    # single page sessions have an int 0 duration, as the sum in getSessionTime()
+    return [(cid, [dur if pages > 1 else 0, hits])
+            for dur, pages, hits in zip(sess_durs.tolist(), sess_pages.tolist(), sess_hits.tolist())]
+
+
+# ----------------------------------------------------------------------
+# Purpose: Columnar version of getSessions(), used only to write out the
+#   sessionized data.
+# Input: A line of customer data from getColumnarRecords().
+# Output: A list of sessions in the same format as getSessions(). As in
+#   getPageDurations() the timestamp of every page visit except the
+#   customer's first is wrapped in a list.
+def getSessionsColumnar(lin):
+
+    cid = lin[0]
+    lurl_dict, ts, url_ids = lin[1]
+
+    starts = getSessionStarts(ts, SESSION_WINDOW_BC.value)
+    durs = np.zeros(len(ts))
+    durs[1:] = np.diff(ts) / float(US_PER_SEC) / 60.0
+    durs[starts] = 0
+    lurls = [lurl_dict[k] for k in url_ids.tolist()]
+    lts = [EPOCH + timedelta(microseconds=k) for k in ts.tolist()]
+    lts = [lts[0]] + [[dt] for dt in lts[1:]]
+
+    lsessions = []
+    lbounds = np.flatnonzero(starts).tolist() + [len(ts)]
+    for k_start, k_end in zip(lbounds[:-1], lbounds[1:]):
+        # the first duration of a session is an int 0, as in getSessions()
+        lsessions.append((cid, [[0] + durs[k_start + 1:k_end].tolist(), lurls[k_start:k_end], lts[k_start:k_end]]))
+    return lsessions
+
+# ----------------------------------------------------------------------
+# Purpose: Calculate the full duration of each session. The sum of all
+#   session times and the total number of sessions are computed from
+#   these as a reduction (see session_stats.getDurationStats()).
 # Input: A line of customer session data with IP as key, and a list as
 #   value consisting of a list of durations between session pages, a
 #   list of urls visited, a list of timestamps for each page visited.
 # Output: A tuple with a customer IP as key and the duration of the
-#   session as value. As a side effect also add this data to the
-#   accumulator vars representing the sum of all session times and
-#   total number of sessions
+#   session as value.
 def getSessionTime(lin):
-    global SUM_SESSION_TIME_ACC, TOTAL_SESSIONS_ACC
 
     cid = lin[0]
     dat = lin[1]
     dur = sum(dat[0])
-    SUM_SESSION_TIME_ACC += dur
-    TOTAL_SESSIONS_ACC += 1
 
     return (cid, dur)
 
+# ----------------------------------------------------------------------
+# Purpose: Same as getSessionTime() for the session stats from
+#   getSessionStatsColumnar() where the duration is already calculated.
+# Input: A tuple with customer IP as key and a list as value consisting
+#   of the duration of the session and number of unique urls visited.
+# Output: A tuple with a customer IP as key and the duration of the
+#   session as value.
+def getSessionTimeColumnar(lin):
+
+    cid = lin[0]
+    dur = lin[1][0]
+
+    return (cid, dur)
+
+# ----------------------------------------------------------------------
+# Purpose: Start the engagement totals of a user from one session (used
+#   as createCombiner by getEngagementTotals()).
+# Input: A tuple of the session duration and number of unique urls.
+# Output: A list of total unique url hits, total session time and number
+#   of sessions.
+def newEngagementTotals((dur, hits)):
+    return [hits, dur, 1.0]
+
+# ----------------------------------------------------------------------
+# Purpose: Add a session to the engagement totals of a user (mergeValue).
+# Input: The totals from newEngagementTotals() and a tuple of the session
+#   duration and number of unique urls.
+# Output: The totals, updated in place.
+def addEngagementTotals(tot, (dur, hits)):
+    tot[0] += hits
+    tot[1] += dur
+    tot[2] += 1.0
+    return tot
+
+# ----------------------------------------------------------------------
+# Purpose: Merge the engagement totals of a user from two partitions
+#   (mergeCombiners).
+# Input: Two totals from newEngagementTotals()
+# Output: The first totals, updated in place.
+def mergeEngagementTotals(tot_a, tot_b):
+    tot_a[0] += tot_b[0]
+    tot_a[1] += tot_b[1]
+    tot_a[2] += tot_b[2]
+    return tot_a
+
+# ----------------------------------------------------------------------
+# Purpose: Calculate the engagement stats of every user in a single pass
+#   (one shuffle) over the per session stats.
+# Input: RDD of tuples with IP as key and a tuple of session duration and
+#   number of unique urls of a session as value.
+# Output: RDD with IP as key and a list as value of total unique url
+#   hits, total session time, avg url hits per session, avg session time
+#   and number of sessions.
+def getEngagementTotals(session_stats_RDD):
+
+    return session_stats_RDD.combineByKey(newEngagementTotals, addEngagementTotals, mergeEngagementTotals) \
+                            .mapValues(lambda tot: [tot[0], tot[1], tot[0] / tot[2], tot[1] / tot[2], tot[2]])
+
 # ----------------------------------------------------------------------
 # Purpose: Heuristic for determining optimal session window.
 # Input: A dict of the window stats indexed by number of URL hits
@@ -294,9 +1138,9 @@ def getSessionTime(lin):
 # Output: A list of optimal session windows given as a list of numbers
 #   in minutes. Return an empty list if no good windows found.
 #   Each number represents a different cohort but the first (or 2nd)
-#   number is suggested as the best session window size. As a side effect
-#   we also plot a line graph of how the percentage changes in the 5 mins
-#   before and after these optimal points.
+#   number is suggested as the best session window size. How the
+#   percentage changes around these points is plotted separately by
+#   plotOptimalSessionWindow().
 
 # General strategy and rationale for determining this heuristic:
 #
@@ -322,24 +1166,28 @@ def getSessionTime(lin):
 # Note: Selecting the percentage of 1 page sessions as opposed to 2-page sessions,
 #    3-page sessions, etc. is somewhat arbitrary. But results are generally
 #    consistent across different number of URL hits.
-def getOptimalSessionWindow(lpg_sess_stats, one_pg_sess_change_fl):
+def getOptimalSessionWindow(lpg_sess_stats):
       # set the heuristic to look at sessions with one URL hit (first or zero index)
     pg_vw = 0
       # total number of cohorts to search for (ie total number of time indices to find)
     num_cohorts = 2
-    lind = []
-    num_ind = 0
       # find all time indices when percentage increases from the previous time index
-      # up to the number of cohorts specified.
-      # also plot these percentages in the vicinity of these time indices
-    for k in range(len(lpg_sess_stats[pg_vw]) - 1):
-        if lpg_sess_stats[pg_vw][k + 1] > lpg_sess_stats[pg_vw][k]:
-            num_ind += 1
-            lind.append(k)
-            plt.plot(map(lambda x: x - 5, range(len(lpg_sess_stats[pg_vw][k - 5:k + 6]))), \
-                     lpg_sess_stats[pg_vw][k - 5:k + 6], label=str(k) + ' Min Session Period')
-            if num_ind >= num_cohorts:
-                break
+      # up to the number of cohorts specified
+    lpcts = np.array(lpg_sess_stats[pg_vw])
+    return np.flatnonzero(lpcts[1:] > lpcts[:-1])[:num_cohorts].tolist()
+
+# ----------------------------------------------------------------------
+# Purpose: Plot a line graph of how the percentage of sessions with one
+#   URL hit changes in the 5 mins before and after the optimal time
+#   indices found by getOptimalSessionWindow().
+# Input: A dict of the window stats (see getOptimalSessionWindow()), the
+#   list of optimal time indices and the file name to save the plot to.
+# Output: A line graph saved to the pdf file (if any indices were found).
+def plotOptimalSessionWindow(lpg_sess_stats, lind, one_pg_sess_change_fl):
+    pg_vw = 0
+    for k in lind:
+        plt.plot(map(lambda x: x - 5, range(len(lpg_sess_stats[pg_vw][k - 5:k + 6]))), \
+                 lpg_sess_stats[pg_vw][k - 5:k + 6], label=str(k) + ' Min Session Period')
     if len(lind) > 0:
         plt.legend()
         plt.xlabel('5 Min Before and After Optimal Time Index')
@@ -347,7 +1195,6 @@ def getOptimalSessionWindow(lpg_sess_stats, one_pg_sess_change_fl):
         plt.title('Plot of Session Percentage by Period Index For ' + str(pg_vw + 1) + ' URL(s) in Session')
         plt.savefig(one_pg_sess_change_fl, bbox_inches='tight')
         plt.close()
-    return lind
 
 # ----------------------------------------------------------------------
 # Purpose: Collect stats on how many X-page sessions there are for each
@@ -363,10 +1210,9 @@ def getOptimalSessionWindow(lpg_sess_stats, one_pg_sess_change_fl):
 def getSessionWindowStats(lsess_window_stats):
 
     page_nums = 6
-    lpg_sess_stats = {}
-    for j in range(page_nums):
-        lpg_sess_stats[j] = [(x[j] * 100.0) / x[6] for x in lsess_window_stats]
-    return lpg_sess_stats
+    sess_window_stats = np.array(lsess_window_stats, dtype=np.float64)
+    pg_sess_pcts = sess_window_stats[:, :page_nums] * 100.0 / sess_window_stats[:, page_nums:page_nums + 1]
+    return dict((j, pg_sess_pcts[:, j].tolist()) for j in range(page_nums))
 
 # ----------------------------------------------------------------------
 # Purpose: Create a stacked bar chart of the percentage of sessions with
@@ -442,10 +1288,202 @@ def plot3d(pdf_file, lx_vals, ly_vals, lz_vals, x_label, y_label, z_label, title
 def outputLocal(filname, lst):
     f = open(filname,'w')
     for ele in lst:
-        f.write(ele[0] + " " + str(ele[1]) + "\n")
+        f.write(getOutputLine(ele))
     f.close()
 
 
+# ----------------------------------------------------------------------
+# Purpose: Format a (key, value) tuple as a line of an output text file
+# Input: Tuple of the form (key, value)
+# Output: String with the key and value separated by a space and ending
+#   in a newline.
+def getOutputLine(ele):
+    return getOutputRecord(ele) + "\n"
+
+
+# ----------------------------------------------------------------------
+# Purpose: Format a (key, value) tuple as a record of an output text file
+# Input: Tuple of the form (key, value)
+# Output: String with the key and value separated by a space.
+def getOutputRecord(ele):
+    return ele[0] + " " + str(ele[1])
+
+
+# ----------------------------------------------------------------------
+# Purpose: Write the contents of a RDD of tuples to an output text file
+#   without collecting it on the driver. Each partition is written by an
+#   executor as a part file of the dir <filname>.parts, in the same line
+#   format as outputLocal(), so the part files of a sorted RDD hold
+#   the lines in sorted order.
+# Input: Filename to save to, a RDD of (key, value) tuples and the output
+#   writer: 'parts' to keep the part files, 'merged' to concatenate them
+#   into filname on the driver afterwards (streamed file by file, local
+#   file system only), or 'collect' to collect the RDD and write it with
+#   outputLocal().
+# Output: None
+def outputRDD(filname, rdd, output_writer):
+
+    if output_writer == 'collect':
+        outputLocal(filname, rdd.collect())
+        return
+    parts_dir = filname + '.parts'
+    shutil.rmtree(parts_dir, ignore_errors=True)
+    rdd.map(getOutputRecord).saveAsTextFile(parts_dir)
+    if output_writer == 'merged':
+        mergeOutputParts(parts_dir, filname)
+
+
+# ----------------------------------------------------------------------
+# Purpose: Concatenate the part files written by saveAsTextFile() into a
+#   single file and remove them.
+# Input: Dir of the part files and filename to save to.
+# Output: None
+def mergeOutputParts(parts_dir, filname):
+
+    f = open(filname, 'wb')
+    for part_file in sorted(os.listdir(parts_dir)):
+        if part_file.startswith('part-'):
+            fpart = open(os.path.join(parts_dir, part_file), 'rb')
+            shutil.copyfileobj(fpart, f)
+            fpart.close()
+    f.close()
+    shutil.rmtree(parts_dir, ignore_errors=True)
+
+
+# ----------------------------------------------------------------------
+# Purpose: Write a ranking of (key, value) tuples in descending order of
+#   value to an output file. With rankings topk only the top_k entries
+#   are written: each partition keeps a bounded heap of its top entries
+#   and the heaps are merged on the driver (takeOrdered()), so no shuffle
+#   of the whole RDD is needed. With rankings full the whole RDD is sorted
+#   (sortBy()) and written.
+# Input: Filename to save to, a RDD of (key, value) tuples, the parsed
+#   command line args, the kind of output (see outputFile()) and the
+#   number of top entries to return.
+# Output: List of the top num_top (key, value) tuples.
+def outputRanking(filname, rdd, args, output_kind, num_top=15):
+
+    if args.rankings == 'full':
+        outputFile(filname, rdd.sortBy(lambda (cid, val): -val), args, output_kind)
+        return rdd.takeOrdered(num_top, key=lambda (cid, val): -val)
+    ltop = rdd.takeOrdered(max(args.top_k, num_top), key=lambda (cid, val): -val)
+    outputFile(filname, rdd.context.parallelize(ltop[:args.top_k], 1), args, output_kind)
+    return ltop[:num_top]
+
+
+# ----------------------------------------------------------------------
+# Purpose: Driver side version of outputRanking() for a list of (key,
+#   value) tuples.
+# Input: List of (key, value) tuples and the parsed command line args.
+# Output: The list sorted in descending order of value, only its top_k
+#   entries with rankings topk (found with a bounded heap).
+def getRankingList(lst, args):
+
+    if args.rankings == 'full':
+        return sorted(lst, key=lambda (cid, val): -val)
+    return heapq.nlargest(args.top_k, lst, key=lambda (cid, val): val)
+
+
+# ----------------------------------------------------------------------
+# Purpose: Convert a session from getSessions() to a row of the sessions
+#   Parquet output. Timestamps are unwrapped from the lists that
+#   getPageDurations() puts them in, and the first octet of the IP and
+#   the hour the session started are added as partition columns.
+# Input: Tuple of (IP, [durations, urls, timestamps])
+# Output: Tuple in the order of SESSION_SCHEMA.
+def getSessionRow(ele):
+
+    cid, (ldurs, lurls, lts) = ele
+    lts = [getTimestamp(ts) for ts in lts]
+    return (cid, cid.split('.')[0], lts[0].strftime('%Y-%m-%dT%H'), lts[0],
+            [float(dur) for dur in ldurs], lurls, lts)
+
+
+# ----------------------------------------------------------------------
+# Purpose: Convert the engagement stats of a customer to a row of the
+#   engagement Parquet output.
+# Input: Tuple of (IP, [total page hits, total time, avg page hits,
+#   avg time, number of sessions])
+# Output: Tuple in the order of ENGAGEMENT_SCHEMA.
+def getEngagementRow(ele):
+
+    cid, dat = ele
+    return (cid, int(dat[0]), float(dat[1]), float(dat[2]), float(dat[3]), float(dat[4]))
+
+
+# schemas of the Parquet outputs, keyed by the kind of output as passed to outputFile(), with the
+# function converting a (key, value) tuple to a row and the columns the output is partitioned by
+SESSION_SCHEMA = StructType([StructField('cid', StringType(), False),
+                             StructField('ip_prefix', StringType(), False),
+                             StructField('start_hour', StringType(), False),
+                             StructField('session_start', TimestampType(), False),
+                             StructField('durations', ArrayType(DoubleType(), False), False),
+                             StructField('urls', ArrayType(StringType(), False), False),
+                             StructField('timestamps', ArrayType(TimestampType(), False), False)])
+URL_VISITS_SCHEMA = StructType([StructField('cid', StringType(), False),
+                                StructField('num_urls', LongType(), False)])
+DURATION_SCHEMA = StructType([StructField('cid', StringType(), False),
+                              StructField('total_time', DoubleType(), False)])
+ENGAGEMENT_SCHEMA = StructType([StructField('cid', StringType(), False),
+                                StructField('total_hits', LongType(), False),
+                                StructField('total_time', DoubleType(), False),
+                                StructField('avg_hits', DoubleType(), False),
+                                StructField('avg_time', DoubleType(), False),
+                                StructField('num_sessions', DoubleType(), False)])
+OUTPUT_SCHEMAS = {'sessions': (getSessionRow, SESSION_SCHEMA, ['ip_prefix', 'start_hour']),
+                  'url_visits': (lambda (cid, num_urls): (cid, int(num_urls)), URL_VISITS_SCHEMA, []),
+                  'durations': (lambda (cid, dur): (cid, float(dur)), DURATION_SCHEMA, []),
+                  'engagement': (getEngagementRow, ENGAGEMENT_SCHEMA, [])}
+
+
+# ----------------------------------------------------------------------
+# Purpose: Get the path of the Parquet output for an output file.
+# Input: Filename of the text output.
+# Output: The filename with its extension replaced by .parquet
+def getParquetPath(filname):
+    return os.path.splitext(filname)[0] + '.parquet'
+
+
+# ----------------------------------------------------------------------
+# Purpose: Write the contents of a RDD of tuples as a Parquet dataset
+#   with the schema of its kind of output. Rows are sorted by IP within
+#   each file so the Parquet min/max stats also let readers skip row
+#   groups when filtering on an IP.
+# Input: Filename of the text output (see getParquetPath()), a RDD of
+#   (key, value) tuples, the kind of output (key of OUTPUT_SCHEMAS) and
+#   the compression codec (e.g. snappy, gzip, zstd).
+# Output: None
+def outputParquet(filname, rdd, output_kind, compression):
+
+    row_fn, schema, lpartition_cols = OUTPUT_SCHEMAS[output_kind]
+    df = SparkSession(rdd.context).createDataFrame(rdd.map(row_fn), schema)
+    writer = df.sortWithinPartitions('cid').write.mode('overwrite').option('compression', compression)
+    if lpartition_cols:
+        writer = writer.partitionBy(*lpartition_cols)
+    writer.parquet(getParquetPath(filname))
+
+
+# ----------------------------------------------------------------------
+# Purpose: Write a RDD of tuples in the output format picked on the
+#   command line, and log the time taken.
+# Input: Filename to save to, a RDD of (key, value) tuples, the parsed
+#   command line args and the kind of output (key of OUTPUT_SCHEMAS).
+#   Text output of the sessions is indexed by IP if session_index is set.
+# Output: None
+def outputFile(filname, rdd, args, output_kind):
+
+    t_start = time.time()
+    if args.output_format == 'parquet':
+        filname = getParquetPath(filname)
+        outputParquet(filname, rdd, output_kind, args.output_compression)
+    elif output_kind == 'sessions' and args.session_index:
+        import session_index
+        session_index.outputIndexedRDD(filname, rdd, args.output_writer)
+    else:
+        outputRDD(filname, rdd, args.output_writer)
+    log.info('Wrote ' + filname + ' in %.2f secs' % (time.time() - t_start))
+
+
 
 #------------------------------------------------------------------------
 
@@ -467,10 +1505,61 @@ if __name__ == '__main__':
     parser.add_argument('--infile', default='/2015_07_22_mktplace_shop_web_log_sample.log', dest='infile', type=str, help='Web log input file to parse.')
     parser.add_argument('--working_dir_path', default='/home/jphilip/PyCharms/Projects/Proj1/', dest='working_dir_path', type=str, help='Full path to the dir where data, code and output reside')
     parser.add_argument('--session_period', dest='session_period', type=int, default=15, help='Time of inactivity in Minutes before another Session is deemed to begin.')
+    parser.add_argument('--engine', dest='engine', type=str, default='auto', choices=['auto', 'rdd', 'dataframe', 'local', 'incremental', 'stream'], help='Run the sessionization as Python RDD transformations (rdd), as DataFrame operations that stay in the JVM (dataframe), in a local pool of Python processes without Spark (local), incrementally over new log segments matching the infile glob carrying open sessions over between runs in state_dir (incremental), or continuously over log files arriving in stream_dir (stream). auto uses local for input files smaller than local_engine_max_mb with text output and rdd otherwise.')
+    parser.add_argument('--local_engine_max_mb', dest='local_engine_max_mb', type=int, default=256, help='Largest input file size in MB for which the auto engine runs the local engine.')
+    parser.add_argument('--local_processes', dest='local_processes', type=int, default=multiprocessing.cpu_count(), help='Number of worker processes of the local engine.')
+    parser.add_argument('--local_chunk_mb', dest='local_chunk_mb', type=int, default=64, help='Size in MB of the input file chunks parsed by each task of the local engine.')
+    parser.add_argument('--local_reader', dest='local_reader', type=str, default='mmap', choices=['mmap', 'lines'], help='How the local engine reads the input file: from a memory map, slicing only the IP, timestamp and URL out of each line (mmap), or a line at a time (lines). Gzip (.gz) and bz2 (.bz2) input files are always read with streaming decompression.')
+    parser.add_argument('--master', dest='master', type=str, default='local[6]', help='Spark master URL to run on.')
+    parser.add_argument('--per_ip_mode', dest='per_ip_mode', type=str, default='stream', choices=['stream', 'record', 'columnar'], help='Process each customer as a stream of page visits sorted in the shuffle (stream), as one record holding lists of all their page visits (record) or as one record holding NumPy arrays of their page visits (columnar).')
+    parser.add_argument('--quantile_error', dest='quantile_error', type=float, default=0.01, help='Relative error of the session time quantiles, computed from a mergeable histogram of log spaced buckets. Supported by the rdd and local engines.')
+    parser.add_argument('--rankings', dest='rankings', type=str, default='topk', choices=['topk', 'full'], help='Write only the top_k entries of the ranked output files (unique URL visits by session and customer session duration), found with a bounded heap per partition (topk), or sort and write all entries (full).')
+    parser.add_argument('--top_k', dest='top_k', type=int, default=1000, help='Number of entries of the ranked output files with rankings topk, and of each time window with top_k_window_mins.')
+    parser.add_argument('--top_k_window_mins', dest='top_k_window_mins', type=int, default=None, help='Also rank the top_k most engaged customers (by total session time) of each time window of this many mins (e.g. 60 for hourly), by the window their sessions start in, and write them to top_k_window_file. Supported by the rdd, local and stream engines.')
+    parser.add_argument('--rollup_mins', dest='rollup_mins', type=str, default=None, help='Comma separated list of time bucket sizes in mins (e.g. 1,60) to roll the sessions up to: number of sessions, sum and avg of session times, active users and unique URLs per bucket. A cube of the finest size is built in the same pass as the sessionization and saved to rollup_cube_file, and the coarser sizes are rolled up from it. Sizes must be multiples of the finest. Supported by the rdd and local engines.')
+    parser.add_argument('--rollup_url_prefix', action='store_true', default=False, help='Also roll up by URL prefix (the first segment of the URL path). Option rollup_mins must be set.')
+    parser.add_argument('--session_time_quantiles', dest='session_time_quantiles', type=str, default='0.5,0.9,0.95,0.99', help='Comma separated list of the quantiles (0 to 1) of the session times to report with the sum, count and avg session time.')
+    parser.add_argument('--session_key', dest='session_key', type=str, default='ip', choices=['ip', 'ip_ua', 'fingerprint'], help='Key to sessionize page visits by: the customer IP (ip), the IP and user agent (ip_ua) or the IP and a hash of the user agent and SSL cipher and protocol (fingerprint), so users behind a shared NAT or proxy IP get sessions of their own. Supported by the rdd and local engines.')
+    parser.add_argument('--key_encoding', dest='key_encoding', type=str, default='none', choices=['dict', 'none'], help='Encode the session keys as int ids from a dictionary of the distinct keys (dict), so the shuffles of the rdd engine carry ints instead of strings, or keep the string keys (none). The dictionary of all the distinct keys is collected to the driver and broadcast, so only use dict when the number of keys fits in memory. Output files always show the keys.')
+    parser.add_argument('--num_partitions', dest='num_partitions', type=int, default=None, help='Number of partitions to shuffle the page visits into by customer IP. Defaults to the number of input partitions.')
+    parser.add_argument('--skew_mode', dest='skew_mode', type=str, default='none', choices=['none', 'split'], help='Partition all page visits of a customer together (none), or detect hot IPs from a sample and split their page visits into time ranges that are sessionized in separate tasks and stitched back together (split). Option per_ip_mode must be stream. The session window heuristic sees a session that spans a time range boundary as two.')
+    parser.add_argument('--skew_sample_fraction', dest='skew_sample_fraction', type=float, default=0.01, help='Fraction of page visits sampled to detect hot IPs.')
+    parser.add_argument('--skew_hot_factor', dest='skew_hot_factor', type=float, default=2.0, help='An IP is hot if it has more than this many times the average page visits per partition.')
+    parser.add_argument('--skew_max_splits', dest='skew_max_splits', type=int, default=16, help='Max number of time ranges a hot IP is split into.')
+    parser.add_argument('--skew_report', action='store_true', default=False, help='Print the distribution of sort and page duration task runtimes with all page visits of an IP in one partition, and with hot IPs split if skew_mode is split.')
+    parser.add_argument('--metrics_file', dest='metrics_file', type=str, default=None, help='Name of a JSON file in the output dir to write per stage metrics (wall time, records, shuffle bytes, peak memory) of the RDD engine to. Each stage is run on its own to time it. No metrics are collected if not set.')
+    parser.add_argument('--metrics_baseline', dest='metrics_baseline', type=str, default=None, help='Full path to a metrics file of an earlier run to flag stages that got slower against. Option metrics_file must be set.')
+    parser.add_argument('--metrics_tolerance', dest='metrics_tolerance', type=float, default=0.2, help='Fraction a stage may be slower than in the metrics baseline before it is flagged as a regression.')
+    parser.add_argument('--state_dir', dest='state_dir', type=str, default=None, help='Full path to the dir holding the state (open sessions and totals) of the incremental engine. Defaults to the state dir in the working dir path.')
+    parser.add_argument('--stream_dir', dest='stream_dir', type=str, default=None, help='Full path to the dir the stream engine tails for arriving log files. Defaults to the stream dir in the data dir.')
+    parser.add_argument('--stream_trigger_secs', dest='stream_trigger_secs', type=int, default=10, help='Interval in secs at which the stream engine processes newly arrived log files.')
+    parser.add_argument('--stream_lateness_mins', dest='stream_lateness_mins', type=int, default=5, help='Time in Minutes a page visit may arrive behind the latest timestamp seen by the stream engine before it is dropped as late.')
+    parser.add_argument('--stream_timeout_secs', dest='stream_timeout_secs', type=int, default=None, help='Stop the stream engine and close all open sessions after this many secs. Runs until killed if not set.')
+    parser.add_argument('--output_writer', dest='output_writer', type=str, default='merged', choices=['merged', 'parts', 'collect'], help='Write output files from the executors as part files in a <output file>.parts dir (parts), as part files then concatenated into the output file (merged), or by collecting each output on the driver (collect).')
+    parser.add_argument('--output_format', dest='output_format', type=str, default='text', choices=['text', 'parquet'], help='Write the sessions, unique URL visits, customer durations and engagement stats as text files of Python reprs (text) or as Parquet datasets with a fixed schema in <output file name>.parquet dirs (parquet). Sessions are partitioned by the first octet of the IP and the hour the session started.')
+    parser.add_argument('--session_index', action='store_true', default=False, help='Also write an index of the sessionized output file by IP (<sessionized_cust_file>.idx) for fast lookups of the sessions of an IP with code/session_index.py. Text output only.')
+    parser.add_argument('--output_compression', dest='output_compression', type=str, default='snappy', help='Compression codec of Parquet output files, e.g. snappy, gzip or zstd (zstd needs a Spark build with the zstd codec).')
+    parser.add_argument('--cache_dir', dest='cache_dir', type=str, default=None, help='Full path to a dir to cache the parsed input in, so later runs on the same input file (e.g. with another session period) skip parsing the log. No cache is used if not set.')
+    parser.add_argument('--cache_max_mb', dest='cache_max_mb', type=int, default=4096, help='Max size in MB of the parse cache before the least recently used entries are evicted.')
+    parser.add_argument('--url_count_mode', dest='url_count_mode', type=str, default='exact', choices=['exact', 'hll'], help='Count the unique URLs of each session exactly from a set of its URLs (exact), or estimate them with HyperLogLog sketches which are also merged into approx unique URL counts per user and overall (hll).')
+    parser.add_argument('--hll_error', dest='hll_error', type=float, default=0.01, help='Relative standard error of the HyperLogLog unique URL counts (with url_count_mode hll) and of the active user and unique URL counts of the rollups (see rollup_mins).')
+    parser.add_argument('--hll_check_error', action='store_true', default=False, help='Also count unique URLs exactly and report the measured error of the HyperLogLog counts per session, per user and overall. Option url_count_mode must be hll.')
+    parser.add_argument('--out_dir', dest='out_dir', type=str, default=None, help='Full path to the dir to write output to. Defaults to the out dir in the working dir path.')
+    parser.add_argument('--session_periods', dest='session_periods', type=str, default=None, help='Comma separated list of session periods in Minutes (e.g. 13,15,34) to sessionize for in one run of the rdd engine, parsing and sorting the log only once. Each period gets its own output files, named with the period appended (e.g. Sessionized_Customer_File_15min.txt). Overrides session_period and the session window heuristic.')
     parser.add_argument('--bCalculate_session_window', action='store_true', default=True, help='Use heuristic to determine best session window. Overrides session_period param if set.')
       # params for names of several of the output files generated during processing
+    parser.add_argument('--window_heuristic', dest='window_heuristic', type=str, default='first_rise', choices=['first_rise', 'knee', 'cohort'], help='Heuristic to determine the best session window with (see code/window_select.py): the first rise in the percentage of sessions with one unique URL over whole minute windows (first_rise), the knee of the number of sessions against the window (knee), or the knee for each cohort of IPs with a similar number of page visits (cohort). knee and cohort only need a histogram of the times between page visits. Option bCalculate_session_window must be true.')
+    parser.add_argument('--window_step_secs', dest='window_step_secs', type=int, default=30, help='Step in secs between the session windows scored by the knee and cohort heuristics.')
+    parser.add_argument('--window_max_mins', dest='window_max_mins', type=int, default=240, help='Largest session window in mins scored by the knee and cohort heuristics.')
+    parser.add_argument('--skip_window_plots', action='store_true', default=False, help='Do not plot the stats the session window heuristic scores.')
+    parser.add_argument('--session_window_gap_plot_file', dest='session_window_gap_plot_file', type=str, default='Session_win_gap_knee.pdf', help='File name of the plot of the number of sessions by session period for the knee and cohort heuristics. Option bCalculate_session_window must be true.')
     parser.add_argument('--session_window_bar_chart_file', dest='session_window_bar_chart_file', type=str, default='Session_win_bar_chart.pdf', help='File name of bar chart file when calculating optimal session window. Option bCalculate_session_window must be true.')
     parser.add_argument('--sessionized_cust_file', dest='sessionized_cust_file', type=str, default='Sessionized_Customer_File.txt', help='Web file sessionized by customer according to session period and showing URLs, timestamps and page durations.')
+    parser.add_argument('--finalized_sessions_file', dest='finalized_sessions_file', type=str, default='Finalized_Sessions.txt', help='File the incremental engine appends closed sessions to, showing duration, unique URLs, page visits and start and end timestamps.')
+    parser.add_argument('--stream_latency_file', dest='stream_latency_file', type=str, default='Stream_Latency.txt', help='File the stream engine appends, for each micro-batch, the number of log files and closed sessions and the min and max secs from log file arrival to session emission.')
+    parser.add_argument('--top_k_window_file', dest='top_k_window_file', type=str, default='Top_Engaged_by_Window.txt', help='File to save the top_k most engaged customers of each time window to (see top_k_window_mins), one line per window with its start and the (IP, total session time) tuples.')
+    parser.add_argument('--rollup_file', dest='rollup_file', type=str, default='Session_Rollups.txt', help='File to save the rollups of each time bucket size to, with the size appended to its name (e.g. Session_Rollups_60min.txt). One line per bucket and URL prefix.')
+    parser.add_argument('--rollup_cube_file', dest='rollup_cube_file', type=str, default='Session_Rollups.pkl', help='File to save the rollup cube of the finest time bucket size to, from which code/rollups.py derives coarser rollups without the sessions.')
     parser.add_argument('--unique_url_visits_file', dest='unique_url_visits_file', type=str, default='Unique_URL_Visits_by_Session.txt', help='File giving the number of unique URL visits by session sorted in descending order.')
     parser.add_argument('--cust_session_duration_file', dest='cust_session_duration_file', type=str, default='Customer_Session_Duration.txt', help='File showing all customer sessions sorted by session duration.')
     parser.add_argument('--user_engagement_stats_file', dest='user_engagement_stats_file', type=str, default='User_Engagement_Stats.txt',help='Name of file to save several stats around user engagement')
@@ -485,32 +1574,153 @@ if __name__ == '__main__':
     log.addHandler(ch)
 
     log.info('Starting...')
-    sc = SparkContext("local[6]", "AAA")
 
     DATA_DIR = args.working_dir_path + 'data/'
-    OUT_DIR = args.working_dir_path + 'out/'
+    OUT_DIR = args.out_dir if args.out_dir is not None else args.working_dir_path + 'out/'
+
+    if args.engine == 'auto':
+        # small log slices are not worth the startup time of a SparkContext
+        infile_size = os.path.getsize(DATA_DIR + args.infile) if os.path.isfile(DATA_DIR + args.infile) else None
+        if infile_size is not None and infile_size < args.local_engine_max_mb * 1024 * 1024 and args.output_format == 'text' \
+                and args.session_periods is None:
+            args.engine = 'local'
+        else:
+            args.engine = 'rdd'
+        log.info('Using ' + args.engine + ' engine.')
+
+    if args.session_key != 'ip' and args.engine not in ['rdd', 'local']:
+        log.warning('Session keys other than ip are only supported by the rdd and local engines, using ip.')
+        args.session_key = 'ip'
+
+    if args.session_periods is not None and args.engine != 'rdd':
+        log.warning('Session periods are only supported by the rdd engine, using session_period.')
+        args.session_periods = None
+
+    if args.rollup_mins is not None and (args.engine not in ['rdd', 'local'] or args.session_periods is not None):
+        log.warning('Rollups are only supported by the rdd and local engines with a single session period, skipping them.')
+        args.rollup_mins = None
+
+    if args.engine == 'local':
+        if args.output_format != 'text':
+            log.warning('The local engine only writes text output files.')
+        import local_engine
+        local_engine.runLocalEngine(args, DATA_DIR, OUT_DIR)
+        sys.exit(0)
+
+    sc = SparkContext(args.master, "AAA")
+
+    if args.engine == 'dataframe':
+        import dataframe_engine
+        dataframe_engine.runDataFrameEngine(sc, args, DATA_DIR, OUT_DIR)
+        sys.exit(0)
+
+    if args.engine == 'incremental':
+        if args.state_dir is None:
+            args.state_dir = args.working_dir_path + 'state/'
+        import incremental_engine
+        incremental_engine.runIncrementalEngine(sc, args, DATA_DIR, OUT_DIR)
+        sys.exit(0)
+
+    if args.engine == 'stream':
+        if args.stream_dir is None:
+            args.stream_dir = DATA_DIR + 'stream/'
+        import stream_engine
+        stream_engine.runStreamEngine(sc, args, OUT_DIR)
+        sys.exit(0)
 
     SESSION_WINDOW_MAX_BC = sc.broadcast(SESSION_WINDOW_MAX)   # Broadcast var to store max session window to test
+    SESSION_KEY_BC = sc.broadcast(args.session_key)       # Broadcast var to store kind of session key
     WEB_LOG_IP_IND_BC = sc.broadcast(WEB_LOG_IP_IND)      # Broadcast var to store index of IP field
     WEB_LOG_URL_IND_BC = sc.broadcast(WEB_LOG_URL_IND)    # Broadcast var to store index of URL field
     WEB_LOG_TS_IND_BC = sc.broadcast(WEB_LOG_TS_IND)      # Broadcast var to store index of timestamp field
 
-    SUM_SESSION_TIME_ACC = sc.accumulator(0)     #  Accumulator to store sum of all session times
-    TOTAL_SESSIONS_ACC = sc.accumulator(0)       #  Accumulator to store total number of sessions
-
-    # parse input file, and collect IP, date and URL, then aggregate by customer IP, and calculate
-    # durations between page visits for each customer
-    log.info('Reading Input file...')
-    d1_lines_RDD = sc.textFile(DATA_DIR + args.infile)
-    log.info('Parsing IP, date and URL from Input...')
-    d2_date_url_RDD = d1_lines_RDD.flatMap(getLines)
-    log.info('Aggregating dates and URLs by customer IP...')
-    d3_agg_date_url_RDD = d2_date_url_RDD.reduceByKey(lambda a,b: a+b)
-    log.info('Sorting each customer line by date...')
-    d4_sort_agg_date_url_RDD = d3_agg_date_url_RDD.map(lambda (cid, dat): (cid, sorted(dat, key=lambda x: x[0]) ))
+    # per stage metrics (each stage is run on its own when enabled, otherwise the stage functions do nothing)
+    import stage_metrics
+    dmetrics = stage_metrics.newRunMetrics(sc, args) if args.metrics_file is not None else None
+
+    # parse input file, and collect IP, date and URL, then partition by customer IP and sort by date
+    # within the shuffle, and calculate durations between page visits for each customer
+    cached_events = None
+    if args.cache_dir is not None:
+        import parse_cache
+        cached_events = parse_cache.loadParsedEvents(sc, args.cache_dir, DATA_DIR + args.infile, args.session_key)
+    if cached_events is not None:
+        log.info('Loading parsed IP, date and URL from cache...')
+        d2_date_url_RDD, num_malformed = cached_events
+    else:
+        log.info('Reading Input file...')
+        d1_lines_RDD = sc.textFile(DATA_DIR + args.infile)
+        log.info('Parsing IP, date and URL from Input...')
+        d2_date_url_RDD, num_malformed = getValidLines(d1_lines_RDD.map(parseLine))
+        if args.cache_dir is not None:
+            parse_cache.saveParsedEvents(sc, args.cache_dir, DATA_DIR + args.infile, d2_date_url_RDD,
+                                         num_malformed, args.cache_max_mb, args.session_key)
+    stage_metrics.runStage(dmetrics, 'parse', d2_date_url_RDD)
+
+    # dictionary encode the session keys, so the shuffles below carry int ids instead of (possibly long
+    # ip_ua) strings. The keys are decoded again where they are written to the output files or printed.
+    KEY_NAMES_BC = None
+    if args.key_encoding == 'dict':
+        log.info('Encoding session keys as int ids...')
+        d2_date_url_RDD.persist()   # read for the dictionary and again to encode the keys
+        lkey_names = stage_metrics.timeStage(dmetrics, 'encode_keys', lambda: getKeyNames(d2_date_url_RDD), 'parse')
+        log.info('Found ' + str(len(lkey_names)) + ' distinct session keys.')
+        KEY_IDS_BC = sc.broadcast(dict((key, k) for k, key in enumerate(lkey_names)))
+        KEY_NAMES_BC = sc.broadcast(lkey_names)
+        d2_date_url_RDD = encodeKeys(d2_date_url_RDD, KEY_IDS_BC)
+    log.info('Partitioning by customer IP and sorting each customer line by date...')
+    bSkew_split = args.skew_mode == 'split' and args.per_ip_mode == 'stream' and args.session_periods is None
+    if args.skew_mode == 'split' and not bSkew_split:
+        log.warning('Skew mode split is only supported with per_ip_mode stream and a single session period.')
+    if bSkew_split or args.skew_report:
+        d2_date_url_RDD.persist()   # sampled and sorted more than once
+    if args.skew_report:
+        printTaskRuntimes('Task runtimes by IP', getTaskRuntimes(getSortedEvents(d2_date_url_RDD, args.num_partitions)))
+    if bSkew_split:
+         # hot IPs get partitions of their own, one per time range of their page visits
+        num_partitions = args.num_partitions if args.num_partitions is not None else d2_date_url_RDD.getNumPartitions()
+        dhot_splits = getHotKeySplits(d2_date_url_RDD, num_partitions, args.skew_sample_fraction,
+                                      args.skew_hot_factor, args.skew_max_splits)
+        log.info('Found ' + str(len(dhot_splits)) + ' hot IPs: ' + str(sorted(getKeyName(cid, KEY_NAMES_BC) for cid in dhot_splits)))
+        d4_sorted_events_RDD, dhot_parts = getSkewSortedEvents(d2_date_url_RDD, num_partitions, dhot_splits)
+        d4_sorted_events_RDD.persist()
+        dprev_ts = getSkewBoundaries(d4_sorted_events_RDD, dhot_parts)
+        if args.skew_report:
+            printTaskRuntimes('Task runtimes with hot IPs split', getTaskRuntimes(d4_sorted_events_RDD))
+    else:
+        d4_sorted_events_RDD = getSortedEvents(d2_date_url_RDD, args.num_partitions)
+    stage_metrics.runStage(dmetrics, 'sort', d4_sorted_events_RDD, 'parse')
     log.info('Calculating times between page visits for each customer...')
-    d5_cust_duration_RDD = d4_sort_agg_date_url_RDD.map(getPageDurations)
+    if bSkew_split:
+         # as stream, with the first page visit of each hot IP time range given its duration since the
+         # last page visit of the previous time range
+        d5_cust_duration_RDD = d4_sorted_events_RDD.mapPartitionsWithIndex(lambda idx, it: getPageDurationsSkew(idx, it, dprev_ts),
+                                                                           preservesPartitioning=True)
+    elif args.per_ip_mode == 'stream':
+         # one element per page visit, with each customer's visits in date order next to each other
+        d5_cust_duration_RDD = d4_sorted_events_RDD.mapPartitions(getPageDurationsStream, preservesPartitioning=True)
+    elif args.per_ip_mode == 'columnar':
+         # one element per customer holding NumPy arrays of timestamps and url ids
+        d5_cust_duration_RDD = d4_sorted_events_RDD.mapPartitions(getColumnarRecords)
+    else:
+         # one element per customer holding lists of all their page visits
+        d5_cust_duration_RDD = d4_sorted_events_RDD.mapPartitions(groupSortedEvents).map(getPageDurations)
     d5_cust_duration_RDD.persist()
+    stage_metrics.runStage(dmetrics, 'durations', d5_cust_duration_RDD, 'sort')
+
+    if args.session_periods is not None:
+         # sessionize for all the session periods at once from the same page visits and durations
+        import multi_window
+        dperiod_totals = multi_window.runPeriodSessions(sc, args, d5_cust_duration_RDD,
+                                                        multi_window.getSessionPeriods(args.session_periods), OUT_DIR, dmetrics,
+                                                        KEY_NAMES_BC)
+        stage_metrics.setRunInfo(dmetrics, 'session_periods', sorted(dperiod_totals))
+        stage_metrics.setRunInfo(dmetrics, 'total_sessions', [dperiod_totals[period][1] for period in sorted(dperiod_totals)])
+        stage_metrics.setRunInfo(dmetrics, 'malformed_lines', num_malformed)
+        print 'Malformed Lines Skipped: ', str(num_malformed), '\n'
+        if args.metrics_file is not None:
+            stage_metrics.writeReport(dmetrics, OUT_DIR + args.metrics_file, args.metrics_baseline, args.metrics_tolerance)
+        sys.exit(0)
 
     # session window size is determined from session_period param or is overriden by the calculated
     # heuristic of optimal window size if the bCalculate_session_window param is set
@@ -518,70 +1728,137 @@ if __name__ == '__main__':
 
     if args.bCalculate_session_window:
         log.info('Calculating heuristic to determine optimal session window.')
-         # get stats for each user on unique URL hits / sesssion for different session windows
-        d6_url_session_RDD = d5_cust_duration_RDD.map(getSessionsURLHits)
-
-         # add up all user stats for unique URLs for each window size
-         # note: would normally use Numpy here for vector addition, but problem with Spark+Numpy integration
-        lsess_window_stats = d6_url_session_RDD.map(lambda (a, b): b).reduce(lambda a, b: [map(sum, zip(x, y)) for x, y in zip(a, b)])
-         # collect session stats as a dict with key being number of page hits and value being a percentage count of all
-         # sessions for that key for each of the different session window sizes
-        lpg_sess_stats = getSessionWindowStats(lsess_window_stats)
-         # save a bar chart showing distribution of session page hits across different window sizes
-        plotSessionWindowStats(lpg_sess_stats, OUT_DIR + args.session_window_bar_chart_file)
-         # determine heuristic for optimal window session size based on stats (none may be found)
-        lind = getOptimalSessionWindow(lpg_sess_stats, OUT_DIR + one_pg_sess_change_fl)
-        if len(lind) > 0:
-            log.info('Optimal session period is determined to be ' + str(lind[0]+1) + ' mins.')
-            session_window = lind[0] + 1
+        import window_select
+        sc.addPyFile(window_select.__file__.replace('.pyc', '.py'))
+        stats_kind, lwindows = window_select.getHeuristicWindows(args)
+        if stats_kind == 'url_hits':
+             # get stats for each user on unique URL hits / sesssion for different session windows
+            if args.per_ip_mode == 'stream':
+                d6_url_session_RDD = d5_cust_duration_RDD.mapPartitions(getSessionsURLHitsStream)
+            elif args.per_ip_mode == 'columnar':
+                d6_url_session_RDD = d5_cust_duration_RDD.map(getSessionsURLHitsColumnar)
+            else:
+                d6_url_session_RDD = d5_cust_duration_RDD.map(getSessionsURLHits)
+
+             # add up all user stats for unique URLs for each window size
+             # note: would normally use Numpy here for vector addition, but problem with Spark+Numpy integration
+            window_stats = stage_metrics.timeStage(dmetrics, 'window_heuristic',
+                                                   lambda: d6_url_session_RDD.map(lambda (a, b): b).reduce(lambda a, b: [map(sum, zip(x, y)) for x, y in zip(a, b)]),
+                                                   'durations')
+        else:
+             # histogram the gaps between page visits of each cohort of users over the window grid
+            if bSkew_split or args.per_ip_mode == 'stream':
+                d6_gap_hist_RDD = d5_cust_duration_RDD.mapPartitions(lambda it: window_select.getGapHistograms(it, lwindows))
+            elif args.per_ip_mode == 'columnar':
+                d6_gap_hist_RDD = d5_cust_duration_RDD.mapPartitions(lambda it: window_select.getGapHistogramsColumnar(it, lwindows))
+            else:
+                d6_gap_hist_RDD = d5_cust_duration_RDD.mapPartitions(lambda it: window_select.getGapHistograms(
+                                                                         (visit for lin in it for visit in iterPageDurations(lin)), lwindows))
+            window_stats = stage_metrics.timeStage(dmetrics, 'window_heuristic',
+                                                   lambda: window_select.getGapStats(d6_gap_hist_RDD), 'durations')
+         # determine the optimal window session size from the stats (none may be found) and plot the stats
+        opt_window = window_select.selectSessionWindow(args, OUT_DIR, stats_kind, lwindows, window_stats)
+        if opt_window is not None:
+            session_window = opt_window
 
 
     SESSION_WINDOW_BC = sc.broadcast(session_window)  # Broadcast var to store session period param
 
      # sessionize data and write to local file
     log.info('Sessionizing the data based on session period...')
-    d7_sessionized_RDD = d5_cust_duration_RDD.flatMap(getSessions)
+    if bSkew_split:
+        d7_sessionized_RDD = getSkewSessions(d5_cust_duration_RDD, dhot_parts)
+    elif args.per_ip_mode == 'stream':
+        d7_sessionized_RDD = d5_cust_duration_RDD.mapPartitions(getSessionsStream)
+    elif args.per_ip_mode == 'columnar':
+        d7_sessionized_RDD = d5_cust_duration_RDD.flatMap(getSessionsColumnar)
+    else:
+        d7_sessionized_RDD = d5_cust_duration_RDD.flatMap(getSessions)
     d7_sessionized_RDD.persist()  # store results of rdd so not have to recalculate
-    lSessionData = d7_sessionized_RDD.collect()
-    outputLocal(OUT_DIR + args.sessionized_cust_file, lSessionData)
+    stage_metrics.runStage(dmetrics, 'sessionize', d7_sessionized_RDD, 'durations')
+    stage_metrics.timeStage(dmetrics, 'output_sessions',
+                            lambda: outputFile(OUT_DIR + args.sessionized_cust_file, decodeKeys(d7_sessionized_RDD, KEY_NAMES_BC), args, 'sessions'))
+
+    if args.rollup_mins:
+        # time bucketed rollups, from the persisted sessions of each partition
+        import rollups
+        import url_sketch
+        sc.addPyFile(url_sketch.__file__.replace('.pyc', '.py'))
+        sc.addPyFile(rollups.__file__.replace('.pyc', '.py'))
+        lrollup_mins = rollups.getRollupMins(args.rollup_mins)
+        rollup_p = url_sketch.getHLLPrecision(args.hll_error)
+        drollup_cube = stage_metrics.timeStage(dmetrics, 'rollups',
+                                               lambda: rollups.getRollupCube(decodeKeys(d7_sessionized_RDD, KEY_NAMES_BC), lrollup_mins[0],
+                                                                             rollup_p, args.rollup_url_prefix))
+        rollups.outputRollups(drollup_cube, lrollup_mins, args, OUT_DIR)
 
 
     log.info('Calculating full duration of each session...')
-       # as a side effect this method also calculates total session time and total # of sessions
-       # and stores in accumulator vars
-    d8_session_duration_RDD = d7_sessionized_RDD.map(getSessionTime)
-    lSessionDuration = d8_session_duration_RDD.collect()
-
-        # store accumulator vars (before it is further modified)
-    sum_session_time = SUM_SESSION_TIME_ACC.value
-    total_num_sessions = TOTAL_SESSIONS_ACC.value
+    if args.per_ip_mode == 'columnar':
+          # session durations and unique url counts are calculated together from the columnar records
+        d8a_session_stats_RDD = d5_cust_duration_RDD.flatMap(getSessionStatsColumnar)
+        d8a_session_stats_RDD.persist()
+        d8_session_duration_RDD = d8a_session_stats_RDD.map(getSessionTimeColumnar)
+    else:
+        d8_session_duration_RDD = d7_sessionized_RDD.map(getSessionTime)
+    d8_session_duration_RDD.persist()   # persist -- used for the session stats and the engagement totals
+    stage_metrics.timeStage(dmetrics, 'session_time', d8_session_duration_RDD.count, 'sessionize')
+
+    # sum, count and quantiles of the session times, as a reduction so that retried or
+    # recomputed tasks cannot count their sessions twice
+    import session_stats
+    sc.addPyFile(session_stats.__file__.replace('.pyc', '.py'))
+    lquantiles = session_stats.getQuantiles(args.session_time_quantiles)
+    dduration_stats = stage_metrics.timeStage(dmetrics, 'session_stats',
+                                              lambda: session_stats.getDurationStats(d8_session_duration_RDD.values(), args.quantile_error))
 
     ## print to stdout the avg session time
-    print '\n\nSum of All Session Times (mins): ', str(sum_session_time)
-    print 'Total Number of Sessions: ', str(total_num_sessions)
-    print 'Avg Session Time (mins): ', str(sum_session_time / (0.0 + total_num_sessions)), '\n'
+    sum_session_time, total_num_sessions = session_stats.printSummary(dduration_stats, lquantiles)
+    print 'Malformed Lines Skipped: ', str(num_malformed), '\n'
 
     # Get number of unique page visits per session and sort them in descending order
     log.info('Calculating number of page hits for each user session...')
-    d8b_page_hits_RDD = d7_sessionized_RDD.map(lambda (cid, dat): (cid, len(set(dat[1]))) )
+    if args.url_count_mode == 'hll':
+         # estimate unique urls from a HyperLogLog sketch of each session, which also gives the
+         # unique urls per user and overall by merging sketches instead of building sets of urls
+        import url_sketch
+        sc.addPyFile(url_sketch.__file__.replace('.pyc', '.py'))
+        hll_p = url_sketch.getHLLPrecision(args.hll_error)
+        d8s_url_sketch_RDD = d7_sessionized_RDD.map(lambda (cid, dat): (cid, url_sketch.getURLSketch(dat[1], hll_p)))
+        d8s_url_sketch_RDD.persist()
+        d8b_page_hits_RDD = d8s_url_sketch_RDD.map(lambda (cid, sketch): (cid, url_sketch.getSketchCount(sketch)))
+        d8t_ip_sketch_RDD = d8s_url_sketch_RDD.reduceByKey(url_sketch.mergeURLSketches)
+        d8t_ip_sketch_RDD.persist()
+        lip_unique_urls = d8t_ip_sketch_RDD.map(lambda (cid, sketch): (cid, url_sketch.getSketchCount(sketch))) \
+                                           .takeOrdered(15, key=lambda (cid, num_urls): -num_urls)
+        num_unique_urls = url_sketch.getSketchCount(d8t_ip_sketch_RDD.values().reduce(url_sketch.mergeURLSketches))
+        print 'Unique URLs across all sessions (approx, p=' + str(hll_p) + '): ', str(num_unique_urls)
+        print 'Top 15 users by unique URL visits across sessions (approx): ' + str(decodeKeyList(lip_unique_urls, KEY_NAMES_BC))
+        if args.hll_check_error:
+            # exact counts for comparison, built from sets of urls
+            for name, counts_RDD in \
+                    [('session', d7_sessionized_RDD.zip(d8s_url_sketch_RDD)
+                                                   .map(lambda ((cid, dat), (cid2, sketch)): (len(set(dat[1])), url_sketch.getSketchCount(sketch)))),
+                     ('user', d7_sessionized_RDD.map(lambda (cid, dat): (cid, set(dat[1]))).reduceByKey(lambda a, b: a | b)
+                                                .join(d8t_ip_sketch_RDD)
+                                                .map(lambda (cid, (surls, sketch)): (len(surls), url_sketch.getSketchCount(sketch))))]:
+                num, mean_err, max_err, num_inexact = url_sketch.getCountErrorStats(counts_RDD)
+                print 'HLL error per %s: count %d  mean rel error %.5f  max rel error %.5f  inexact %d' % \
+                      (name, num, mean_err, max_err, num_inexact)
+            num_exact = d7_sessionized_RDD.flatMap(lambda (cid, dat): dat[1]).distinct().count()
+            print 'HLL error overall: exact %d  approx %d  rel error %.5f' % \
+                  (num_exact, num_unique_urls, abs(num_unique_urls - num_exact) / float(max(num_exact, 1)))
+    elif args.per_ip_mode == 'columnar':
+        d8b_page_hits_RDD = d8a_session_stats_RDD.map(lambda (cid, dat): (cid, dat[1]))
+    else:
+        d8b_page_hits_RDD = d7_sessionized_RDD.map(lambda (cid, dat): (cid, len(set(dat[1]))) )
     d8b_page_hits_RDD.persist()     # persist -- will use later to get total hits across sessions
-    d8c_sort_page_hits = d8b_page_hits_RDD.sortBy(lambda (cid, session_hits): -session_hits)
-    lunique_url_visits = d8c_sort_page_hits.collect()
-    print 'lunique url : ' + str(lunique_url_visits)
-    outputLocal(OUT_DIR + args.unique_url_visits_file, lunique_url_visits)
-
-    # Now add up session times by user and sort results in descending order
-    log.info('Calculating total duration for each user across sessions...')
-    d9_total_cust_session_RDD = d8_session_duration_RDD.reduceByKey(lambda a, b: a + b)
-    d10_sorted_total_cust_session = d9_total_cust_session_RDD.sortBy(lambda (cid, dur): -dur)
-    d10_sorted_total_cust_session.persist()     # persist -- will use later to merge with total page hits
-    lTotalSessionDuration = d10_sorted_total_cust_session.collect()
-    outputLocal(OUT_DIR + args.cust_session_duration_file, lTotalSessionDuration)
-
-    # print to stdout the top 15 most engaged users with their full session time across sessions
-    topIPs = lTotalSessionDuration[0:14]
-    print '\n\nTop 15 Most Engaged users by total duration from all their sessions (mins): ' + str(topIPs)
-
+    stage_metrics.runStage(dmetrics, 'unique_urls', d8b_page_hits_RDD, 'sessionize')
+    # sessions ranked by unique url visits, only the top_k unless rankings full is asked for
+    lunique_url_visits = stage_metrics.timeStage(dmetrics, 'output_url_visits',
+                                                 lambda: outputRanking(OUT_DIR + args.unique_url_visits_file, decodeKeys(d8b_page_hits_RDD, KEY_NAMES_BC),
+                                                                       args, 'url_visits'))
+    print 'Top 15 sessions by unique URL visits: ' + str(lunique_url_visits)
 
     #-----------------------------------------------------------------------------------------------------
     # As an alternate definition of an 'engaged' user, we collect stats for total time across sessions, avg time
@@ -589,22 +1866,45 @@ if __name__ == '__main__':
     # for each user in a single file
     # Many of these stats are correlated but we can pick 2 or more to give a better indicator of user engagement
 
-    # Get total page hits across sessions and total number of sessions per user.
-    log.info('Calculating total page hits across sessions and total number of sessions per user...')
-    d11_page_sessions_RDD = d8b_page_hits_RDD.map(lambda (cid, page_hit): (cid, [page_hit, 1.0]))
-    d12_total_page_sessions_RDD = d11_page_sessions_RDD.reduceByKey(lambda a, b: [a[0] + b[0], a[1] + b[1]])
+    # Add up session times, page hits and sessions per user in a single aggregation. The durations and page
+    # hits RDDs are both maps of the sessions, so they zip (partition for partition) without a shuffle.
+    log.info('Calculating total duration, total page hits and total number of sessions per user...')
+    d9_session_stats_RDD = d8_session_duration_RDD.zip(d8b_page_hits_RDD) \
+                                                  .map(lambda ((cid, dur), (cid2, page_hit)): (cid, (dur, page_hit)))
+    d14_total_engagement_RDD = getEngagementTotals(d9_session_stats_RDD)
+    d14_total_engagement_RDD.persist()
+    stage_metrics.runStage(dmetrics, 'aggregate_engagement', d14_total_engagement_RDD, 'session_time')
+
+    # total session time by user, ranked in descending order only for the output file
+    topIPs = stage_metrics.timeStage(dmetrics, 'output_durations',
+                                     lambda: outputRanking(OUT_DIR + args.cust_session_duration_file,
+                                                           decodeKeys(d14_total_engagement_RDD.map(lambda (cid, dat): (cid, dat[1])), KEY_NAMES_BC),
+                                                           args, 'durations'))
 
-    log.info('Joining time across sessions with total page hits per user...')
-    d13_engagement_RDD = d12_total_page_sessions_RDD.join(d10_sorted_total_cust_session)
-    d14_total_engagement_RDD = d13_engagement_RDD.map(lambda (cid, dat): (cid, [dat[0][0], dat[1], dat[0][0]/dat[0][1],\
-                                                                  dat[1]/dat[0][1], dat[0][1] ]))
-    lTotalEngagementStats = d14_total_engagement_RDD.collect()
-    outputLocal(OUT_DIR + args.user_engagement_stats_file, lTotalEngagementStats)
+    # print to stdout the top 15 most engaged users with their full session time across sessions
+    print '\n\nTop 15 Most Engaged users by total duration from all their sessions (mins): ' + str(topIPs)
+
+    if args.top_k_window_mins:
+        # top_k most engaged users of each time window, by the window their sessions start in
+        import top_k
+        sc.addPyFile(top_k.__file__.replace('.pyc', '.py'))
+        window_mins = args.top_k_window_mins
+        d10w_window_sessions_RDD = d7_sessionized_RDD.map(lambda (cid, dat): ((getBucketStart(getTimestamp(dat[2][0]), window_mins), cid),
+                                                                             sum(dat[0])))
+        lwindow_top = stage_metrics.timeStage(dmetrics, 'top_k_windows', lambda: top_k.getWindowTopK(d10w_window_sessions_RDD, args.top_k))
+        lwindow_top = [(window, decodeKeyList(ltop, KEY_NAMES_BC)) for window, ltop in lwindow_top]
+        top_k.writeWindowTopK(OUT_DIR + args.top_k_window_file, lwindow_top, 'w')
+        log.info('Wrote the top ' + str(args.top_k) + ' users of ' + str(len(lwindow_top)) + ' windows to ' + args.top_k_window_file)
+
+    stage_metrics.timeStage(dmetrics, 'output_engagement',
+                            lambda: outputFile(OUT_DIR + args.user_engagement_stats_file, decodeKeys(d14_total_engagement_RDD, KEY_NAMES_BC), args, 'engagement'))
 
     # pick 3 stats (avg URL hits, avg session time, # of sessions) and run a 3D scatterplot
-    lavg_page_hits = [x[1][2] for x in lTotalEngagementStats]
-    lavg_session_time = [x[1][3] for x in lTotalEngagementStats]
-    lnum_sessions = [x[1][4] for x in lTotalEngagementStats]
+    # (only these are collected to the driver for plotting)
+    lplot_stats = d14_total_engagement_RDD.map(lambda (cid, dat): (dat[2], dat[3], dat[4])).collect()
+    lavg_page_hits = [x[0] for x in lplot_stats]
+    lavg_session_time = [x[1] for x in lplot_stats]
+    lnum_sessions = [x[2] for x in lplot_stats]
 
     x_label = 'Avg Session Time (Mins)'
     y_label = 'Avg Number of Page Hits'
@@ -612,5 +1912,12 @@ if __name__ == '__main__':
     title = 'Plot of User Engagement'
     plot3d(OUT_DIR + args.user_engagement_plot_file, lavg_session_time, lavg_page_hits, lnum_sessions, x_label, y_label, z_label, title)
 
+    stage_metrics.setRunInfo(dmetrics, 'session_window', session_window)
+    stage_metrics.setRunInfo(dmetrics, 'total_sessions', total_num_sessions)
+    stage_metrics.setRunInfo(dmetrics, 'session_time_quantiles', session_stats.getSummary(dduration_stats, lquantiles)[3])
+    stage_metrics.setRunInfo(dmetrics, 'malformed_lines', num_malformed)
+    if args.metrics_file is not None:
+        stage_metrics.writeReport(dmetrics, OUT_DIR + args.metrics_file, args.metrics_baseline, args.metrics_tolerance)
+
 
 
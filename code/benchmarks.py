@@ -0,0 +1,705 @@
+# PaytmLabs/WeblogChallenge
+#
+# Benchmarks for the web log processing in PaytmLabs_challenge.py.
+# Run by calling: python <working_dir_path>/code/benchmarks.py <optional params>
+#
+# A synthetic ELB log in the same format as the sample data is generated (if it does not already
+# exist) and used as input so that timings are repeatable across runs and machines.
+#
+# Parse benchmark: compares the throughput of the single pass ELB tokenizer used by getLines()
+# against the original regex + shlex + dateutil parser on the same lines, and checks that both
+# parsers produce the same (IP, timestamp, URL) for every line. Note the shlex parser keeps a
+# backslash in front of single quotes in URLs (an artifact of escaping them for shlex) which the
+# tokenizer does not, so real logs with such URLs will show a few differences.
+#
+# Engines benchmark: runs PaytmLabs_challenge.py with the RDD and the DataFrame engine on the sample
+# log with spark-submit for several local[N] core counts, and compares their output files.
+#
+# Local benchmark: runs PaytmLabs_challenge.py with the local engine and with the RDD engine on the
+# same input and reports startup to first result latency and peak RSS for each.
+#
+# Output benchmark: runs PaytmLabs_challenge.py with the RDD engine once with text output files and
+# once with Parquet output for each compression codec, and reports the size and write time of each
+# output.
+#
+# Stream benchmark: replays the sample log in timestamp order through the stream dir of the stream
+# engine as a number of segment files arriving at a fixed interval, then checks the sessions it
+# emitted agree with a batch sessionization of the same log and reports the latency from segment
+# arrival to session emission.
+#
+# Stage benchmark: generates a synthetic log for each of several sizes and runs PaytmLabs_challenge.py
+# with the RDD engine on each for several local[N] core counts, with --metrics_file set so each stage
+# (parse, sort, page durations, session window heuristic, sessionize, aggregates) is timed on its own.
+# The stage times of all runs are written to a JSON results file along with the generator args, and
+# a scaling plot shows the speedup of each stage with cores and its time against input size.
+# Skew check: checks the session window heuristic stats of hot IPs split into time ranges (--skew_mode
+# split). The visits of each IP of the sample log are split in two, with the first visit of the second
+# range keeping its duration since the last visit of the first range as getPageDurationsSkew() gives it,
+# and the stats of getSessionsURLHitsStream() over the two ranges are checked against the sessions
+# getSessionsStream() finds in each range for every session window, i.e. a session spanning the split
+# is seen as two and no empty session is counted.
+# The synthetic log can be skewed with a Zipf distribution of requests per IP (--zipf_s) and with
+# exponential or heavy tailed (pareto) times between requests (--arrival) to match real traffic.
+###########################################################################################################################
+
+
+import argparse
+import json
+import os
+import re
+import random
+import subprocess
+import sys
+import time
+from bisect import bisect_right
+from datetime import datetime, timedelta
+
+import matplotlib.pyplot as plt
+
+import PaytmLabs_challenge as plc
+from local_engine import LocalBroadcast
+
+
+# user agents and url paths used to build synthetic log lines
+SYNTH_USER_AGENTS = ['Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/43.0.2357.130 Safari/537.36',
+                     'Mozilla/5.0 (iPhone; CPU iPhone OS 8_3 like Mac OS X) AppleWebKit/600.1.4 (KHTML, like Gecko) Mobile/12F70',
+                     'Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)',
+                     '-']
+# output files of PaytmLabs_challenge.py compared between engines
+ENGINE_OUT_FILES = ['Sessionized_Customer_File.txt', 'Unique_URL_Visits_by_Session.txt',
+                    'Customer_Session_Duration.txt', 'User_Engagement_Stats.txt']
+# stages of the RDD engine (as named in its --metrics_file report) shown by the stage benchmark: parse
+# (getLines), per IP sort and page durations, session window heuristic (getSessionsURLHits), sessionize
+# (getSessions) and the engagement join
+BENCH_STAGES = ['parse', 'sort', 'durations', 'window_heuristic', 'sessionize', 'aggregate_engagement']
+STAGE_METRICS_FILE = 'Stage_Metrics.json'
+SYNTH_URL_PATHS = ['shop/authresponse', 'shop/wallet/txnhistory', 'shop/cart', 'shop/orderdetail/',
+                   'shop/p/', 'papi/v1/expresscart/verify', 'api/user/favourite', 'offer/']
+
+
+# ----------------------------------------------------------------------
+# Purpose: Build one line of a synthetic ELB web log.
+# Input: Random number generator, timestamp of the request, client IP
+#   and URL.
+# Output: A string in the ELB access log format (no newline).
+def makeElbLine(rnd, dt, ip, url):
+    return '%sZ marketpalce-shop %s:%d 10.0.6.%d:80 0.0000%d 0.0%d 0.0000%d 200 200 0 %d "GET %s HTTP/1.1" "%s" ' \
+           'ECDHE-RSA-AES128-GCM-SHA256 TLSv1.2' % (dt.strftime('%Y-%m-%dT%H:%M:%S.%f'), ip,
+                                                     rnd.randint(1024, 65535), rnd.randint(1, 254),
+                                                     rnd.randint(10, 99), rnd.randint(1000, 99999),
+                                                     rnd.randint(10, 99), rnd.randint(100, 9000), url,
+                                                     rnd.choice(SYNTH_USER_AGENTS))
+
+
+# ----------------------------------------------------------------------
+# Purpose: Get the time between two requests of the synthetic log.
+# Input: Random number generator, inter-arrival distribution (uniform,
+#   exponential or pareto) and mean time between requests in ms.
+# Output: Python timedelta
+def getInterArrival(rnd, arrival, arrival_mean_ms):
+
+    mean_us = int(arrival_mean_ms * 1000)
+    if arrival == 'exponential':
+        return timedelta(microseconds=int(rnd.expovariate(1.0 / mean_us)))
+    if arrival == 'pareto':
+        # heavy tailed gaps (mean of paretovariate(1.5) is 3), so there are idle periods that end sessions
+        return timedelta(microseconds=int(mean_us * rnd.paretovariate(1.5) / 3.0))
+    return timedelta(microseconds=rnd.randint(0, 2 * mean_us))
+
+
+# ----------------------------------------------------------------------
+# Purpose: Write a synthetic ELB web log of approximately the requested
+#   size. Requests arrive in time order from randomly chosen IPs with
+#   random URLs.
+# Input: File name to write, approximate size in MB, number of distinct
+#   IPs and URLs, the random seed, the Zipf exponent of the activity of
+#   the IPs (0 for all IPs equally active), and the inter-arrival
+#   distribution and mean of requests (see getInterArrival()).
+# Output: Number of lines written to the file.
+def writeSyntheticElbLog(filname, size_mb, num_ips, num_urls, seed, zipf_s=0.0, arrival='uniform', arrival_mean_ms=10.0):
+
+    rnd = random.Random(seed)
+    lips = ['%d.%d.%d.%d' % (rnd.randint(1, 223), rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(1, 254))
+            for _ in range(num_ips)]
+    lurls = ['https://paytm.com:443/%s%d' % (rnd.choice(SYNTH_URL_PATHS), k) for k in range(num_urls)]
+    # cumulative Zipf weights of the IPs, the k-th IP making requests in proportion to 1 / k^zipf_s
+    lcum_weights = []
+    total = 0.0
+    for k in range(num_ips):
+        total += 1.0 / (k + 1) ** zipf_s
+        lcum_weights.append(total)
+
+    max_bytes = size_mb * 1024 * 1024
+    num_bytes = 0
+    num_lines = 0
+    dt = datetime(2015, 7, 22, 9, 0, 0)
+    f = open(filname, 'w')
+    while num_bytes < max_bytes:
+        dt += getInterArrival(rnd, arrival, arrival_mean_ms)
+        if zipf_s > 0:
+            ip = lips[min(bisect_right(lcum_weights, rnd.random() * total), num_ips - 1)]
+        else:
+            ip = rnd.choice(lips)
+        lin = makeElbLine(rnd, dt, ip, rnd.choice(lurls)) + '\n'
+        f.write(lin)
+        num_bytes += len(lin)
+        num_lines += 1
+    f.close()
+    return num_lines
+
+
+# ----------------------------------------------------------------------
+# Purpose: Get a synthetic log generated with the benchmark args,
+#   generating it if it does not exist or was generated with other args.
+# Input: Parsed command line args, file name in the data dir and size in
+#   MB.
+# Output: Tuple of the full path of the log and a dict of the generator
+#   args and the number of lines (also saved next to the log as JSON).
+def getSyntheticElbLog(args, filname, size_mb):
+
+    synth_path = args.working_dir_path + 'data/' + filname
+    dgen = {'size_mb': size_mb, 'num_ips': args.num_ips, 'num_urls': args.num_urls, 'seed': args.seed,
+            'zipf_s': args.zipf_s, 'arrival': args.arrival, 'arrival_mean_ms': args.arrival_mean_ms}
+    if os.path.exists(synth_path) and os.path.exists(synth_path + '.json'):
+        f = open(synth_path + '.json', 'r')
+        dsaved = json.load(f)
+        f.close()
+        if dict((key, dsaved.get(key)) for key in dgen) == dgen:
+            return synth_path, dsaved
+
+    print 'Generating synthetic log of ' + str(size_mb) + ' MB: ' + synth_path
+    dgen['num_lines'] = writeSyntheticElbLog(synth_path, size_mb, args.num_ips, args.num_urls, args.seed,
+                                             args.zipf_s, args.arrival, args.arrival_mean_ms)
+    print 'Lines written: ' + str(dgen['num_lines'])
+    f = open(synth_path + '.json', 'w')
+    json.dump(dgen, f, indent=1, sort_keys=True)
+    f.close()
+    return synth_path, dgen
+
+
+# ----------------------------------------------------------------------
+# Purpose: Time a line parser over the lines of a file.
+# Input: File name to read, parser function taking (line, ip index,
+#   timestamp index, url index), and max number of lines to parse
+#   (all lines if None).
+# Output: A tuple of number of lines parsed, number of malformed lines,
+#   MB parsed and elapsed time in seconds.
+def benchParser(filname, parse_fn, max_lines):
+
+    num_lines = 0
+    num_malformed = 0
+    num_bytes = 0
+    f = open(filname, 'r')
+    t_start = time.time()
+    for lin in f:
+        if max_lines is not None and num_lines >= max_lines:
+            break
+        num_lines += 1
+        num_bytes += len(lin)
+        try:
+            parse_fn(lin.rstrip('\n'), plc.WEB_LOG_IP_IND, plc.WEB_LOG_TS_IND, plc.WEB_LOG_URL_IND)
+        except:
+            num_malformed += 1
+    elapsed = time.time() - t_start
+    f.close()
+    return num_lines, num_malformed, num_bytes / (1024.0 * 1024.0), elapsed
+
+
+# ----------------------------------------------------------------------
+# Purpose: Check that two line parsers return the same fields.
+# Input: File name to read, the two parser functions and the number
+#   of lines to compare.
+# Output: Number of lines where the parsers disagree (including one
+#   failing while the other succeeds).
+def compareParsers(filname, parse_fn_a, parse_fn_b, max_lines):
+
+    num_diffs = 0
+    f = open(filname, 'r')
+    for k, lin in enumerate(f):
+        if k >= max_lines:
+            break
+        lres = []
+        for parse_fn in [parse_fn_a, parse_fn_b]:
+            try:
+                lres.append(parse_fn(lin.rstrip('\n'), plc.WEB_LOG_IP_IND, plc.WEB_LOG_TS_IND, plc.WEB_LOG_URL_IND))
+            except:
+                lres.append(None)
+        if repr(lres[0]) != repr(lres[1]):
+            num_diffs += 1
+    f.close()
+    return num_diffs
+
+
+# ----------------------------------------------------------------------
+# Purpose: Run PaytmLabs_challenge.py with spark-submit and time it.
+# Input: Path of spark-submit, list of extra args for the script and
+#   the output dir to write to.
+# Output: Elapsed wall time in seconds. Raises CalledProcessError if the
+#   run fails.
+def timeChallengeRun(spark_submit, largs, out_dir):
+
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'PaytmLabs_challenge.py')
+    t_start = time.time()
+    subprocess.check_call([spark_submit, script, '--out_dir', out_dir] + largs)
+    return time.time() - t_start
+
+
+# ----------------------------------------------------------------------
+# Purpose: Compare an output file written by two runs.
+# Input: The two output dirs and the output file name.
+# Output: 'identical' if the files are byte for byte the same, 'same
+#   lines' if they hold the same lines in a different order (the order
+#   of unsorted outputs and of ties in sorted outputs depends on the
+#   engine's partitioning), and otherwise the number of lines that differ.
+def compareOutputFiles(out_dir_a, out_dir_b, filname):
+
+    lfiles = []
+    for out_dir in [out_dir_a, out_dir_b]:
+        f = open(os.path.join(out_dir, filname), 'r')
+        lfiles.append(f.read())
+        f.close()
+    if lfiles[0] == lfiles[1]:
+        return 'identical'
+    llines_a = sorted(lfiles[0].splitlines())
+    llines_b = sorted(lfiles[1].splitlines())
+    if llines_a == llines_b:
+        return 'same lines'
+    return str(len(set(llines_a) ^ set(llines_b))) + ' lines differ'
+
+
+# ----------------------------------------------------------------------
+# Purpose: Parse benchmark (see top of file).
+# Input: Parsed command line args and path of the synthetic log.
+# Output: None. Results are printed to std output.
+def runParseBenchmark(args, synth_path):
+
+    num_diffs = compareParsers(synth_path, plc.parseElbLine, plc.parseElbLineShlex, args.verify_lines)
+    print 'Lines where parsers disagree (first ' + str(args.verify_lines) + ' lines): ' + str(num_diffs)
+
+    for name, parse_fn in [('tokenizer', plc.parseElbLine), ('shlex', plc.parseElbLineShlex)]:
+        num_lines, num_malformed, mb, elapsed = benchParser(synth_path, parse_fn, args.max_lines)
+        print '%-10s lines: %d  malformed: %d  time (s): %.2f  lines/s: %.0f  MB/s: %.2f' % \
+              (name, num_lines, num_malformed, elapsed, num_lines / elapsed, mb / elapsed)
+
+
+# ----------------------------------------------------------------------
+# Purpose: Engine benchmark. Run the RDD and DataFrame engines of
+#   PaytmLabs_challenge.py on the same input for each number of local
+#   cores, and check the engines write the same output files.
+# Input: Parsed command line args.
+# Output: None. Results are printed to std output.
+def runEngineBenchmark(args):
+
+    for cores in args.cores.split(','):
+        dout_dirs = {}
+        for engine in ['rdd', 'dataframe']:
+            out_dir = os.path.join(args.working_dir_path, 'out', 'bench_' + engine + '_' + cores) + '/'
+            elapsed = timeChallengeRun(args.spark_submit, ['--infile', args.engine_infile,
+                                                           '--working_dir_path', args.working_dir_path,
+                                                           '--engine', engine, '--master', 'local[' + cores + ']'],
+                                       out_dir)
+            dout_dirs[engine] = out_dir
+            print '%-10s local[%s]  time (s): %.2f' % (engine, cores, elapsed)
+        for filname in ENGINE_OUT_FILES:
+            print '    ' + filname + ': ' + compareOutputFiles(dout_dirs['rdd'], dout_dirs['dataframe'], filname)
+
+
+# ----------------------------------------------------------------------
+# Purpose: Run a command and measure its latency to first result and
+#   peak memory. The command is run from a child Python process that
+#   reports the max RSS of its own children, so each measurement only
+#   covers that one run.
+# Input: Command as a list of args and the start of the std output line
+#   that marks the first result.
+# Output: Tuple of seconds until the marker line was printed (None if it
+#   never was), total elapsed seconds and peak RSS in MB of the largest
+#   process (ru_maxrss of the waited for descendants).
+def measureRun(lcmd, first_result_marker):
+
+    wrapper = 'import resource, subprocess, sys; rc = subprocess.call(sys.argv[1:]); ' \
+              'print "MAXRSS_KB", resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss; sys.exit(rc)'
+    env = dict(os.environ, PYTHONUNBUFFERED='1')
+    t_start = time.time()
+    proc = subprocess.Popen([sys.executable, '-c', wrapper] + lcmd, stdout=subprocess.PIPE, env=env)
+    first_result = None
+    max_rss_kb = 0
+    for lin in iter(proc.stdout.readline, ''):
+        if first_result is None and first_result_marker in lin:
+            first_result = time.time() - t_start
+        if lin.startswith('MAXRSS_KB'):
+            max_rss_kb = int(lin.split()[1])
+    if proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, lcmd)
+    return first_result, time.time() - t_start, max_rss_kb / 1024.0
+
+
+# ----------------------------------------------------------------------
+# Purpose: Local engine benchmark. Compare startup to first result
+#   latency and peak memory of the local engine and the Spark (RDD)
+#   engine on the same input, and check they write the same output files.
+# Input: Parsed command line args.
+# Output: None. Results are printed to std output.
+def runLocalBenchmark(args):
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'PaytmLabs_challenge.py')
+    dout_dirs = {}
+    for engine, lcmd in [('local', [sys.executable, script]), ('rdd', [args.spark_submit, script])]:
+        out_dir = os.path.join(args.working_dir_path, 'out', 'bench_' + engine) + '/'
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        first_result, elapsed, max_rss_mb = measureRun(lcmd + ['--infile', args.engine_infile,
+                                                               '--working_dir_path', args.working_dir_path,
+                                                               '--out_dir', out_dir, '--engine', engine],
+                                                       'Sum of All Session Times')
+        dout_dirs[engine] = out_dir
+        print '%-10s first result (s): %.2f  total time (s): %.2f  peak RSS (MB): %.1f' % \
+              (engine, first_result, elapsed, max_rss_mb)
+    for filname in ENGINE_OUT_FILES:
+        print '    ' + filname + ': ' + compareOutputFiles(dout_dirs['rdd'], dout_dirs['local'], filname)
+
+
+# ----------------------------------------------------------------------
+# Purpose: Get the size of an output file or dataset dir.
+# Input: Full path of the output file or dir.
+# Output: Size in MB of the file, or of all files under the dir.
+def getOutputSize(path):
+
+    if os.path.isfile(path):
+        return os.path.getsize(path) / (1024.0 * 1024.0)
+    total = 0
+    for dir_path, ldirs, lfiles in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(dir_path, filname)) for filname in lfiles)
+    return total / (1024.0 * 1024.0)
+
+
+# ----------------------------------------------------------------------
+# Purpose: Output benchmark (see top of file).
+# Input: Parsed command line args.
+# Output: None. Results are printed to std output.
+def runOutputBenchmark(args):
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'PaytmLabs_challenge.py')
+    wrote_pattern = re.compile(r'Wrote (\S+) in ([0-9.]+) secs')
+    lformats = [('text', [])] + [('parquet-' + codec, ['--output_format', 'parquet', '--output_compression', codec])
+                                 for codec in args.output_codecs.split(',')]
+    for name, lformat_args in lformats:
+        out_dir = os.path.join(args.working_dir_path, 'out', 'bench_output_' + name) + '/'
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        proc = subprocess.Popen([args.spark_submit, script, '--infile', args.engine_infile, '--working_dir_path',
+                                 args.working_dir_path, '--out_dir', out_dir, '--engine', 'rdd'] + lformat_args,
+                                stdout=subprocess.PIPE)
+        loutputs = []
+        for lin in iter(proc.stdout.readline, ''):
+            match = wrote_pattern.search(lin)
+            if match:
+                loutputs.append((match.group(1), float(match.group(2))))
+        if proc.wait() != 0:
+            raise subprocess.CalledProcessError(proc.returncode, name)
+        for path, write_secs in loutputs:
+            print '%-16s %-40s size (MB): %9.2f  write time (s): %.2f' % \
+                  (name, os.path.basename(path), getOutputSize(path), write_secs)
+
+
+# ----------------------------------------------------------------------
+# Purpose: Stage benchmark (see top of file).
+# Input: Parsed command line args.
+# Output: None. Results are printed to std output and written to the
+#   stage benchmark results file and scaling plot in the output dir.
+def runStageBenchmark(args):
+
+    bench_out_dir = os.path.join(args.working_dir_path, 'out') + '/'
+    base, ext = os.path.splitext(args.synth_file)
+    lruns = []
+    print '%-8s %-6s %9s' % ('size_mb', 'cores', 'total') + ''.join(' %16s' % stage for stage in BENCH_STAGES)
+    for size_mb in [int(size) for size in args.stage_sizes_mb.split(',')]:
+        synth_file = base + '_' + str(size_mb) + 'mb' + ext
+        synth_path, dgen = getSyntheticElbLog(args, synth_file, size_mb)
+        for cores in [int(num) for num in args.cores.split(',')]:
+            out_dir = os.path.join(bench_out_dir, 'bench_stages_' + str(size_mb) + '_' + str(cores)) + '/'
+            elapsed = timeChallengeRun(args.spark_submit, ['--infile', '/' + synth_file,
+                                                           '--working_dir_path', args.working_dir_path,
+                                                           '--engine', 'rdd', '--master', 'local[' + str(cores) + ']',
+                                                           '--metrics_file', STAGE_METRICS_FILE],
+                                       out_dir)
+            f = open(out_dir + STAGE_METRICS_FILE, 'r')
+            dmetrics = json.load(f)
+            f.close()
+            dstage_secs = dict((dstage['name'], dstage['secs']) for dstage in dmetrics['stages'])
+            lruns.append({'size_mb': size_mb, 'num_lines': dgen['num_lines'], 'cores': cores, 'total_secs': elapsed,
+                          'stage_secs': dstage_secs, 'stages': dmetrics['stages'], 'run': dmetrics['run']})
+            print '%-8d %-6d %9.2f' % (size_mb, cores, elapsed) + \
+                  ''.join(' %16.2f' % dstage_secs.get(stage, float('nan')) for stage in BENCH_STAGES)
+
+    dgen = dict(dgen)
+    del dgen['size_mb'], dgen['num_lines']
+    f = open(bench_out_dir + args.stage_results_file, 'w')
+    json.dump({'generator': dgen, 'stages': BENCH_STAGES, 'runs': lruns}, f, indent=1, sort_keys=True)
+    f.close()
+    print 'Results written to ' + bench_out_dir + args.stage_results_file
+    plotStageScaling(bench_out_dir + args.stage_plot_file, lruns)
+    print 'Scaling plot written to ' + bench_out_dir + args.stage_plot_file
+
+
+# ----------------------------------------------------------------------
+# Purpose: Plot how the stage times of the stage benchmark scale with
+#   the number of cores and the input size.
+# Input: Name of the pdf file to save and the list of run dicts of
+#   runStageBenchmark().
+# Output: None
+def plotStageScaling(pdf_file, lruns):
+
+    lsizes = sorted(set(drun['size_mb'] for drun in lruns))
+    lcores = sorted(set(drun['cores'] for drun in lruns))
+    fig, (ax_cores, ax_size) = plt.subplots(1, 2, figsize=(14, 6))
+
+    # speedup of each stage over the fewest cores, on the largest input
+    druns = dict((drun['cores'], drun) for drun in lruns if drun['size_mb'] == lsizes[-1])
+    for stage in BENCH_STAGES + ['total']:
+        lsecs = [druns[cores]['total_secs'] if stage == 'total' else druns[cores]['stage_secs'].get(stage)
+                 for cores in lcores]
+        if None in lsecs or min(lsecs) <= 0:
+            continue
+        ax_cores.plot(lcores, [lsecs[0] / secs for secs in lsecs], 'o-', label=stage)
+    ax_cores.plot(lcores, [cores / float(lcores[0]) for cores in lcores], 'k--', label='linear')
+    ax_cores.set_xlabel('local[N] Cores')
+    ax_cores.set_ylabel('Speedup over local[' + str(lcores[0]) + ']')
+    ax_cores.set_title('Stage Speedup for ' + str(lsizes[-1]) + ' MB Input')
+    ax_cores.legend(loc='upper left', fontsize='small')
+
+    # time of each stage against input size, on the most cores
+    druns = dict((drun['size_mb'], drun) for drun in lruns if drun['cores'] == lcores[-1])
+    for stage in BENCH_STAGES + ['total']:
+        lsecs = [druns[size_mb]['total_secs'] if stage == 'total' else druns[size_mb]['stage_secs'].get(stage)
+                 for size_mb in lsizes]
+        if None in lsecs:
+            continue
+        ax_size.plot(lsizes, lsecs, 'o-', label=stage)
+    ax_size.set_xlabel('Input Size (MB)')
+    ax_size.set_ylabel('Time (secs)')
+    ax_size.set_title('Stage Time by Input Size on local[' + str(lcores[-1]) + ']')
+    ax_size.legend(loc='upper left', fontsize='small')
+
+    plt.savefig(pdf_file, bbox_inches='tight')
+    plt.close(fig)
+
+
+# ----------------------------------------------------------------------
+# Purpose: Parse a web log and sort its page visits by timestamp.
+# Input: Full path of the web log file.
+# Output: List of ((IP, Python datetime), url) tuples, and the list of
+#   the lines of the web log in timestamp order (malformed lines last).
+def getTimeOrderedVisits(filname):
+
+    lvisits = []
+    lmalformed = []
+    f = open(filname, 'r')
+    for lin in f:
+        try:
+            cid, dt, url = plc.parseElbLine(lin, plc.WEB_LOG_IP_IND, plc.WEB_LOG_TS_IND, plc.WEB_LOG_URL_IND)
+        except:
+            lmalformed.append(lin)
+            continue
+        lvisits.append(((cid, dt), url, lin))
+    f.close()
+    lvisits.sort(key=lambda ((cid, dt), url, lin): dt)
+    return [(key, url) for key, url, lin in lvisits], [lin for key, url, lin in lvisits] + lmalformed
+
+
+# ----------------------------------------------------------------------
+# Purpose: Summarize the sessions of a batch sessionization for
+#   comparison with the finalized sessions of the stream engine.
+# Input: List of ((IP, Python datetime), url) tuples and the session
+#   window in mins.
+# Output: Sorted list of (IP, session duration, number of unique urls,
+#   number of page visits) tuples, with durations rounded to 6 places.
+def getBatchSessionSummary(lvisits, session_window):
+
+    plc.SESSION_WINDOW_BC = LocalBroadcast(session_window)
+    return sorted((cid, round(sum(dat[0]), 6), len(set(dat[1])), len(dat[0]))
+                  for cid, dat in plc.getSessionsStream(plc.getPageDurationsStream(iter(sorted(lvisits)))))
+
+
+# ----------------------------------------------------------------------
+# Purpose: Summarize the finalized sessions file written by the stream
+#   engine in the same format as getBatchSessionSummary().
+# Input: Full path of the finalized sessions file.
+# Output: Sorted list of (IP, session duration, number of unique urls,
+#   number of page visits) tuples.
+def getStreamSessionSummary(filname):
+
+    lsessions = []
+    f = open(filname, 'r')
+    for lin in f:
+        cid, dat = lin.split(' ', 1)
+        ldat = dat.strip('[]\n').split(', ')
+        lsessions.append((cid.decode('utf-8'), round(float(ldat[0]), 6), int(ldat[1]), int(ldat[2])))
+    f.close()
+    return sorted(lsessions)
+
+
+# ----------------------------------------------------------------------
+# Purpose: Count the sessions of a customer's page visits for every
+#   session window by number of unique urls, with getSessionsStream().
+# Input: List of page visits of a customer from getPageDurationsStream().
+#   The first visit always starts a session.
+# Output: List with the session stats of each window, in the format of
+#   getWindowURLHits().
+def getWindowSessionCounts(lrecs):
+
+    lrecs = [(lrecs[0][0], [lrecs[0][1][0], lrecs[0][1][1], 0])] + lrecs[1:]
+    lwindow_counts = []
+    for window in range(1, plc.SESSION_WINDOW_MAX):
+        plc.SESSION_WINDOW_BC = LocalBroadcast(window)
+        lcounts = [0] * 6
+        for cid, dat in plc.getSessionsStream(iter(lrecs)):
+            lcounts[min(len(set(dat[1])), 6) - 1] += 1
+        lwindow_counts.append(lcounts + [sum(lcounts)])
+    return lwindow_counts
+
+
+# ----------------------------------------------------------------------
+# Purpose: Skew check (see top of file).
+# Input: Parsed command line args.
+# Output: None. Results are printed to std output. Exits with status 1
+#   if any IP's stats differ.
+def runSkewCheck(args):
+
+    plc.SESSION_WINDOW_MAX_BC = LocalBroadcast(plc.SESSION_WINDOW_MAX)
+    lvisits, llines = getTimeOrderedVisits(args.working_dir_path + 'data/' + args.engine_infile)
+    dcust_recs = {}
+    for rec in plc.getPageDurationsStream(iter(sorted(lvisits))):
+        dcust_recs.setdefault(rec[0], []).append(rec)
+
+    num_checked = 0
+    lfailed = []
+    for cid in sorted(dcust_recs, key=lambda cid: -len(dcust_recs[cid]))[:args.skew_check_ips]:
+        lrecs = dcust_recs[cid]
+        if len(lrecs) < 2:
+            continue
+        mid = len(lrecs) / 2
+        # each time range is sessionized in a task of its own
+        lsplit = [list(plc.getSessionsURLHitsStream(iter(lrange)))[0][1] for lrange in [lrecs[:mid], lrecs[mid:]]]
+        lexpected = [getWindowSessionCounts(lrange) for lrange in [lrecs[:mid], lrecs[mid:]]]
+        num_checked += 1
+        if lsplit != lexpected:
+            lfailed.append(cid)
+
+    print '\nSkew check: ' + str(num_checked) + ' IPs split in two time ranges, ' + str(len(lfailed)) + ' with wrong window stats' + \
+          (': ' + ', '.join(lfailed[:10]) if lfailed else '')
+    if lfailed:
+        sys.exit(1)
+
+
+# ----------------------------------------------------------------------
+# Purpose: Stream benchmark (see top of file).
+# Input: Parsed command line args.
+# Output: None. Results are printed to std output.
+def runStreamBenchmark(args):
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'PaytmLabs_challenge.py')
+    stream_dir = os.path.join(args.working_dir_path, 'data', 'bench_stream') + '/'
+    out_dir = os.path.join(args.working_dir_path, 'out', 'bench_stream') + '/'
+    for dir_path in [stream_dir, out_dir]:
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+    for filname in os.listdir(stream_dir):
+        os.remove(stream_dir + filname)
+
+    lvisits, llines = getTimeOrderedVisits(args.working_dir_path + 'data/' + args.engine_infile)
+    timeout = args.stream_segments * args.stream_interval_secs + args.stream_drain_secs
+    proc = subprocess.Popen([args.spark_submit, script, '--engine', 'stream', '--working_dir_path', args.working_dir_path,
+                             '--stream_dir', stream_dir, '--out_dir', out_dir, '--session_period', str(args.session_period),
+                             '--stream_trigger_secs', str(args.stream_interval_secs),
+                             '--stream_timeout_secs', str(timeout)])
+
+    # files starting with _ are ignored by the stream source, so segments are renamed into place once written
+    seg_lines = len(llines) / args.stream_segments + 1
+    for seg in range(args.stream_segments):
+        time.sleep(args.stream_interval_secs)
+        seg_file = 'segment_%04d.log' % seg
+        f = open(stream_dir + '_' + seg_file, 'w')
+        f.writelines(llines[seg * seg_lines:(seg + 1) * seg_lines])
+        f.close()
+        os.rename(stream_dir + '_' + seg_file, stream_dir + seg_file)
+    if proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, 'stream engine')
+
+    lbatch = getBatchSessionSummary(lvisits, args.session_period)
+    lstream = getStreamSessionSummary(out_dir + 'Finalized_Sessions.txt')
+    print 'Sessions  batch: %d  stream: %d  differing: %d' % (len(lbatch), len(lstream), len(set(lbatch) ^ set(lstream)))
+
+    llatency = []
+    f = open(out_dir + 'Stream_Latency.txt', 'r')
+    for lin in f:
+        ldat = lin.split(' ', 1)[1].strip('[]\n').split(', ')
+        if ldat[3] != 'None':
+            llatency.append(float(ldat[3]))
+    f.close()
+    if llatency:
+        llatency.sort()
+        print 'Segment arrival to session emission latency (s)  median: %.2f  max: %.2f' % \
+              (llatency[len(llatency) / 2], llatency[-1])
+
+
+#------------------------------------------------------------------------
+
+
+if __name__ == '__main__':
+
+    # e.g. run as "python benchmarks.py --working_dir_path '/home/jphilip/PyCharms/Projects/Proj1/' --size_mb 4096"
+    #        or as "python benchmarks.py --benchmarks engines --cores 2,6 --spark_submit /opt/spark/bin/spark-submit"
+
+    parser = argparse.ArgumentParser(description='Benchmark web log processing on a synthetic ELB log.')
+    parser.add_argument('--benchmarks', default='parse', dest='benchmarks', type=str, help='Comma separated list of benchmarks to run: parse, engines, local, output, stream, stages, skew.')
+    parser.add_argument('--working_dir_path', default='/home/jphilip/PyCharms/Projects/Proj1/', dest='working_dir_path', type=str, help='Full path to the dir where data, code and output reside')
+    parser.add_argument('--synth_file', default='synthetic_elb.log', dest='synth_file', type=str, help='Name of synthetic log file in data dir. Generated if it does not exist.')
+    parser.add_argument('--size_mb', default=2048, dest='size_mb', type=int, help='Approximate size in MB of the synthetic log to generate.')
+    parser.add_argument('--num_ips', default=90000, dest='num_ips', type=int, help='Number of distinct client IPs in the synthetic log.')
+    parser.add_argument('--num_urls', default=50000, dest='num_urls', type=int, help='Number of distinct URLs in the synthetic log.')
+    parser.add_argument('--seed', default=42, dest='seed', type=int, help='Random seed for the synthetic log.')
+    parser.add_argument('--zipf_s', default=0.0, dest='zipf_s', type=float, help='Zipf exponent of the number of requests per IP in the synthetic log (e.g. 1.1 for a few very active IPs). 0 makes all IPs equally active.')
+    parser.add_argument('--arrival', default='uniform', dest='arrival', type=str, choices=['uniform', 'exponential', 'pareto'], help='Distribution of the time between requests in the synthetic log. pareto gives heavy tailed gaps, i.e. bursts of requests with idle periods in between.')
+    parser.add_argument('--arrival_mean_ms', default=10.0, dest='arrival_mean_ms', type=float, help='Mean time in ms between requests in the synthetic log.')
+    parser.add_argument('--max_lines', default=None, dest='max_lines', type=int, help='Max number of lines to parse per parser (all lines if not set).')
+    parser.add_argument('--spark_submit', default='spark-submit', dest='spark_submit', type=str, help='Path to spark-submit used to run the engines benchmark.')
+    parser.add_argument('--engine_infile', default='/2015_07_22_mktplace_shop_web_log_sample.log', dest='engine_infile', type=str, help='Web log input file in data dir for the engines benchmark.')
+    parser.add_argument('--cores', default='1,2,4,6', dest='cores', type=str, help='Comma separated list of local[N] core counts for the engines and stage benchmarks.')
+    parser.add_argument('--stage_sizes_mb', default='64,256,1024', dest='stage_sizes_mb', type=str, help='Comma separated list of synthetic log sizes in MB for the stage benchmark. Uses the cores option for the local[N] core counts.')
+    parser.add_argument('--stage_results_file', default='Stage_Benchmark.json', dest='stage_results_file', type=str, help='File in the output dir to write the stage benchmark results to as JSON.')
+    parser.add_argument('--stage_plot_file', default='Stage_Benchmark_Scaling.pdf', dest='stage_plot_file', type=str, help='File in the output dir to save the stage benchmark scaling plot to.')
+    parser.add_argument('--output_codecs', default='snappy,gzip', dest='output_codecs', type=str, help='Comma separated list of Parquet compression codecs for the output benchmark.')
+    parser.add_argument('--session_period', default=15, dest='session_period', type=int, help='Session period in Minutes for the stream benchmark.')
+    parser.add_argument('--stream_segments', default=20, dest='stream_segments', type=int, help='Number of segment files the log is replayed as in the stream benchmark.')
+    parser.add_argument('--stream_interval_secs', default=5, dest='stream_interval_secs', type=int, help='Secs between segment files arriving in the stream benchmark.')
+    parser.add_argument('--stream_drain_secs', default=60, dest='stream_drain_secs', type=int, help='Secs the stream engine keeps running after the last segment arrives in the stream benchmark.')
+    parser.add_argument('--skew_check_ips', default=200, dest='skew_check_ips', type=int, help='Number of IPs (those with the most page visits) to check in the skew check.')
+    parser.add_argument('--verify_lines', default=100000, dest='verify_lines', type=int, help='Number of lines to check for identical output between parsers.')
+
+    args = parser.parse_args()
+
+    lbenchmarks = args.benchmarks.split(',')
+
+    if 'parse' in lbenchmarks:
+        synth_path, dgen = getSyntheticElbLog(args, args.synth_file, args.size_mb)
+        runParseBenchmark(args, synth_path)
+
+    if 'engines' in lbenchmarks:
+        runEngineBenchmark(args)
+
+    if 'local' in lbenchmarks:
+        runLocalBenchmark(args)
+
+    if 'output' in lbenchmarks:
+        runOutputBenchmark(args)
+
+    if 'stream' in lbenchmarks:
+        runStreamBenchmark(args)
+
+    if 'stages' in lbenchmarks:
+        runStageBenchmark(args)
+
+    if 'skew' in lbenchmarks:
+        runSkewCheck(args)
@@ -0,0 +1,327 @@
+# PaytmLabs/WeblogChallenge
+#
+# Spark DataFrame engine for the web log sessionization in PaytmLabs_challenge.py.
+# Selected by calling: bin/spark-submit <working_dir_path>/code/PaytmLabs_challenge.py --engine dataframe <optional params>
+#
+# The RDD engine runs every step as a Python lambda, so every record is pickled between the JVM and
+# the Python workers. This engine expresses the same steps as DataFrame operations that stay in the
+# JVM:
+# 1) Parse the IP, timestamp and URL from each line with a regular expression. Timestamps not in the
+#    fixed ELB format fall back to Spark's ISO-8601 timestamp cast, as the RDD engine falls back to
+#    dateutil, so they are not counted as malformed.
+# 2) Calculate the duration since the previous page visit of the customer with lag() over a window
+#    partitioned by IP and ordered by timestamp.
+# 3) Mark the page visits that start a session and number the sessions with a cumulative sum over
+#    the same window.
+# 4) Aggregate each session (session time, unique URLs) and each customer (engagement stats).
+# Only the final (much smaller) results are brought back to Python, on the executors, to be written to
+# the output files in the same format as the RDD engine.
+###########################################################################################################################
+
+
+from datetime import timedelta
+
+from pyspark.sql import SparkSession, Window
+import pyspark.sql.functions as F
+
+import numpy as np
+
+import PaytmLabs_challenge as plc
+import window_select
+
+
+# regex for the ELB fields used (see WEB_LOG_TS_IND, WEB_LOG_IP_IND and WEB_LOG_URL_IND): group 1 is the
+# timestamp, group 2 the client IP (with the port stripped) and group 3 the quoted request. As with the
+# tokenizer in splitElbLine() the request runs up to the first quote followed by a space.
+ELB_LINE_PATTERN = r'^(\S+) +\S+ +([^ :]+)\S* +(?:\S+ +){8}"(.*?)"(?: |$)'
+
+
+# ----------------------------------------------------------------------
+# Purpose: Parse the customer IP, timestamp and URL from each line of
+#   the input file. Timestamps are converted to microseconds since the
+#   epoch (UTC). As in parseElbTimestamp(), the fixed ELB format (e.g.
+#   2015-07-22T09:00:28.019143Z) is parsed directly and any other ISO-8601
+#   form (e.g. without fractional secs or with a +hh:mm offset) falls back
+#   to a timestamp cast, which reads timestamps without a zone as UTC (the
+#   session time zone) like getEpochMicros() does.
+# Input: SparkSession and full path of the web log input file.
+# Output: A tuple of a DataFrame with columns cid, ts_us and url for the
+#   lines that were parsed, and the number of malformed lines.
+def getEventsDF(spark, filname):
+
+    lines_df = spark.read.text(filname)
+    ts_str = F.regexp_extract('value', ELB_LINE_PATTERN, 1)
+    ts_us = F.when((F.length(ts_str) == 27) & (ts_str.substr(27, 1) == 'Z'),
+                   F.unix_timestamp(ts_str.substr(1, 19), "yyyy-MM-dd'T'HH:mm:ss") * plc.US_PER_SEC
+                   + ts_str.substr(21, 6).cast('long'))
+    # the cast timestamp is exact to the microsecond, so rounding undoes the float error of the secs
+    ts_us = F.coalesce(ts_us, F.round(F.to_timestamp(ts_str).cast('double') * plc.US_PER_SEC).cast('long'))
+    parsed_df = lines_df.select(F.regexp_extract('value', ELB_LINE_PATTERN, 2).alias('cid'),
+                                ts_us.alias('ts_us'),
+                                F.regexp_extract('value', ELB_LINE_PATTERN, 3).alias('url'))
+    parsed_df = parsed_df.withColumn('valid', (F.col('cid') != '') & F.col('ts_us').isNotNull())
+    parsed_df.persist()
+
+    num_malformed = parsed_df.filter(~F.col('valid')).count()
+    return parsed_df.filter(F.col('valid')).drop('valid'), num_malformed
+
+
+# ----------------------------------------------------------------------
+# Purpose: Determine the duration between page visits for each customer
+#   (DataFrame version of getPageDurations()).
+# Input: DataFrame of page visits from getEventsDF()
+# Output: DataFrame with columns cid, ts_us, url, first (true for the
+#   first page visit of a customer) and dur (duration in mins since the
+#   customer's previous page visit, 0 for the first visit). The duration
+#   is calculated with the same floating point operations as
+#   timedelta.total_seconds() / 60.0 so results match the RDD engine.
+def getDurationsDF(events_df):
+
+    cust_win = Window.partitionBy('cid').orderBy('ts_us')
+    prev_ts_us = F.lag('ts_us').over(cust_win)
+    return events_df.withColumn('first', prev_ts_us.isNull()) \
+                    .withColumn('dur', F.when(prev_ts_us.isNull(), F.lit(0.0))
+                                        .otherwise((F.col('ts_us') - prev_ts_us).cast('double') / float(plc.US_PER_SEC) / 60.0))
+
+
+# ----------------------------------------------------------------------
+# Purpose: Number each customer's sessions for a session window. A page
+#   visit starts a new session if it is the customer's first or if the
+#   duration since the previous visit is not less than the window.
+# Input: DataFrame from getDurationsDF(), the list of columns that
+#   identify a customer (and window), and the session window column or
+#   value in mins.
+# Output: The DataFrame with an extra column session_id numbering the
+#   sessions of each customer from 1 in timestamp order, and the
+#   duration of the first page of each session set to 0.
+def getSessionIdsDF(dur_df, lpartition_cols, session_window):
+
+    sess_win = Window.partitionBy(*lpartition_cols).orderBy('ts_us') \
+                     .rowsBetween(Window.unboundedPreceding, Window.currentRow)
+    is_start = F.col('first') | (F.col('dur') >= session_window)
+    return dur_df.withColumn('session_id', F.sum(is_start.cast('int')).over(sess_win)) \
+                 .withColumn('dur', F.when(is_start, F.lit(0.0)).otherwise(F.col('dur')))
+
+
+# ----------------------------------------------------------------------
+# Purpose: DataFrame version of getSessionsURLHits() summed over all
+#   customers. Every page visit is paired with every session window and
+#   sessions are numbered for all windows at once.
+# Input: DataFrame from getDurationsDF() and the max session window.
+# Output: A list of lists with the outer list representing window sizes
+#   1 to max_window - 1 and the inner list holding the number of sessions
+#   with 1, 2, 3, 4, 5 and 6+ unique URLs, and the total number of
+#   sessions (same as the reduced output of getSessionsURLHits()).
+def getSessionWindowStatsDF(spark, dur_df, max_window):
+
+    windows_df = spark.range(1, max_window).select(F.col('id').alias('period'))
+    win_df = getSessionIdsDF(dur_df.crossJoin(F.broadcast(windows_df)), ['cid', 'period'], F.col('period'))
+    sess_df = win_df.groupBy('cid', 'period', 'session_id').agg(F.countDistinct('url').alias('num_urls'))
+    lrows = sess_df.groupBy('period', F.least('num_urls', F.lit(6)).alias('bucket')).count().collect()
+
+    lsess_window_stats = [[0] * 7 for _ in range(max_window - 1)]
+    for row in lrows:
+        lsess_window_stats[row['period'] - 1][row['bucket'] - 1] += row['count']
+        lsess_window_stats[row['period'] - 1][6] += row['count']
+    return lsess_window_stats
+
+
+# ----------------------------------------------------------------------
+# Purpose: DataFrame version of the gap stats of getGapHistograms() and
+#   getGapStats(). Gaps are binned by the window grid step in the JVM and
+#   only the counts of each (cohort, bin) are collected.
+# Input: DataFrame from getDurationsDF() and the window grid.
+# Output: Dict of cohort to a list of the number of customers and the gap
+#   histogram of the cohort.
+def getGapStatsDF(dur_df, lwindows):
+
+    num_windows = len(lwindows)
+    num_visits = F.count('*').over(Window.partitionBy('cid'))
+    cohort = F.lit(0)
+    for k, min_visits in enumerate(window_select.COHORT_MIN_VISITS[1:]):
+        cohort = F.when(num_visits >= min_visits, F.lit(k + 1)).otherwise(cohort)
+    gap_bin = F.least(F.floor(F.col('dur') / float(lwindows[0])), F.lit(num_windows))
+    lrows = dur_df.withColumn('cohort', cohort) \
+                  .groupBy('cohort', F.when(F.col('first'), F.lit(-1)).otherwise(gap_bin).alias('bin')).count().collect()
+
+    dgap_stats = {}
+    for row in lrows:
+        if row['cohort'] not in dgap_stats:
+            dgap_stats[row['cohort']] = [0, np.zeros(num_windows + 1, dtype=np.int64)]
+        if row['bin'] == -1:
+            dgap_stats[row['cohort']][0] += row['count']
+        else:
+            dgap_stats[row['cohort']][1][int(row['bin'])] += row['count']
+    return dgap_stats
+
+
+# ----------------------------------------------------------------------
+# Purpose: Collect each customer's page visits into sessions and
+#   aggregate each session.
+# Input: DataFrame from getDurationsDF() and the session window in mins.
+# Output: DataFrame with one row per session and columns cid, session_id,
+#   visits (array of (ts_us, dur, url, first) structs in timestamp order),
+#   num_visits, num_urls (unique URLs) and session_time (sum of the
+#   durations in timestamp order, as sum() does in getSessionTime()).
+def getSessionsDF(dur_df, session_window):
+
+    sess_df = getSessionIdsDF(dur_df, ['cid'], F.lit(session_window)) \
+                .groupBy('cid', 'session_id') \
+                .agg(F.sort_array(F.collect_list(F.struct('ts_us', 'dur', 'url', 'first'))).alias('visits'),
+                     F.count('*').alias('num_visits'),
+                     F.countDistinct('url').alias('num_urls'))
+    return sess_df.withColumn('session_time', F.expr('aggregate(visits.dur, cast(0 as double), (acc, x) -> acc + x)'))
+
+
+# ----------------------------------------------------------------------
+# Purpose: Aggregate the sessions of each customer into the engagement
+#   stats (DataFrame version of the reduce and join in the RDD engine).
+# Input: DataFrame from getSessionsDF()
+# Output: DataFrame with one row per customer and columns cid,
+#   total_hits, total_time, avg_hits, avg_time, num_sessions and
+#   max_visits (most page visits in a session of the customer).
+def getEngagementDF(sess_df):
+
+    return sess_df.groupBy('cid') \
+                  .agg(F.sum('num_urls').alias('total_hits'),
+                       F.sum('session_time').alias('total_time'),
+                       F.count('*').alias('num_sessions'),
+                       F.max('num_visits').alias('max_visits')) \
+                  .withColumn('avg_hits', F.col('total_hits') / F.col('num_sessions')) \
+                  .withColumn('avg_time', F.col('total_time') / F.col('num_sessions'))
+
+
+# ----------------------------------------------------------------------
+# Purpose: Match the Python type of a sum of session durations in the
+#   RDD engine. A session with a single page visit has a duration of int
+#   0 so a sum is only a float if one of its sessions had more than one
+#   page visit. This keeps the output files the same for both engines.
+# Input: Sum of session durations and the most page visits in any of the
+#   sessions summed.
+# Output: The sum as an int or float.
+def getSessionTimeValue(total_time, max_visits):
+
+    if max_visits > 1:
+        return total_time
+    return int(total_time)
+
+
+# ----------------------------------------------------------------------
+# Purpose: Convert a session row to the same (IP, [durations, urls,
+#   timestamps]) tuple as getSessions(). As in getPageDurations() the
+#   timestamp of every page visit except the customer's first is wrapped
+#   in a list.
+# Input: A row of getSessionsDF()
+# Output: A tuple in the format of getSessions() output.
+def getSessionTuple(row):
+
+    ldurs = [0] + [v['dur'] for v in row['visits'][1:]]
+    lurls = [v['url'] for v in row['visits']]
+    lts = []
+    for v in row['visits']:
+        dt = plc.EPOCH + timedelta(microseconds=v['ts_us'])
+        lts.append(dt if v['first'] else [dt])
+    return (row['cid'], [ldurs, lurls, lts])
+
+
+# ----------------------------------------------------------------------
+# Purpose: Convert an engagement row to the same (IP, total time) tuple
+#   as the total customer session durations of the RDD engine.
+# Input: A row of getEngagementDF()
+# Output: Tuple of IP and total session time (mins).
+def getTotalTimeTuple(row):
+    return (row['cid'], getSessionTimeValue(row['total_time'], row['max_visits']))
+
+
+# ----------------------------------------------------------------------
+# Purpose: Convert an engagement row to the same fields and Python types
+#   as the engagement stats of the RDD engine: total page hits (int),
+#   total time, avg page hits, avg time and number of sessions (float).
+# Input: A row of getEngagementDF()
+# Output: Tuple of IP and list of engagement stats.
+def getEngagementTuple(row):
+
+    total_time = getSessionTimeValue(row['total_time'], row['max_visits'])
+    num_sessions = float(row['num_sessions'])
+    return (row['cid'], [int(row['total_hits']), total_time, int(row['total_hits']) / num_sessions,
+                         total_time / num_sessions, num_sessions])
+
+
+# ----------------------------------------------------------------------
+# Purpose: Run the sessionization and write the same output files and
+#   stats as the RDD engine.
+# Input: SparkContext, parsed command line args, data and output dirs.
+# Output: None. Output files are written to the output dir and stats
+#   printed to std output.
+def runDataFrameEngine(sc, args, data_dir, out_dir):
+
+    sc.addPyFile(plc.__file__.replace('.pyc', '.py'))
+    sc.addPyFile(__file__.replace('.pyc', '.py'))
+
+    spark = SparkSession(sc)
+    spark.conf.set('spark.sql.session.timeZone', 'UTC')
+
+    plc.log.info('Parsing IP, date and URL from Input...')
+    events_df, num_malformed = getEventsDF(spark, data_dir + args.infile)
+    plc.log.info('Calculating times between page visits for each customer...')
+    dur_df = getDurationsDF(events_df)
+    dur_df.persist()
+
+    session_window = args.session_period
+    if args.bCalculate_session_window:
+        plc.log.info('Calculating heuristic to determine optimal session window.')
+        stats_kind, lwindows = window_select.getHeuristicWindows(args)
+        if stats_kind == 'url_hits':
+            window_stats = getSessionWindowStatsDF(spark, dur_df, plc.SESSION_WINDOW_MAX)
+        else:
+            window_stats = getGapStatsDF(dur_df, lwindows)
+        opt_window = window_select.selectSessionWindow(args, out_dir, stats_kind, lwindows, window_stats)
+        if opt_window is not None:
+            session_window = opt_window
+
+    plc.log.info('Sessionizing the data based on session period...')
+    sess_df = getSessionsDF(dur_df, session_window)
+    sess_df.persist()
+    plc.outputFile(out_dir + args.sessionized_cust_file, sess_df.rdd.map(getSessionTuple), args, 'sessions')
+
+    plc.log.info('Calculating full duration of each session...')
+    tot_row = sess_df.agg(F.sum('session_time').alias('sum_time'), F.count('*').alias('num_sessions'),
+                          F.max('num_visits').alias('max_visits')).collect()[0]
+    sum_session_time = getSessionTimeValue(tot_row['sum_time'], tot_row['max_visits'])
+    total_num_sessions = tot_row['num_sessions']
+
+    print '\n\nSum of All Session Times (mins): ', str(sum_session_time)
+    print 'Total Number of Sessions: ', str(total_num_sessions)
+    print 'Avg Session Time (mins): ', str(sum_session_time / (0.0 + total_num_sessions)), '\n'
+    print 'Malformed Lines Skipped: ', str(num_malformed), '\n'
+
+    plc.log.info('Calculating number of page hits for each user session...')
+    url_visits_df = sess_df.select('cid', 'num_urls').orderBy(F.desc('num_urls'))
+    if args.rankings == 'topk':
+        # a limit after the sort is planned as a per partition top K (TakeOrderedAndProject)
+        url_visits_df = url_visits_df.limit(args.top_k)
+    plc.outputFile(out_dir + args.unique_url_visits_file,
+                   url_visits_df.rdd.map(lambda row: (row['cid'], int(row['num_urls']))), args, 'url_visits')
+    print 'Top 15 sessions by unique URL visits: ' + str([(row['cid'], int(row['num_urls'])) for row in url_visits_df.take(15)])
+
+    plc.log.info('Calculating total duration and engagement stats for each user across sessions...')
+    eng_df = getEngagementDF(sess_df)
+    eng_df.persist()
+    total_time_df = eng_df.orderBy(F.desc('total_time'))
+    if args.rankings == 'topk':
+        total_time_df = total_time_df.limit(args.top_k)
+    plc.outputFile(out_dir + args.cust_session_duration_file, total_time_df.rdd.map(getTotalTimeTuple), args, 'durations')
+
+    topIPs = map(getTotalTimeTuple, total_time_df.take(15))
+    print '\n\nTop 15 Most Engaged users by total duration from all their sessions (mins): ' + str(topIPs)
+
+    eng_stats_RDD = eng_df.rdd.map(getEngagementTuple)
+    eng_stats_RDD.persist()
+    plc.outputFile(out_dir + args.user_engagement_stats_file, eng_stats_RDD, args, 'engagement')
+
+    lplot_stats = eng_stats_RDD.map(lambda (cid, dat): (dat[2], dat[3], dat[4])).collect()
+    lavg_page_hits = [x[0] for x in lplot_stats]
+    lavg_session_time = [x[1] for x in lplot_stats]
+    lnum_sessions = [x[2] for x in lplot_stats]
+    plc.plot3d(out_dir + args.user_engagement_plot_file, lavg_session_time, lavg_page_hits, lnum_sessions,
+               'Avg Session Time (Mins)', 'Avg Number of Page Hits', 'Number of Sessions', 'Plot of User Engagement')
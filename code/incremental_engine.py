@@ -0,0 +1,379 @@
+# PaytmLabs/WeblogChallenge
+#
+# Incremental sessionization for PaytmLabs_challenge.py.
+# Selected by calling: bin/spark-submit <working_dir_path>/code/PaytmLabs_challenge.py --engine incremental \
+#                          --infile '<glob of log segments in data dir>' --state_dir <dir> <optional params>
+#
+# The other engines re-read the whole log and recompute every session on each run. This engine only
+# reads the log segments that were not processed by a previous run, and carries the open session of
+# each customer over between runs in a state store:
+# 1) New segments (files matching the --infile glob that are not in the state manifest) are parsed and
+#    sorted by (IP, timestamp) together with the open sessions from the state store.
+# 2) Each customer's page visits extend its open session or close it and start a new one when the
+#    time since the last visit is not less than the session period. At the end of a run, open sessions
+#    whose last visit is at least a session period before the latest timestamp seen (the watermark)
+#    are closed too, since any later visit will start a new session.
+# 3) Only closed (final) sessions are emitted. They are appended to the finalized sessions output file
+#    and added as deltas to the per customer engagement totals and the overall session totals in the
+#    state store. The customer duration and engagement output files are rewritten from the totals.
+# Segments are expected to arrive in time order. A page visit older than the previous watermark is
+# counted as late and dropped, and one inside or before its customer's open session is added to it (see
+# getIncrementalSessions()).
+#
+# The state store is a dir holding a JSON manifest and pickled RDDs of the open sessions and the
+# engagement totals. Each run writes new RDD dirs and then replaces the manifest, so an interrupted run
+# leaves the previous state intact. The manifest also holds the size of the finalized sessions file,
+# which a run truncates back to before appending, so sessions appended by an interrupted run are not
+# appended a second time when its segments are processed again.
+###########################################################################################################################
+
+
+import glob
+import json
+import os
+import shutil
+from datetime import timedelta
+
+from pyspark.rdd import portable_hash
+
+import PaytmLabs_challenge as plc
+
+
+# name of the manifest file in the state dir
+STATE_MANIFEST = 'manifest.json'
+
+# sort key timestamp of open session records so they come before a customer's new page visits
+STATE_SORT_TS = plc.EPOCH
+
+# record kinds in the sorted stream of getIncrementalSessions() and its output tags
+REC_STATE = 0
+REC_VISIT = 1
+TAG_CLOSED = 'closed'
+TAG_OPEN = 'open'
+TAG_LATE = 'late'
+
+
+# ----------------------------------------------------------------------
+# Purpose: Load the manifest of the state store.
+# Input: State dir
+# Output: Dict with the list of processed segment files, the dirs of the
+#   open sessions and engagement totals RDDs (None on the first run), the
+#   overall session totals and the watermark (epoch microseconds).
+def loadManifest(state_dir):
+
+    manifest_file = os.path.join(state_dir, STATE_MANIFEST)
+    if not os.path.exists(manifest_file):
+        return {'processed': [], 'open_dir': None, 'totals_dir': None, 'run': 0,
+                'sum_session_time': 0, 'total_sessions': 0, 'late_visits': 0, 'watermark_us': None,
+                'finalized_bytes': 0}
+    f = open(manifest_file, 'r')
+    manifest = json.load(f)
+    f.close()
+    return manifest
+
+
+# ----------------------------------------------------------------------
+# Purpose: Drop the finalized sessions appended by an interrupted run,
+#   i.e. after the size recorded in the manifest.
+# Input: Full path of the finalized sessions file and its size in bytes
+#   as of the last completed run (None for a state store written before
+#   the size was recorded, which is left as is).
+# Output: None
+def truncateFinalized(filname, num_bytes):
+
+    if num_bytes is None or not os.path.exists(filname) or os.path.getsize(filname) <= num_bytes:
+        return
+    plc.log.info('Dropping finalized sessions of an interrupted run from ' + filname)
+    f = open(filname, 'r+b')
+    f.truncate(num_bytes)
+    f.close()
+
+
+# ----------------------------------------------------------------------
+# Purpose: Replace the manifest of the state store.
+# Input: State dir and manifest dict.
+# Output: None
+def saveManifest(state_dir, manifest):
+
+    manifest_file = os.path.join(state_dir, STATE_MANIFEST)
+    f = open(manifest_file + '.tmp', 'w')
+    json.dump(manifest, f, indent=1)
+    f.close()
+    os.rename(manifest_file + '.tmp', manifest_file)
+
+
+# ----------------------------------------------------------------------
+# Purpose: Parse a line of a log segment into a page visit record for
+#   getIncrementalSessions(). Same as parseLine() but without its
+#   broadcast vars, which are only set up by the RDD engine.
+# Input: Line of web log input file.
+# Output: A tuple of (IP, Python datetime, REC_VISIT) as key and the
+#   string URL as value, or None if the line is malformed (see
+#   getValidLines()).
+def getVisit(lin):
+
+    try:
+        cid, dt, url = plc.parseElbLine(lin, plc.WEB_LOG_IP_IND, plc.WEB_LOG_TS_IND, plc.WEB_LOG_URL_IND)
+    except:
+        return None
+    return ((cid, dt, REC_VISIT), url)
+
+
+# ----------------------------------------------------------------------
+# Purpose: Start a new session from a page visit.
+# Input: Python datetime and url of the page visit.
+# Output: Open session state as a list of session start, last page
+#   visit timestamp, running session duration (mins), set of urls and
+#   number of page visits.
+def newSessionState(dt, url):
+    return [dt, dt, 0, set([url]), 1]
+
+
+# ----------------------------------------------------------------------
+# Purpose: Summarize a closed session.
+# Input: Open session state from newSessionState()
+# Output: List of session duration (mins), number of unique urls, number
+#   of page visits, and session start and end timestamps.
+def getClosedSession(state):
+    return [state[2], len(state[3]), state[4], state[0], state[1]]
+
+
+# ----------------------------------------------------------------------
+# Purpose: Add the page visits that came in before a customer's open
+#   session to it, the way a batch run would have sessionized them.
+# Input: Customer IP, open session state, state of the session built
+#   from the earlier page visits (None if there were none) and the session
+#   window in mins.
+# Output: List of (tag, IP, value) tuples (see getIncrementalSessions())
+#   closing the earlier session if it is a session period or more before
+#   the open session, otherwise empty with the open session extended
+#   back to the start of the earlier one in place.
+def mergeEarlySession(cid, state, early, session_window):
+
+    if early is None:
+        return []
+    gap = (state[0] - early[1]).total_seconds() / 60.0
+    if gap >= session_window:
+        return [(TAG_CLOSED, cid, getClosedSession(early))]
+    state[0] = early[0]
+    state[2] += early[2] + gap
+    state[3] |= early[3]
+    state[4] += early[4]
+    return []
+
+
+# ----------------------------------------------------------------------
+# Purpose: Sessionize the new page visits of each customer starting from
+#   their open session in the state store.
+# Input: Iterator over a partition sorted by (IP, timestamp, record kind)
+#   holding the open session records (REC_STATE) and new page visits
+#   (REC_VISIT) of each customer, the session window in mins, the
+#   watermark (latest timestamp seen) and the watermark of the previous
+#   run or micro-batch (None if there is none) as Python datetimes.
+# Output: Iterator of tuples of (tag, IP, value). Closed sessions are
+#   tagged TAG_CLOSED with a value from getClosedSession(), the open
+#   session of a customer at the end of the partition is tagged TAG_OPEN
+#   with its state, and page visits older than the previous watermark
+#   are dropped as late and tagged TAG_LATE. Page visits before the open
+#   session but not older than the previous watermark are sessionized on
+#   their own and merged into it (see mergeEarlySession()).
+def getIncrementalSessions(it, session_window, watermark, prev_watermark):
+
+    cid_cur = None
+    state = None
+    early = None
+    for (cid, dt, kind), val in it:
+        if cid != cid_cur:
+            if state is not None:
+                for rec in mergeEarlySession(cid_cur, state, early, session_window) + \
+                           closeIdleSession(cid_cur, state, session_window, watermark):
+                    yield rec
+            cid_cur = cid
+            state = None
+            early = None
+
+        if kind == REC_STATE:
+            state = val
+        elif state is None:
+            state = newSessionState(dt, val)
+        elif dt < state[0]:
+            if prev_watermark is not None and dt < prev_watermark:
+                yield (TAG_LATE, cid, 1)
+            elif early is None:
+                early = newSessionState(dt, val)
+            elif (dt - early[1]).total_seconds() / 60.0 < session_window:
+                early[2] += (dt - early[1]).total_seconds() / 60.0
+                early[1] = dt
+                early[3].add(val)
+                early[4] += 1
+            else:
+                yield (TAG_CLOSED, cid, getClosedSession(early))
+                early = newSessionState(dt, val)
+        else:
+            for rec in mergeEarlySession(cid, state, early, session_window):
+                yield rec
+            early = None
+            if dt <= state[1]:
+                # late page visit inside the open session
+                state[3].add(val)
+                state[4] += 1
+            else:
+                dur = (dt - state[1]).total_seconds() / 60.0
+                if dur < session_window:
+                    state[1] = dt
+                    state[2] += dur
+                    state[3].add(val)
+                    state[4] += 1
+                else:
+                    yield (TAG_CLOSED, cid, getClosedSession(state))
+                    state = newSessionState(dt, val)
+
+    if state is not None:
+        for rec in mergeEarlySession(cid_cur, state, early, session_window) + \
+                   closeIdleSession(cid_cur, state, session_window, watermark):
+            yield rec
+
+
+# ----------------------------------------------------------------------
+# Purpose: Close a customer's open session if no later page visit can
+#   extend it, or keep it open otherwise.
+# Input: Customer IP, open session state, session window in mins and
+#   the watermark as a Python datetime.
+# Output: List with a single (tag, IP, value) tuple (see
+#   getIncrementalSessions()).
+def closeIdleSession(cid, state, session_window, watermark):
+
+    if (watermark - state[1]).total_seconds() / 60.0 >= session_window:
+        return [(TAG_CLOSED, cid, getClosedSession(state))]
+    return [(TAG_OPEN, cid, state)]
+
+
+# ----------------------------------------------------------------------
+# Purpose: Add the closed sessions to the per customer engagement totals.
+# Input: RDD of (IP, closed session) tuples from getIncrementalSessions()
+#   and RDD of the previous totals (None if there are none yet).
+# Output: RDD of (IP, [total page hits, total time, number of sessions]).
+def getTotalsRDD(closed_RDD, prev_totals_RDD):
+
+    totals_RDD = closed_RDD.map(lambda (cid, sess): (cid, [sess[1], sess[0], 1.0]))
+    if prev_totals_RDD is not None:
+        totals_RDD = totals_RDD.union(prev_totals_RDD)
+    return totals_RDD.reduceByKey(lambda a, b: [a[0] + b[0], a[1] + b[1], a[2] + b[2]])
+
+
+# ----------------------------------------------------------------------
+# Purpose: Append closed sessions to the finalized sessions file and
+#   rewrite the customer duration and engagement files from the totals.
+# Input: List of (IP, closed session) tuples, RDD of the totals from
+#   getTotalsRDD(), parsed command line args and output dir.
+# Output: Size in bytes of the finalized sessions file after the append.
+def writeSessionOutputs(lclosed, totals_RDD, args, out_dir):
+
+    f = open(out_dir + args.finalized_sessions_file, 'a')
+    for ele in lclosed:
+        f.write(plc.getOutputLine(ele))
+    f.close()
+    num_bytes = os.path.getsize(out_dir + args.finalized_sessions_file)
+
+    plc.outputRanking(out_dir + args.cust_session_duration_file,
+                      totals_RDD.map(lambda (cid, tot): (cid, tot[1])), args, 'durations')
+    plc.outputFile(out_dir + args.user_engagement_stats_file,
+                   totals_RDD.map(lambda (cid, tot): (cid, [tot[0], tot[1], tot[0] / tot[2], tot[1] / tot[2], tot[2]])),
+                   args, 'engagement')
+    return num_bytes
+
+
+# ----------------------------------------------------------------------
+# Purpose: Run one incremental sessionization step over the log segments
+#   not processed yet, update the state store and write the outputs.
+# Input: SparkContext, parsed command line args, data and output dirs.
+# Output: None. Finalized sessions are appended to the output file, the
+#   customer duration and engagement files are rewritten and the totals
+#   printed to std output.
+def runIncrementalEngine(sc, args, data_dir, out_dir):
+
+    sc.addPyFile(plc.__file__.replace('.pyc', '.py'))
+    sc.addPyFile(__file__.replace('.pyc', '.py'))
+
+    state_dir = args.state_dir
+    if not os.path.exists(state_dir):
+        os.makedirs(state_dir)
+    manifest = loadManifest(state_dir)
+
+    lnew_files = [fl for fl in sorted(glob.glob(data_dir + args.infile)) if fl not in manifest['processed']]
+    if not lnew_files:
+        plc.log.info('No new log segments to process.')
+        return
+    plc.log.info('Processing ' + str(len(lnew_files)) + ' new log segment(s)...')
+    truncateFinalized(out_dir + args.finalized_sessions_file, manifest.get('finalized_bytes'))
+
+    session_window = args.session_period
+    run = manifest['run'] + 1
+
+    plc.log.info('Parsing IP, date and URL from new log segments...')
+    visits_RDD, num_malformed = plc.getValidLines(sc.textFile(','.join(lnew_files)).map(getVisit))
+
+    # the watermark only moves forward
+    lwatermarks = [plc.getEpochMicros(dt) for dt in visits_RDD.map(lambda (key, url): key[1]).top(1)]
+    if manifest['watermark_us'] is not None:
+        lwatermarks.append(manifest['watermark_us'])
+    watermark_us = max(lwatermarks) if lwatermarks else None
+    if watermark_us is None:
+        plc.log.info('No page visits in new log segments.')
+        manifest['processed'].extend(lnew_files)
+        saveManifest(state_dir, manifest)
+        return
+    watermark = plc.EPOCH + timedelta(microseconds=watermark_us)
+    prev_watermark = plc.EPOCH + timedelta(microseconds=manifest['watermark_us']) \
+        if manifest['watermark_us'] is not None else None
+
+    plc.log.info('Sessionizing new page visits from open sessions...')
+    events_RDD = visits_RDD
+    if manifest['open_dir'] is not None:
+        open_RDD = sc.pickleFile(manifest['open_dir']).map(lambda (cid, state): ((cid, STATE_SORT_TS, REC_STATE), state))
+        events_RDD = events_RDD.union(open_RDD)
+    sessions_RDD = events_RDD.repartitionAndSortWithinPartitions(args.num_partitions,
+                                                                 partitionFunc=lambda key: portable_hash(key[0])) \
+                             .mapPartitions(lambda it: getIncrementalSessions(it, session_window, watermark, prev_watermark))
+    sessions_RDD.persist()
+
+    closed_RDD = sessions_RDD.filter(lambda (tag, cid, val): tag == TAG_CLOSED).map(lambda (tag, cid, val): (cid, val))
+    closed_RDD.persist()
+
+    new_open_dir = os.path.join(state_dir, 'open_%d' % run)
+    sessions_RDD.filter(lambda (tag, cid, val): tag == TAG_OPEN).map(lambda (tag, cid, val): (cid, val)) \
+                .saveAsPickleFile(new_open_dir)
+
+    # per customer engagement deltas (total page hits, total time, number of sessions) added to the totals
+    new_totals_dir = os.path.join(state_dir, 'totals_%d' % run)
+    prev_totals_RDD = sc.pickleFile(manifest['totals_dir']) if manifest['totals_dir'] is not None else None
+    getTotalsRDD(closed_RDD, prev_totals_RDD).saveAsPickleFile(new_totals_dir)
+
+    lclosed = closed_RDD.collect()
+    num_late = sessions_RDD.filter(lambda (tag, cid, val): tag == TAG_LATE).count()
+
+    plc.log.info('Writing finalized sessions and updated customer totals...')
+    finalized_bytes = writeSessionOutputs(lclosed, sc.pickleFile(new_totals_dir), args, out_dir)
+
+    lold_dirs = [manifest['open_dir'], manifest['totals_dir']]
+    manifest['processed'].extend(lnew_files)
+    manifest['open_dir'] = new_open_dir
+    manifest['totals_dir'] = new_totals_dir
+    manifest['run'] = run
+    manifest['sum_session_time'] += sum(sess[0] for cid, sess in lclosed)
+    manifest['total_sessions'] += len(lclosed)
+    manifest['late_visits'] += num_late
+    manifest['watermark_us'] = watermark_us
+    manifest['finalized_bytes'] = finalized_bytes
+    saveManifest(state_dir, manifest)
+    for old_dir in lold_dirs:
+        if old_dir is not None:
+            shutil.rmtree(old_dir, ignore_errors=True)
+
+    print '\n\nSessions Finalized This Run: ', str(len(lclosed))
+    print 'Late Page Visits Dropped This Run: ', str(num_late)
+    print 'Malformed Lines Skipped This Run: ', str(num_malformed)
+    print 'Sum of All Session Times (mins): ', str(manifest['sum_session_time'])
+    print 'Total Number of Sessions: ', str(manifest['total_sessions'])
+    if manifest['total_sessions'] > 0:
+        print 'Avg Session Time (mins): ', str(manifest['sum_session_time'] / (0.0 + manifest['total_sessions'])), '\n'
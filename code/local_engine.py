@@ -0,0 +1,477 @@
+# PaytmLabs/WeblogChallenge
+#
+# Local engine for the web log sessionization in PaytmLabs_challenge.py that runs without Spark.
+# Selected by calling: python <working_dir_path>/code/PaytmLabs_challenge.py --engine local <optional params>
+# or automatically with --engine auto (the default) when the input file is smaller than
+# --local_engine_max_mb.
+#
+# Starting a SparkContext costs several seconds of JVM startup before any work is done, which
+# dominates the run time for small (e.g. hourly) log slices. This engine reuses the same parsing and
+# sessionization functions as the RDD engine (getLines(), getPageDurationsStream(), getSessionsStream(),
+# getSessionsURLHitsStream() and getSessionTime()) in a pool of worker processes:
+# 1) The input file is split into newline aligned byte ranges (chunks) that are parsed in parallel.
+#    Each worker hash partitions the parsed lines by customer IP into spill files in a temp dir.
+#    By default the chunks are parsed from a memory map of the input file (see code/mmap_reader.py).
+#    Gzip and bz2 input files are decompressed as a stream by the main process in blocks of whole
+#    lines, which are parsed in parallel the same way. The parse throughput and the peak memory (RSS)
+#    of each worker are logged.
+# 2) Each partition's spill files are loaded, sorted by (IP, timestamp) and saved as one sorted file.
+#    The session window stats for the heuristic are calculated in the same step.
+# 3) Each sorted partition is sessionized. Sessions are written to a part file per partition that is
+#    appended to the sessionized output file, and the per session and per customer stats are
+#    returned to the main process to be written to the other output files. With rankings topk each
+#    partition returns only its top_k sessions by unique URL visits (and top_k of each time window
+#    with --top_k_window_mins), found with a bounded heap, and the main process merges them. With
+#    --rollup_mins each partition also returns its rollup cube (see code/rollups.py) to be merged.
+###########################################################################################################################
+
+
+import cPickle
+import heapq
+import mmap
+import os
+import resource
+import shutil
+import tempfile
+import time
+import zlib
+from collections import deque
+from multiprocessing import Pool
+
+import PaytmLabs_challenge as plc
+import mmap_reader
+import rollups
+import session_index
+import session_stats
+import top_k
+import window_select
+
+
+# number of parsed records written to a spill file at a time
+SPILL_BATCH_SIZE = 10000
+
+
+# ----------------------------------------------------------------------
+# Holds a value in the worker processes of the local engine with the
+# same interface as a Spark broadcast variable, so the functions shared
+# with the RDD engine can read e.g. SESSION_WINDOW_BC.value.
+class LocalBroadcast(object):
+    def __init__(self, value):
+        self.value = value
+
+
+# ----------------------------------------------------------------------
+# Purpose: Set up a worker process of the pool with the values the RDD
+#   engine holds in broadcast variables.
+# Input: Kind of session key (see SESSION_KEY_FIELDS).
+# Output: None
+def initWorker(session_key):
+    plc.SESSION_KEY_BC = LocalBroadcast(session_key)
+    plc.SESSION_WINDOW_MAX_BC = LocalBroadcast(plc.SESSION_WINDOW_MAX)
+    plc.WEB_LOG_IP_IND_BC = LocalBroadcast(plc.WEB_LOG_IP_IND)
+    plc.WEB_LOG_URL_IND_BC = LocalBroadcast(plc.WEB_LOG_URL_IND)
+    plc.WEB_LOG_TS_IND_BC = LocalBroadcast(plc.WEB_LOG_TS_IND)
+
+
+# ----------------------------------------------------------------------
+# Purpose: Split a file into byte ranges of about the same size.
+# Input: File name and the size of a chunk in bytes.
+# Output: List of (start, end) byte offsets. A line belongs to the chunk
+#   it starts in (see iterChunkLines()).
+def getChunkRanges(filname, chunk_bytes):
+
+    file_size = os.path.getsize(filname)
+    return [(start, min(start + chunk_bytes, file_size)) for start in range(0, file_size, chunk_bytes)]
+
+
+# ----------------------------------------------------------------------
+# Purpose: Read the lines of a file that start in a byte range. A line
+#   that starts before the range is skipped (it belongs to the previous
+#   chunk) and the last line starting in the range is read to its end.
+# Input: File name and (start, end) byte offsets.
+# Output: Iterator of lines decoded as UTF-8 (the same unicode strings
+#   Spark's textFile() produces) without the line ending.
+def iterChunkLines(filname, start, end):
+
+    f = open(filname, 'rb')
+    if start > 0:
+        f.seek(start - 1)
+        # skip to the start of the first line beginning in the range
+        f.readline()
+    while f.tell() < end:
+        lin = f.readline()
+        if not lin:
+            break
+        yield lin.rstrip('\r\n').decode('utf-8', 'replace')
+    f.close()
+
+
+# ----------------------------------------------------------------------
+# Purpose: Get the partition of a customer IP. Uses a hash that is the
+#   same in every process and run.
+# Input: Customer IP and number of partitions.
+# Output: Partition index.
+def getPartition(cid, num_partitions):
+    return (zlib.crc32(cid.encode('utf-8')) & 0xffffffff) % num_partitions
+
+
+# ----------------------------------------------------------------------
+# Purpose: Iterate over the records pickled in batches to a file.
+# Input: File name
+# Output: Iterator of the records in the file.
+def iterSpillFile(filname):
+
+    f = open(filname, 'rb')
+    while True:
+        try:
+            lbatch = cPickle.load(f)
+        except EOFError:
+            break
+        for rec in lbatch:
+            yield rec
+    f.close()
+
+
+# ----------------------------------------------------------------------
+# Purpose: Iterate over the parsed lines of a chunk of the input file
+#   read a line at a time and parsed with getLines().
+# Input: Input file name, (start, end) byte offsets and a list of the
+#   number of lines read and number of malformed lines so far.
+# Output: Iterator of ((IP, timestamp), url) records as sorted by
+#   getSortedEvents(). The counts are updated in place.
+def iterChunkEvents(filname, start, end, lcounts):
+
+    plc.MALFORMED_LINES_ACC = 0
+    for lin in iterChunkLines(filname, start, end):
+        lcounts[0] += 1
+        for cid, dat in plc.getLines(lin):
+            yield (cid, dat[0][0]), dat[0][1]
+    lcounts[1] += plc.MALFORMED_LINES_ACC
+
+
+# ----------------------------------------------------------------------
+# Purpose: Hash partition parsed lines by customer IP into one spill file
+#   per partition.
+# Input: Iterator of ((IP, timestamp), url) records, chunk index, number
+#   of partitions and temp dir.
+# Output: None
+def spillEvents(it, chunk_ind, num_partitions, tmp_dir):
+
+    lfiles = [open(os.path.join(tmp_dir, 'part_%d_chunk_%d.pkl' % (p, chunk_ind)), 'wb') for p in range(num_partitions)]
+    lbatches = [[] for _ in range(num_partitions)]
+    for rec in it:
+        p = getPartition(rec[0][0], num_partitions)
+        lbatches[p].append(rec)
+        if len(lbatches[p]) >= SPILL_BATCH_SIZE:
+            cPickle.dump(lbatches[p], lfiles[p], cPickle.HIGHEST_PROTOCOL)
+            lbatches[p] = []
+    for lbatch, f in zip(lbatches, lfiles):
+        if lbatch:
+            cPickle.dump(lbatch, f, cPickle.HIGHEST_PROTOCOL)
+        f.close()
+
+
+# ----------------------------------------------------------------------
+# Purpose: Parse a chunk of the input file and write the parsed lines to
+#   one spill file per partition.
+# Input: Tuple of input file name, (start, end) byte offsets, chunk
+#   index, number of partitions, temp dir and the reader (mmap to parse
+#   from a memory map of the file, lines to read a line at a time).
+# Output: Tuple of number of lines read, number of malformed lines,
+#   number of bytes parsed, worker process id and its peak RSS in MB.
+def parseChunk(task):
+
+    filname, (start, end), chunk_ind, num_partitions, tmp_dir, reader = task
+
+    lcounts = [0, 0]
+    if reader == 'mmap':
+        f = open(filname, 'rb')
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        spillEvents(mmap_reader.iterMappedEvents(buf, start, end, len(buf), lcounts, plc.SESSION_KEY_BC.value),
+                    chunk_ind, num_partitions, tmp_dir)
+        buf.close()
+        f.close()
+    else:
+        spillEvents(iterChunkEvents(filname, start, end, lcounts), chunk_ind, num_partitions, tmp_dir)
+
+    return lcounts[0], lcounts[1], end - start, os.getpid(), getMaxRssMB()
+
+
+# ----------------------------------------------------------------------
+# Purpose: Parse a block of whole lines of a decompressed input file and
+#   write the parsed lines to one spill file per partition.
+# Input: Tuple of the block (string), chunk index, number of partitions
+#   and temp dir.
+# Output: Tuple as for parseChunk().
+def parseBlock(task):
+
+    block, chunk_ind, num_partitions, tmp_dir = task
+
+    lcounts = [0, 0]
+    spillEvents(mmap_reader.iterMappedEvents(block, 0, len(block), len(block), lcounts, plc.SESSION_KEY_BC.value),
+                chunk_ind, num_partitions, tmp_dir)
+    return lcounts[0], lcounts[1], len(block), os.getpid(), getMaxRssMB()
+
+
+# ----------------------------------------------------------------------
+# Purpose: Get the peak memory of the current process so far.
+# Input: None
+# Output: Max RSS of the process in MB.
+def getMaxRssMB():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+# ----------------------------------------------------------------------
+# Purpose: Run tasks in a pool with a bound on the tasks waiting for a
+#   worker, so tasks generated from a stream (e.g. blocks of a
+#   decompressed input file) are not all held in memory at once.
+# Input: Pool, task function, iterator of tasks and max number of tasks
+#   submitted but not done.
+# Output: Iterator of the results in task order.
+def imapBounded(pool, fn, it, max_pending):
+
+    qpending = deque()
+    for task in it:
+        qpending.append(pool.apply_async(fn, (task,)))
+        if len(qpending) >= max_pending:
+            yield qpending.popleft().get()
+    while qpending:
+        yield qpending.popleft().get()
+
+
+# ----------------------------------------------------------------------
+# Purpose: Parse the input file into one spill file per partition and
+#   chunk, and log the parse throughput and peak RSS of each worker.
+# Input: Pool, parsed command line args, input file name, number of
+#   partitions and temp dir.
+# Output: Tuple of the number of chunks and the number of malformed
+#   lines.
+def parseInput(pool, args, infile, num_partitions, tmp_dir):
+
+    chunk_bytes = args.local_chunk_mb * 1024 * 1024
+    t_start = time.time()
+    if mmap_reader.isCompressed(infile):
+        ltasks = ((block, k, num_partitions, tmp_dir)
+                  for k, block in enumerate(mmap_reader.iterCompressedBlocks(infile, chunk_bytes)))
+        lresults = list(imapBounded(pool, parseBlock, ltasks, 2 * args.local_processes))
+    else:
+        ltasks = [(infile, rng, k, num_partitions, tmp_dir, args.local_reader)
+                  for k, rng in enumerate(getChunkRanges(infile, chunk_bytes))]
+        lresults = list(pool.imap_unordered(parseChunk, ltasks))
+    secs = time.time() - t_start
+
+    num_lines = sum(res[0] for res in lresults)
+    num_mb = sum(res[2] for res in lresults) / (1024.0 * 1024.0)
+    dworker_rss = {}
+    for res in lresults:
+        dworker_rss[res[3]] = max(dworker_rss.get(res[3], 0.0), res[4])
+    plc.log.info('Parsed ' + str(num_lines) + ' lines (%.1f MB) in %.2f secs: %.1f MB/s' %
+                 (num_mb, secs, num_mb / max(secs, 1e-6)) +
+                 (' (%.1f MB/s compressed)' % (os.path.getsize(infile) / (1024.0 * 1024.0) / max(secs, 1e-6))
+                  if mmap_reader.isCompressed(infile) else ''))
+    plc.log.info('Peak RSS of the parse workers (MB): ' +
+                 ', '.join('%.1f' % rss for pid, rss in sorted(dworker_rss.items())))
+    return len(lresults), sum(res[1] for res in lresults)
+
+
+# ----------------------------------------------------------------------
+# Purpose: Sort a partition by (IP, timestamp), replacing its spill
+#   files with a single sorted file, and optionally calculate the
+#   session window stats of the partition.
+# Input: Tuple of temp dir, partition index, number of chunks, the kind
+#   of session window stats to calculate (None to not calculate them) and
+#   the windows the stats are for.
+# Output: Session window stats of the customers in the partition, summed
+#   (see getSessionsURLHits()) for url_hits or a dict from cohort to gap
+#   stats (see getGapHistograms()) for gaps, or None if not calculated
+#   or the partition is empty.
+def sortPartition(task):
+
+    tmp_dir, p, num_chunks, stats_kind, lwindows = task
+
+    levents = []
+    for chunk_ind in range(num_chunks):
+        spill_file = os.path.join(tmp_dir, 'part_%d_chunk_%d.pkl' % (p, chunk_ind))
+        levents.extend(iterSpillFile(spill_file))
+        os.remove(spill_file)
+    levents.sort()
+
+    f = open(os.path.join(tmp_dir, 'part_%d.pkl' % p), 'wb')
+    for k in range(0, len(levents), SPILL_BATCH_SIZE):
+        cPickle.dump(levents[k:k + SPILL_BATCH_SIZE], f, cPickle.HIGHEST_PROTOCOL)
+    f.close()
+
+    window_stats = None
+    if stats_kind == 'url_hits':
+        for cid, lall_sess_url_hits in plc.getSessionsURLHitsStream(plc.getPageDurationsStream(iter(levents))):
+            window_stats = addWindowStats(window_stats, lall_sess_url_hits)
+    elif stats_kind == 'gaps' and levents:
+        window_stats = dict(window_select.getGapHistograms(plc.getPageDurationsStream(iter(levents)), lwindows))
+    return window_stats
+
+
+# ----------------------------------------------------------------------
+# Purpose: Add up the session window stats of two sets of customers.
+# Input: Two lists of session window stats (either may be None).
+# Output: The element wise sum as a list of lists.
+def addWindowStats(lstats_a, lstats_b):
+
+    if lstats_a is None:
+        return lstats_b
+    if lstats_b is None:
+        return lstats_a
+    return [map(sum, zip(x, y)) for x, y in zip(lstats_a, lstats_b)]
+
+
+# ----------------------------------------------------------------------
+# Purpose: Sessionize a sorted partition. Sessions are written to the
+#   partition's part file in the format of the sessionized output file.
+# Input: Tuple of temp dir, partition index, session window in mins,
+#   relative error of the session time quantiles, top K, kind of rankings
+#   (topk or full), window size in mins of the window top K (None if off)
+#   and the rollup params (bucket size in mins, HyperLogLog precision and
+#   whether to roll up by URL prefix; None if off).
+# Output: Tuple of the session time stats (see newDurationStats()),
+#   (IP, unique URLs) of each session (only the top K with topk rankings),
+#   (IP, total session time) of each customer, (IP, engagement stats) of
+#   each customer, the runs of sessions of each IP in the part file (see
+#   writeIndexedLine()), the window top K heaps (see getWindowHeaps()) and
+#   the rollup cube (see getPartitionCube()), the last two None if off.
+def sessionizePartition(task):
+
+    tmp_dir, p, session_window, quantile_error, k, rankings, window_mins, rollup = task
+    plc.SESSION_WINDOW_BC = LocalBroadcast(session_window)
+
+    sorted_file = os.path.join(tmp_dir, 'part_%d.pkl' % p)
+    f = open(os.path.join(tmp_dir, 'sessions_%d.txt' % p), 'wb')
+    dduration_stats = session_stats.newDurationStats(quantile_error)
+    lunique_url_visits = []
+    dcust_totals = {}
+    lcids = []
+    lruns = []
+    dwindow_totals = {}
+    drollup_cube = {} if rollup else None
+    for sess in plc.getSessionsStream(plc.getPageDurationsStream(iterSpillFile(sorted_file))):
+        session_index.writeIndexedLine(f, sess, lruns)
+        cid, dur = plc.getSessionTime(sess)
+        session_stats.addDuration(dduration_stats, dur)
+        page_hit = len(set(sess[1][1]))
+        lunique_url_visits.append((cid, page_hit))
+        if window_mins:
+            window = plc.getBucketStart(plc.getTimestamp(sess[1][2][0]), window_mins)
+            dwindow_totals[(window, cid)] = dwindow_totals.get((window, cid), 0) + dur
+        if rollup:
+            rollups.addSession(drollup_cube, sess, *rollup)
+        # total time, total page hits and number of sessions of the customer
+        if cid not in dcust_totals:
+            dcust_totals[cid] = [dur, page_hit, 1.0]
+            lcids.append(cid)
+        else:
+            dcust_totals[cid][0] += dur
+            dcust_totals[cid][1] += page_hit
+            dcust_totals[cid][2] += 1.0
+    f.close()
+    os.remove(sorted_file)
+
+    if rankings == 'topk':
+        lunique_url_visits = heapq.nlargest(k, lunique_url_visits, key=lambda (cid, session_hits): session_hits)
+    dwindow_heaps = top_k.getWindowHeaps(dwindow_totals, k) if window_mins else None
+    lcust_totals = [(ip, dcust_totals[ip]) for ip in lcids]
+    ltotal_durations = [(ip, tot_dur) for ip, (tot_dur, tot_hits, num_sess) in lcust_totals]
+    lengagement = [(ip, [tot_hits, tot_dur, tot_hits / num_sess, tot_dur / num_sess, num_sess])
+                   for ip, (tot_dur, tot_hits, num_sess) in lcust_totals]
+    return dduration_stats, lunique_url_visits, ltotal_durations, lengagement, lruns, dwindow_heaps, drollup_cube
+
+
+# ----------------------------------------------------------------------
+# Purpose: Run the sessionization in a pool of worker processes and write
+#   the same output files and stats as the RDD engine.
+# Input: Parsed command line args, data and output dirs.
+# Output: None. Output files are written to the output dir and stats
+#   printed to std output.
+def runLocalEngine(args, data_dir, out_dir):
+
+    num_procs = args.local_processes
+    num_partitions = num_procs * 4
+    tmp_dir = tempfile.mkdtemp(prefix='weblog_local_')
+    pool = Pool(num_procs, initializer=initWorker, initargs=(args.session_key,))
+    try:
+        plc.log.info('Parsing IP, date and URL from Input and partitioning by customer IP...')
+        num_chunks, num_malformed = parseInput(pool, args, data_dir + args.infile, num_partitions, tmp_dir)
+
+        plc.log.info('Sorting each customer line by date...')
+        stats_kind, lwindows = window_select.getHeuristicWindows(args) if args.bCalculate_session_window else (None, None)
+        ltasks = [(tmp_dir, p, num_chunks, stats_kind, lwindows) for p in range(num_partitions)]
+        merge_fn = window_select.mergeGapStats if stats_kind == 'gaps' else addWindowStats
+        window_stats = reduce(merge_fn, pool.imap_unordered(sortPartition, ltasks), None)
+
+        session_window = args.session_period
+        if stats_kind is not None and window_stats is not None:
+            plc.log.info('Calculating heuristic to determine optimal session window.')
+            opt_window = window_select.selectSessionWindow(args, out_dir, stats_kind, lwindows, window_stats)
+            if opt_window is not None:
+                session_window = opt_window
+
+        plc.log.info('Sessionizing the data based on session period...')
+        rollup = None
+        if args.rollup_mins:
+            lrollup_mins = rollups.getRollupMins(args.rollup_mins)
+            rollup = (lrollup_mins[0], rollups.url_sketch.getHLLPrecision(args.hll_error), args.rollup_url_prefix)
+        ltasks = [(tmp_dir, p, session_window, args.quantile_error, args.top_k, args.rankings, args.top_k_window_mins, rollup)
+                  for p in range(num_partitions)]
+        lresults = pool.map(sessionizePartition, ltasks)
+
+        if args.session_index:
+            lentries = session_index.getMergedIndexEntries([(os.path.join(tmp_dir, 'sessions_%d.txt' % p), lresults[p][4])
+                                                            for p in range(num_partitions)],
+                                                           out_dir + args.sessionized_cust_file)
+            session_index.saveSessionIndex(out_dir + args.sessionized_cust_file + session_index.INDEX_SUFFIX, lentries)
+        f = open(out_dir + args.sessionized_cust_file, 'wb')
+        for p in range(num_partitions):
+            part_file = open(os.path.join(tmp_dir, 'sessions_%d.txt' % p), 'rb')
+            shutil.copyfileobj(part_file, f)
+            part_file.close()
+        f.close()
+    finally:
+        pool.close()
+        pool.join()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    # partition stats merged in partition order, as by session_stats.getDurationStats()
+    dduration_stats = reduce(session_stats.mergeDurationStats, [res[0] for res in lresults])
+    session_stats.printSummary(dduration_stats, session_stats.getQuantiles(args.session_time_quantiles))
+    print 'Malformed Lines Skipped: ', str(num_malformed), '\n'
+
+    plc.log.info('Calculating number of page hits for each user session...')
+    lunique_url_visits = plc.getRankingList([x for res in lresults for x in res[1]], args)
+    print 'Top 15 sessions by unique URL visits: ' + str(lunique_url_visits[0:15])
+    plc.outputLocal(out_dir + args.unique_url_visits_file, lunique_url_visits)
+
+    plc.log.info('Calculating total duration for each user across sessions...')
+    lTotalSessionDuration = plc.getRankingList([x for res in lresults for x in res[2]], args)
+    plc.outputLocal(out_dir + args.cust_session_duration_file, lTotalSessionDuration)
+
+    topIPs = lTotalSessionDuration[0:15]
+    print '\n\nTop 15 Most Engaged users by total duration from all their sessions (mins): ' + str(topIPs)
+
+    if args.top_k_window_mins:
+        # merge the top K heaps of each window from all partitions
+        dwindow_heaps = {}
+        for res in lresults:
+            for window, heap in res[5].iteritems():
+                top_k.mergeTopK(dwindow_heaps.setdefault(window, []), heap, args.top_k)
+        top_k.writeWindowTopK(out_dir + args.top_k_window_file,
+                              [(window, top_k.getSortedTopK(dwindow_heaps[window])) for window in sorted(dwindow_heaps)], 'w')
+
+    if args.rollup_mins:
+        rollups.outputRollups(reduce(rollups.mergeCubes, [res[6] for res in lresults], {}), lrollup_mins, args, out_dir)
+
+    plc.log.info('Calculating total page hits across sessions and total number of sessions per user...')
+    lTotalEngagementStats = [x for res in lresults for x in res[3]]
+    plc.outputLocal(out_dir + args.user_engagement_stats_file, lTotalEngagementStats)
+
+    lavg_page_hits = [x[1][2] for x in lTotalEngagementStats]
+    lavg_session_time = [x[1][3] for x in lTotalEngagementStats]
+    lnum_sessions = [x[1][4] for x in lTotalEngagementStats]
+    plc.plot3d(out_dir + args.user_engagement_plot_file, lavg_session_time, lavg_page_hits, lnum_sessions,
+               'Avg Session Time (Mins)', 'Avg Number of Page Hits', 'Number of Sessions', 'Plot of User Engagement')
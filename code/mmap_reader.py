@@ -0,0 +1,167 @@
+# PaytmLabs/WeblogChallenge
+#
+# Memory mapped reader of the web log input file for the local engine of PaytmLabs_challenge.py.
+# Used by calling: python <working_dir_path>/code/PaytmLabs_challenge.py --engine local --local_reader mmap <optional params>
+#
+# Reading the input a line at a time copies every line into a Python string, decodes it to unicode and
+# splits it into a list of strings for all its fields, of which only the IP, timestamp and URL are kept.
+# This reader memory maps the input file instead and, for each newline aligned byte range (chunk) of
+# it, finds the line and field boundaries with find() on the mapped buffer. Only the IP, timestamp and
+# URL are sliced out as strings, so no copies are made of the lines or of the fields that are
+# discarded. The fields are split the same way as splitElbLine() and give the same records as
+# getLines().
+# Gzip and bz2 input files (.gz and .bz2) cannot be mapped or split at byte offsets, so they are read
+# with streaming decompression, in blocks of whole lines that are parsed the same way.
+###########################################################################################################################
+
+
+import bz2
+import gzip
+
+import PaytmLabs_challenge as plc
+
+
+# openers of the supported compressed input files by file extension
+COMPRESSED_OPENERS = {'.gz': gzip.open, '.bz2': bz2.BZ2File}
+
+
+# ----------------------------------------------------------------------
+# Purpose: Find the fields of a line of the ELB web log in a buffer
+#   without copying them. Same rules as splitElbLine().
+# Input: Buffer (mmap or string), start and end offsets of the line in
+#   it (without the line ending) and the number of fields to find.
+# Output: List of (start, end) offsets of the fields in the buffer.
+#   Raises ValueError if a quoted field is not terminated.
+def getElbFieldSpans(buf, start, end, max_fields):
+
+    lspans = []
+    pos = start
+    while pos < end and len(lspans) < max_fields:
+        if buf[pos] == ' ':
+            pos += 1
+        elif buf[pos] == '"':
+            field_end = buf.find('" ', pos + 1, end)
+            if field_end < 0:
+                field_end = end - 1
+                if field_end <= pos or buf[field_end] != '"':
+                    raise ValueError('Unterminated quoted field')
+            lspans.append((pos + 1, field_end))
+            pos = field_end + 2
+        else:
+            field_end = buf.find(' ', pos, end)
+            if field_end < 0:
+                field_end = end
+            lspans.append((pos, field_end))
+            pos = field_end + 1
+    return lspans
+
+
+# ----------------------------------------------------------------------
+# Purpose: Parse the customer IP, timestamp and URL from a line of the
+#   web log in a buffer. Same as parseElbLine() but only the fields it
+#   uses are sliced from the buffer.
+# Input: Buffer, start and end offsets of the line, the indices of the
+#   IP, timestamp and URL fields and the kind of session key.
+# Output: A tuple of customer IP (port stripped) or session key, Python
+#   datetime object and string URL, with the strings decoded as UTF-8 as
+#   by iterChunkLines(). Raises an exception if the line is malformed.
+def parseMappedLine(buf, start, end, ip_ind, ts_ind, url_ind, session_key='ip'):
+
+    lkey_inds = plc.SESSION_KEY_FIELDS[session_key]
+    lspans = getElbFieldSpans(buf, start, end, max([ip_ind, ts_ind, url_ind] + lkey_inds) + 1)
+    ip_start, ip_end = lspans[ip_ind]
+    port_ind = buf.find(':', ip_start, ip_end)
+    if port_ind >= 0:
+        ip_end = port_ind
+    ts_start, ts_end = lspans[ts_ind]
+    url_start, url_end = lspans[url_ind]
+    cust_id = buf[ip_start:ip_end].decode('utf-8', 'replace')
+    if lkey_inds:
+        lkey_dat = [buf[lspans[k][0]:lspans[k][1]].decode('utf-8', 'replace') if k < len(lspans) else u'-'
+                    for k in lkey_inds]
+        cust_id = plc.getSessionKey(cust_id, lkey_dat, session_key)
+    return (cust_id, plc.parseElbTimestamp(buf[ts_start:ts_end]), buf[url_start:url_end].decode('utf-8', 'replace'))
+
+
+# ----------------------------------------------------------------------
+# Purpose: Find the lines of a buffer that start in a byte range. As in
+#   iterChunkLines(), a line that starts before the range belongs to the
+#   previous chunk and the last line starting in the range is read to
+#   its end.
+# Input: Buffer, (start, end) byte offsets and the size of the buffer.
+# Output: Iterator of (start, end) offsets of the lines without their
+#   line ending.
+def iterLineSpans(buf, start, end, buf_size):
+
+    pos = start
+    if start > 0:
+        # skip to the start of the first line beginning in the range
+        pos = buf.find('\n', start - 1, buf_size) + 1
+        if pos == 0:
+            return
+    while pos < end:
+        lin_end = buf.find('\n', pos, buf_size)
+        next_pos = lin_end + 1
+        if lin_end < 0:
+            lin_end = next_pos = buf_size
+        while lin_end > pos and buf[lin_end - 1] == '\r':
+            lin_end -= 1
+        yield pos, lin_end
+        pos = next_pos
+
+
+# ----------------------------------------------------------------------
+# Purpose: Parse the lines of a buffer that start in a byte range.
+# Input: Buffer, (start, end) byte offsets, size of the buffer, a list of
+#   the number of lines read and the number of malformed lines so far and
+#   the kind of session key.
+# Output: Iterator of ((IP, timestamp), url) records as sorted by
+#   getSortedEvents(). Malformed lines are skipped and the counts are
+#   updated in place.
+def iterMappedEvents(buf, start, end, buf_size, lcounts, session_key='ip'):
+
+    ip_ind, ts_ind, url_ind = plc.WEB_LOG_IP_IND, plc.WEB_LOG_TS_IND, plc.WEB_LOG_URL_IND
+    for lin_start, lin_end in iterLineSpans(buf, start, end, buf_size):
+        lcounts[0] += 1
+        try:
+            cid, dt, url = parseMappedLine(buf, lin_start, lin_end, ip_ind, ts_ind, url_ind, session_key)
+        except:
+            lcounts[1] += 1
+            continue
+        yield (cid, dt), url
+
+
+# ----------------------------------------------------------------------
+# Purpose: Check if an input file is compressed.
+# Input: File name
+# Output: True if the file has a supported compressed file extension.
+def isCompressed(filname):
+    return any(filname.endswith(ext) for ext in COMPRESSED_OPENERS)
+
+
+# ----------------------------------------------------------------------
+# Purpose: Read a compressed input file with streaming decompression in
+#   blocks of whole lines.
+# Input: File name and the least size of a block in bytes (of the
+#   decompressed data).
+# Output: Iterator of string blocks, each ending with a line ending (but
+#   the last if the file does not).
+def iterCompressedBlocks(filname, block_bytes):
+
+    ext = [ext for ext in COMPRESSED_OPENERS if filname.endswith(ext)][0]
+    f = COMPRESSED_OPENERS[ext](filname, 'rb')
+    rest = ''
+    while True:
+        dat = f.read(block_bytes)
+        if not dat:
+            break
+        dat = rest + dat
+        lin_end = dat.rfind('\n')
+        if lin_end < 0:
+            rest = dat
+            continue
+        rest = dat[lin_end + 1:]
+        yield dat[:lin_end + 1]
+    f.close()
+    if rest:
+        yield rest
@@ -0,0 +1,216 @@
+# PaytmLabs/WeblogChallenge
+#
+# Sessionization for several session periods in one run of PaytmLabs_challenge.py.
+# Run by calling: bin/spark-submit <working_dir_path>/code/PaytmLabs_challenge.py --session_periods 13,15,34 <optional params>
+#
+# Comparing session periods used to mean rerunning the whole job for each one, parsing, shuffling
+# and sorting the log again every time. With --session_periods the page visits with their durations
+# (d5_cust_duration_RDD) are computed once and sessionized for all the periods in a single pass over
+# each customer's gaps: since a gap that starts a session for a period starts one for every shorter
+# period too, the open sessions of the periods are nested, and only the visits of the open session of
+# the longest period are kept, with the start of the open session of each period as an index into them.
+# The sessions, session times and unique URL counts of all periods come out of that one pass, and the
+# engagement totals of all periods are aggregated in one shuffle keyed by (period, IP).
+# Each period gets its own set of output files, named after the single period output files with the
+# period appended (e.g. Sessionized_Customer_File_15min.txt).
+###########################################################################################################################
+
+
+import os
+from bisect import bisect_right
+from datetime import timedelta
+
+import numpy as np
+
+import PaytmLabs_challenge as plc
+
+
+# ----------------------------------------------------------------------
+# Purpose: Parse the list of session periods.
+# Input: Comma separated string of session periods in mins.
+# Output: Sorted list of the distinct periods as floats. Raises ValueError
+#   if a period is not a positive number.
+def getSessionPeriods(periods):
+
+    lperiods = sorted(set(float(period) for period in periods.split(',')))
+    if not lperiods or lperiods[0] <= 0:
+        raise ValueError('Session periods must be positive: ' + periods)
+    return lperiods
+
+
+# ----------------------------------------------------------------------
+# Purpose: Get the name of the output file of a session period.
+# Input: Name of the single period output file and the period in mins.
+# Output: File name with the period added before the extension, e.g.
+#   Sessionized_Customer_File_15min.txt
+def getPeriodFileName(filname, period):
+
+    base, ext = os.path.splitext(filname)
+    return base + '_%gmin' % period + ext
+
+
+# ----------------------------------------------------------------------
+# Purpose: Convert a customer record from getColumnarRecords() to the per
+#   page visit stream produced by getPageDurationsStream().
+# Input: A line of customer data from getColumnarRecords().
+# Output: Iterator of tuples with customer IP as key and a list of the
+#   string URL, timestamp and duration of a page visit as value.
+def iterColumnarPageDurations(lin):
+
+    cid = lin[0]
+    lurl_dict, ts, url_ids = lin[1]
+    ldurs = [0.0] + (np.diff(ts) / (60.0 * plc.US_PER_SEC)).tolist()
+    for k, (url_id, us, dur) in enumerate(zip(url_ids.tolist(), ts.tolist(), ldurs)):
+        dt = plc.EPOCH + timedelta(microseconds=us)
+        yield (cid, [lurl_dict[url_id], dt if k == 0 else [dt], dur])
+
+
+# ----------------------------------------------------------------------
+# Purpose: Emit the open sessions of the shortest session periods.
+# Input: Customer IP, number of periods to close the sessions of, list of
+#   the start index of the open session of each period and the lists of
+#   durations, urls and timestamps of the open session of the longest
+#   period.
+# Output: Iterator of tuples of period index and session (as for
+#   getSessions()). The first duration of a session is always 0.
+def closePeriodSessions(cid, num_closed, lstarts, ldurs, lurls, lts):
+
+    for k in range(num_closed):
+        k_start = lstarts[k]
+        yield (k, (cid, [[0] + ldurs[k_start + 1:], lurls[k_start:], lts[k_start:]]))
+
+
+# ----------------------------------------------------------------------
+# Purpose: Multi period version of getSessionsStream(). The sessions of
+#   all periods are found in one pass over a customer's page visits.
+#   A visit whose duration since the previous visit is dur starts a new
+#   session for every period <= dur, so it closes the open sessions of
+#   the shortest periods. The visits of the open session of the longest
+#   period are kept once, and the open session of each shorter period is
+#   the visits from its start index on.
+# Input: Iterator of page visits from getPageDurationsStream() with all
+#   the visits of a customer next to each other, and the sorted list of
+#   session periods.
+# Output: Iterator of tuples of period index (into the list of periods)
+#   and a session in the same format as getSessions(). The sessions of
+#   each period are in the same order as getSessionsStream() gives them.
+def getPeriodSessionsStream(it, lperiods):
+
+    num_periods = len(lperiods)
+    cid_cur = None
+    for cid, (url, ts, dur) in it:
+        if cid != cid_cur:
+            if cid_cur is not None:
+                for ele in closePeriodSessions(cid_cur, num_periods, lstarts, ldurs, lurls, lts):
+                    yield ele
+            cid_cur = cid
+            lstarts = [0] * num_periods
+            ldurs, lurls, lts = [], [], []
+
+        # number of periods (shortest first) for which the duration since
+        # the last page visited is not less than the period
+        num_closed = bisect_right(lperiods, dur)
+        if num_closed > 0:
+            for ele in closePeriodSessions(cid_cur, num_closed, lstarts, ldurs, lurls, lts):
+                yield ele
+            if num_closed == num_periods:
+                ldurs, lurls, lts = [], [], []
+            for k in range(num_closed):
+                lstarts[k] = len(ldurs)
+        ldurs.append(dur)
+        lurls.append(url)
+        lts.append(ts)
+
+    if cid_cur is not None:
+        for ele in closePeriodSessions(cid_cur, num_periods, lstarts, ldurs, lurls, lts):
+            yield ele
+
+
+# ----------------------------------------------------------------------
+# Purpose: Add up the session time and number of sessions of two sets of
+#   customers.
+# Input: Two tuples of sum of session times and number of sessions.
+# Output: The element wise sum.
+def addPeriodTotals(a, b):
+    return (a[0] + b[0], a[1] + b[1])
+
+
+# ----------------------------------------------------------------------
+# Purpose: Sessionize the page visits for every session period and write
+#   the sessions, unique URL visits, customer durations and engagement
+#   stats of each period to its own output files.
+# Input: SparkContext, parsed command line args, RDD of page visits with
+#   their durations (d5_cust_duration_RDD of the stream, columnar or list
+#   per_ip_mode), sorted list of session periods, output dir, the stage
+#   metrics (see stage_metrics.newRunMetrics(), or None) and the broadcast
+#   list of session keys if the keys are encoded (see getKeyNames()).
+# Output: Dict of period to a tuple of the sum of session times and the
+#   number of sessions. Stats are also printed to std output.
+def runPeriodSessions(sc, args, cust_duration_RDD, lperiods, out_dir, dmetrics, key_names_BC=None):
+
+    import stage_metrics
+    sc.addPyFile(__file__.replace('.pyc', '.py'))
+
+    if args.per_ip_mode == 'stream':
+        visits_RDD = cust_duration_RDD
+    elif args.per_ip_mode == 'columnar':
+        visits_RDD = cust_duration_RDD.flatMap(iterColumnarPageDurations)
+    else:
+        visits_RDD = cust_duration_RDD.flatMap(plc.iterPageDurations)
+
+    plc.log.info('Sessionizing the data for session periods ' + str(lperiods) + '...')
+    d7_period_sessions_RDD = visits_RDD.mapPartitions(lambda it: getPeriodSessionsStream(it, lperiods))
+    d7_period_sessions_RDD.persist()
+    stage_metrics.runStage(dmetrics, 'sessionize', d7_period_sessions_RDD, 'durations')
+
+    # duration and unique urls of each session, keyed by period and IP
+    d8_session_stats_RDD = d7_period_sessions_RDD.map(lambda (k, (cid, dat)): ((k, cid), (sum(dat[0]), len(set(dat[1])))))
+    d8_session_stats_RDD.persist()
+    stage_metrics.runStage(dmetrics, 'session_time', d8_session_stats_RDD, 'sessionize')
+
+    # engagement totals of every period in one shuffle
+    plc.log.info('Calculating total duration, total page hits and total number of sessions per user and period...')
+    d14_total_engagement_RDD = plc.getEngagementTotals(d8_session_stats_RDD)
+    d14_total_engagement_RDD.persist()
+    stage_metrics.runStage(dmetrics, 'aggregate_engagement', d14_total_engagement_RDD, 'session_time')
+    dperiod_totals = d14_total_engagement_RDD.map(lambda ((k, cid), dat): (k, (dat[1], dat[4]))) \
+                                             .reduceByKey(addPeriodTotals).collectAsMap()
+
+    dtotals = {}
+    for k, period in enumerate(lperiods):
+        sum_session_time, total_num_sessions = dperiod_totals.get(k, (0.0, 0))
+        dtotals[period] = (sum_session_time, int(total_num_sessions))
+        print '\n\nSession Period (mins): ', '%g' % period
+        print 'Sum of All Session Times (mins): ', str(sum_session_time)
+        print 'Total Number of Sessions: ', str(int(total_num_sessions))
+        print 'Avg Session Time (mins): ', str(sum_session_time / (0.0 + max(total_num_sessions, 1))), '\n'
+
+        stage_metrics.timeStage(dmetrics, 'output_sessions_%gmin' % period,
+                                lambda: plc.outputFile(out_dir + getPeriodFileName(args.sessionized_cust_file, period),
+                                                       plc.decodeKeys(d7_period_sessions_RDD.filter(lambda (k_sess, sess): k_sess == k).values(),
+                                                                      key_names_BC),
+                                                       args, 'sessions'))
+
+        d8b_page_hits_RDD = d8_session_stats_RDD.filter(lambda ((k_sess, cid), stats): k_sess == k) \
+                                                .map(lambda ((k_sess, cid), (dur, page_hit)): (cid, page_hit))
+        lunique_url_visits = stage_metrics.timeStage(dmetrics, 'output_url_visits_%gmin' % period,
+                                                     lambda: plc.outputRanking(out_dir + getPeriodFileName(args.unique_url_visits_file, period),
+                                                                               plc.decodeKeys(d8b_page_hits_RDD, key_names_BC), args, 'url_visits'))
+        print 'Top 15 sessions by unique URL visits: ' + str(lunique_url_visits)
+
+        d14_period_engagement_RDD = d14_total_engagement_RDD.filter(lambda ((k_cust, cid), dat): k_cust == k) \
+                                                            .map(lambda ((k_cust, cid), dat): (cid, dat))
+        d10_total_cust_session = d14_period_engagement_RDD.map(lambda (cid, dat): (cid, dat[1]))
+        topIPs = stage_metrics.timeStage(dmetrics, 'output_durations_%gmin' % period,
+                                         lambda: plc.outputRanking(out_dir + getPeriodFileName(args.cust_session_duration_file, period),
+                                                                   plc.decodeKeys(d10_total_cust_session, key_names_BC), args, 'durations'))
+        print '\n\nTop 15 Most Engaged users by total duration from all their sessions (mins): ' + str(topIPs)
+        stage_metrics.timeStage(dmetrics, 'output_engagement_%gmin' % period,
+                                lambda: plc.outputFile(out_dir + getPeriodFileName(args.user_engagement_stats_file, period),
+                                                       plc.decodeKeys(d14_period_engagement_RDD, key_names_BC), args, 'engagement'))
+
+    print '\n\n%-22s %16s %24s' % ('Session Period (mins)', 'Total Sessions', 'Avg Session Time (mins)')
+    for period in lperiods:
+        sum_session_time, total_num_sessions = dtotals[period]
+        print '%-22g %16d %24.4f' % (period, total_num_sessions, sum_session_time / (0.0 + max(total_num_sessions, 1)))
+    return dtotals
@@ -0,0 +1,173 @@
+# PaytmLabs/WeblogChallenge
+#
+# Cache of the parsed web log for PaytmLabs_challenge.py.
+# Enabled by calling: bin/spark-submit <working_dir_path>/code/PaytmLabs_challenge.py --cache_dir <dir> <optional params>
+#
+# Parsing the raw log is the most expensive step of a run and gives the same (IP, timestamp, URL)
+# page visits every time, even when only the session period or the analysis of the sessions changes.
+# The first run on an input file saves the parsed page visits in the cache dir as a Parquet dataset
+# (columns cid, ts_us and url, the same as the events of the DataFrame engine) and later runs load
+# them from there instead of parsing the log again.
+# Cache entries are keyed by the input file path, size and modification time, PARSER_VERSION and the
+# kind of session key (--session_key), so an entry is not used once the file or the parser changes,
+# and older entries for the same input file are removed when a new one is saved. Once the entries add
+# up to more than --cache_max_mb the least recently used ones are evicted.
+###########################################################################################################################
+
+
+import hashlib
+import json
+import os
+import shutil
+import time
+from datetime import timedelta
+
+from pyspark.sql import SparkSession
+from pyspark.sql.types import StructType, StructField, StringType, LongType
+
+import PaytmLabs_challenge as plc
+
+
+# names of the files of a cache entry
+CACHE_META = 'meta.json'
+CACHE_EVENTS = 'events.parquet'
+
+EVENTS_SCHEMA = StructType([StructField('cid', StringType(), False),
+                            StructField('ts_us', LongType(), False),
+                            StructField('url', StringType(), False)])
+
+
+# ----------------------------------------------------------------------
+# Purpose: Build the cache key of an input file.
+# Input: Full path of the web log input file and the kind of session key
+#   the page visits are parsed with.
+# Output: A tuple of the key (hex string) and a dict of the file
+#   attributes the key is made from.
+def getCacheKey(filname, session_key):
+
+    st = os.stat(filname)
+    dkey = {'path': os.path.abspath(filname), 'size': st.st_size, 'mtime': st.st_mtime,
+            'parser_version': plc.PARSER_VERSION}
+    if session_key != 'ip':
+        # left out for ip so entries saved before session keys existed are still used
+        dkey['session_key'] = session_key
+    return hashlib.sha1(json.dumps(dkey, sort_keys=True)).hexdigest()[:16], dkey
+
+
+# ----------------------------------------------------------------------
+# Purpose: Load the metadata of all complete cache entries.
+# Input: Cache dir
+# Output: Dict with the cache key as key and the entry's metadata dict
+#   as value. Entries without metadata (interrupted saves) are removed.
+def loadCacheEntries(cache_dir):
+
+    dentries = {}
+    if not os.path.exists(cache_dir):
+        return dentries
+    for key in os.listdir(cache_dir):
+        meta_file = os.path.join(cache_dir, key, CACHE_META)
+        if not os.path.exists(meta_file):
+            shutil.rmtree(os.path.join(cache_dir, key), ignore_errors=True)
+            continue
+        f = open(meta_file, 'r')
+        dentries[key] = json.load(f)
+        f.close()
+    return dentries
+
+
+# ----------------------------------------------------------------------
+# Purpose: Write the metadata of a cache entry.
+# Input: Cache dir, cache key and metadata dict.
+# Output: None
+def saveCacheMeta(cache_dir, key, dmeta):
+
+    meta_file = os.path.join(cache_dir, key, CACHE_META)
+    f = open(meta_file + '.tmp', 'w')
+    json.dump(dmeta, f, indent=1)
+    f.close()
+    os.rename(meta_file + '.tmp', meta_file)
+
+
+# ----------------------------------------------------------------------
+# Purpose: Get the size of a cache entry on disk.
+# Input: Dir of the cache entry.
+# Output: Size in bytes of all files in the dir.
+def getEntrySize(entry_dir):
+
+    total = 0
+    for dir_path, ldirs, lfiles in os.walk(entry_dir):
+        total += sum(os.path.getsize(os.path.join(dir_path, filname)) for filname in lfiles)
+    return total
+
+
+# ----------------------------------------------------------------------
+# Purpose: Load the parsed page visits of an input file from the cache.
+# Input: SparkContext, cache dir, full path of the web log input file and
+#   the kind of session key.
+# Output: None if there is no valid cache entry for the file, otherwise
+#   a tuple of a RDD in the same (IP, [[Python datetime, url]]) format as
+#   getLines() output, and the number of malformed lines the parse
+#   skipped.
+def loadParsedEvents(sc, cache_dir, filname, session_key='ip'):
+
+    key, dkey = getCacheKey(filname, session_key)
+    dentries = loadCacheEntries(cache_dir)
+    if key not in dentries:
+        return None
+    dmeta = dentries[key]
+    dmeta['last_used'] = time.time()
+    saveCacheMeta(cache_dir, key, dmeta)
+
+    sc.addPyFile(plc.__file__.replace('.pyc', '.py'))
+    events_df = SparkSession(sc).read.parquet(os.path.join(cache_dir, key, CACHE_EVENTS))
+    date_url_RDD = events_df.rdd.map(lambda row: (row.cid, [[plc.EPOCH + timedelta(microseconds=row.ts_us), row.url]]))
+    return date_url_RDD, dmeta['num_malformed']
+
+
+# ----------------------------------------------------------------------
+# Purpose: Save the parsed page visits of an input file to the cache,
+#   replacing older entries for the same file, and evict the least
+#   recently used entries until the cache fits in its max size.
+# Input: SparkContext, cache dir, full path of the web log input file,
+#   RDD of getValidLines() output, the number of malformed lines, the max
+#   cache size in MB and the kind of session key.
+# Output: None
+def saveParsedEvents(sc, cache_dir, filname, date_url_RDD, num_malformed, max_mb, session_key='ip'):
+
+    key, dkey = getCacheKey(filname, session_key)
+    entry_dir = os.path.join(cache_dir, key)
+    shutil.rmtree(entry_dir, ignore_errors=True)
+    os.makedirs(entry_dir)
+
+    sc.addPyFile(plc.__file__.replace('.pyc', '.py'))
+    events_RDD = date_url_RDD.map(lambda (cid, dat): (cid, plc.getEpochMicros(dat[0][0]), dat[0][1]))
+    SparkSession(sc).createDataFrame(events_RDD, EVENTS_SCHEMA).write.parquet(os.path.join(entry_dir, CACHE_EVENTS))
+
+    dmeta = dict(dkey, num_malformed=num_malformed, size_bytes=getEntrySize(entry_dir), last_used=time.time())
+    saveCacheMeta(cache_dir, key, dmeta)
+    plc.log.info('Saved parsed input to cache entry ' + key + ' (%.1f MB).' % (dmeta['size_bytes'] / (1024.0 * 1024.0)))
+
+    dentries = loadCacheEntries(cache_dir)
+    for old_key, dold in dentries.items():
+        if old_key != key and dold['path'] == dkey['path'] and dold.get('session_key', 'ip') == session_key:
+            # same input file, but it or the parser changed since
+            shutil.rmtree(os.path.join(cache_dir, old_key), ignore_errors=True)
+            del dentries[old_key]
+    evictCacheEntries(cache_dir, dentries, max_mb)
+
+
+# ----------------------------------------------------------------------
+# Purpose: Remove the least recently used cache entries until the cache
+#   fits in its max size.
+# Input: Cache dir, dict of cache entries from loadCacheEntries() and
+#   max cache size in MB.
+# Output: None
+def evictCacheEntries(cache_dir, dentries, max_mb):
+
+    total_bytes = sum(dmeta['size_bytes'] for dmeta in dentries.values())
+    for key, dmeta in sorted(dentries.items(), key=lambda (key, dmeta): dmeta['last_used']):
+        if total_bytes <= max_mb * 1024 * 1024:
+            break
+        plc.log.info('Evicting cache entry ' + key + ' for ' + dmeta['path'] + '.')
+        shutil.rmtree(os.path.join(cache_dir, key), ignore_errors=True)
+        total_bytes -= dmeta['size_bytes']
@@ -0,0 +1,260 @@
+# PaytmLabs/WeblogChallenge
+#
+# Time bucketed rollups of the sessions of PaytmLabs_challenge.py.
+# Built by calling: bin/spark-submit <working_dir_path>/code/PaytmLabs_challenge.py --rollup_mins 1,60 <optional params>
+# Rolled up further by calling: python <working_dir_path>/code/rollups.py --cube_file <out_dir>/Session_Rollups.pkl \
+#                                   --bucket_mins 1440 <optional params>
+#
+# A run only gives one overall average session time. With --rollup_mins the sessions are also
+# aggregated, in the same pass as the sessionization (per partition, then merged), into a cube of time
+# bucket x metric cells at the finest bucket size asked for, optionally also by URL prefix (the first
+# path segment of the URL, with --rollup_url_prefix). Each cell holds:
+#   - the number of sessions and the sum of their session times, by the bucket the session starts in
+#   - a HyperLogLog sketch of the active users and of the unique URLs, by the bucket of each page visit
+#     (see code/url_sketch.py, error set by --hll_error)
+# All of these are additive (sketches are merged by the max of their registers), so a coarser rollup is
+# made by merging the cells of the finer buckets it covers, without touching the sessions. The cube is
+# saved to --rollup_cube_file, and each bucket size of --rollup_mins is written to a text file named
+# after --rollup_file with the bucket size appended (e.g. Session_Rollups_60min.txt), one line per
+# bucket and URL prefix ('*' for all URLs):
+#   <'bucket start' 'URL prefix' [sessions, sum of session times, avg session time, active users, unique URLs]>
+# Buckets are counted from the epoch (UTC, see getBucketStart()), so daily buckets (1440) start at midnight.
+###########################################################################################################################
+
+
+import argparse
+import cPickle
+import os
+from urlparse import urlparse
+
+import PaytmLabs_challenge as plc
+import url_sketch
+
+
+# URL prefix of the cells over all URLs
+ALL_URLS = '*'
+
+
+# ----------------------------------------------------------------------
+# Purpose: Get the prefix of a URL to roll up by.
+# Input: String URL field of the web log (the request line, e.g.
+#   GET https://paytm.com:443/shop/wallet/txnhistory HTTP/1.1)
+# Output: String of the first segment of the URL path, e.g. '/shop', or
+#   '/' if it has none.
+def getURLPrefix(url):
+
+    lparts = url.split(' ')
+    path = urlparse(lparts[1] if len(lparts) > 1 else lparts[0]).path
+    return '/' + path.lstrip('/').split('/', 1)[0]
+
+
+# ----------------------------------------------------------------------
+# Purpose: Get a cell of the cube, adding it if it is not there yet.
+# Input: Dict of the cube, (bucket start, URL prefix) key of the cell and
+#   the number of HyperLogLog register index bits p.
+# Output: The cell as a list of the number of sessions, sum of session
+#   times, sketch of the active users and sketch of the unique URLs.
+def getCell(dcube, key, p):
+
+    cell = dcube.get(key)
+    if cell is None:
+        cell = dcube[key] = [0, 0.0, url_sketch.getURLSketch([], p), url_sketch.getURLSketch([], p)]
+    return cell
+
+
+# ----------------------------------------------------------------------
+# Purpose: Add a session to the cube.
+# Input: Dict of the cube, a session as given by getSessions(), the bucket
+#   size in mins, p and whether to roll up by URL prefix too.
+# Output: None. The cube is updated in place.
+def addSession(dcube, sess, bucket_mins, p, bPrefix):
+
+    cid, (ldurs, lurls, lts) = sess
+    cid_hash = url_sketch.getURLHash(cid)
+    start_bucket = plc.getBucketStart(plc.getTimestamp(lts[0]), bucket_mins)
+    session_time = sum(ldurs)
+    lprefixes = [ALL_URLS] + (sorted(set(getURLPrefix(url) for url in lurls)) if bPrefix else [])
+    for prefix in lprefixes:
+        cell = getCell(dcube, (start_bucket, prefix), p)
+        cell[0] += 1
+        cell[1] += session_time
+
+    for url, ts in zip(lurls, lts):
+        bucket = plc.getBucketStart(plc.getTimestamp(ts), bucket_mins)
+        url_hash = url_sketch.getURLHash(url)
+        for prefix in ([ALL_URLS, getURLPrefix(url)] if bPrefix else [ALL_URLS]):
+            cell = getCell(dcube, (bucket, prefix), p)
+            url_sketch.addURLHash(cell[2], cid_hash)
+            url_sketch.addURLHash(cell[3], url_hash)
+
+
+# ----------------------------------------------------------------------
+# Purpose: Merge two cells of the same bucket and URL prefix.
+# Input: Two cells from getCell()
+# Output: A new cell with the sums of the counts and the merged sketches.
+def mergeCells(a, b):
+    return [a[0] + b[0], a[1] + b[1], url_sketch.mergeURLSketches(a[2], b[2]), url_sketch.mergeURLSketches(a[3], b[3])]
+
+
+# ----------------------------------------------------------------------
+# Purpose: Merge the cells of a cube into another cube (e.g. of two
+#   partitions).
+# Input: Dicts of the two cubes.
+# Output: The first cube, updated in place.
+def mergeCubes(dcube_a, dcube_b):
+
+    for key, cell in dcube_b.iteritems():
+        dcube_a[key] = mergeCells(dcube_a[key], cell) if key in dcube_a else cell
+    return dcube_a
+
+
+# ----------------------------------------------------------------------
+# Purpose: Build the cube of a partition of sessions.
+# Input: Iterator over sessions, the bucket size in mins, p and whether to
+#   roll up by URL prefix too.
+# Output: Iterator of ((bucket start, URL prefix), cell) tuples.
+def getPartitionCube(it, bucket_mins, p, bPrefix):
+
+    dcube = {}
+    for sess in it:
+        addSession(dcube, sess, bucket_mins, p, bPrefix)
+    return dcube.iteritems()
+
+
+# ----------------------------------------------------------------------
+# Purpose: Build the cube of the sessions. Each partition is aggregated
+#   on its own and the partition cubes are merged by cell.
+# Input: RDD of sessions (with the session keys decoded), the bucket size
+#   in mins, p and whether to roll up by URL prefix too.
+# Output: Dict of (bucket start, URL prefix) to cell.
+def getRollupCube(sessions_RDD, bucket_mins, p, bPrefix):
+
+    return sessions_RDD.mapPartitions(lambda it: getPartitionCube(it, bucket_mins, p, bPrefix)) \
+                       .reduceByKey(mergeCells) \
+                       .collectAsMap()
+
+
+# ----------------------------------------------------------------------
+# Purpose: Roll a cube up to coarser buckets.
+# Input: Dict of the cube and the coarser bucket size in mins (a multiple
+#   of the bucket size of the cube).
+# Output: Dict of the cube with the coarser buckets. Cells are merged in
+#   bucket order, so the sums do not depend on the order of the dict.
+def rollupCube(dcube, bucket_mins):
+
+    drollup = {}
+    for bucket, prefix in sorted(dcube):
+        cell = dcube[(bucket, prefix)]
+        key = (plc.getBucketStart(bucket, bucket_mins), prefix)
+        drollup[key] = mergeCells(drollup[key], cell) if key in drollup else cell
+    return drollup
+
+
+# ----------------------------------------------------------------------
+# Purpose: Get the metrics of the cells of a cube.
+# Input: Dict of the cube.
+# Output: List of ('bucket start' 'URL prefix', [sessions, sum of session
+#   times, avg session time, active users, unique URLs]) tuples in bucket
+#   and prefix order.
+def getRollupRows(dcube):
+
+    lrows = []
+    for bucket, prefix in sorted(dcube):
+        num_sessions, session_time, users_sketch, urls_sketch = dcube[(bucket, prefix)]
+        lrows.append((bucket.strftime('%Y-%m-%dT%H:%M') + ' ' + prefix,
+                      [num_sessions, session_time, session_time / num_sessions if num_sessions else 0.0,
+                       url_sketch.getSketchCount(users_sketch), url_sketch.getSketchCount(urls_sketch)]))
+    return lrows
+
+
+# ----------------------------------------------------------------------
+# Purpose: Parse the list of rollup bucket sizes.
+# Input: Comma separated string of bucket sizes in mins.
+# Output: Sorted list of the distinct sizes as ints. Raises ValueError if
+#   a size is not positive or not a multiple of the finest size.
+def getRollupMins(rollup_mins):
+
+    lmins = sorted(set(int(mins) for mins in rollup_mins.split(',')))
+    if lmins[0] <= 0 or any(mins % lmins[0] for mins in lmins):
+        raise ValueError('Rollup bucket sizes must be positive multiples of the finest size: ' + rollup_mins)
+    return lmins
+
+
+# ----------------------------------------------------------------------
+# Purpose: Get the name of the output file of a bucket size.
+# Input: Name of the rollup output file and the bucket size in mins.
+# Output: File name with the size added before the extension, e.g.
+#   Session_Rollups_60min.txt
+def getRollupFileName(filname, bucket_mins):
+
+    base, ext = os.path.splitext(filname)
+    return base + '_%dmin' % bucket_mins + ext
+
+
+# ----------------------------------------------------------------------
+# Purpose: Save a cube so it can be rolled up later without the sessions.
+# Input: Full path of the cube file, dict of the cube and its bucket size
+#   in mins.
+# Output: None
+def saveCube(filname, dcube, bucket_mins):
+
+    f = open(filname, 'wb')
+    cPickle.dump({'bucket_mins': bucket_mins, 'cells': dcube}, f, cPickle.HIGHEST_PROTOCOL)
+    f.close()
+
+
+# ----------------------------------------------------------------------
+# Purpose: Load a cube saved by saveCube().
+# Input: Full path of the cube file.
+# Output: Tuple of the dict of the cube and its bucket size in mins.
+def loadCube(filname):
+
+    f = open(filname, 'rb')
+    dsaved = cPickle.load(f)
+    f.close()
+    return dsaved['cells'], dsaved['bucket_mins']
+
+
+# ----------------------------------------------------------------------
+# Purpose: Write the rows of a cube to a rollup output file.
+# Input: Full path of the output file and dict of the cube.
+# Output: None
+def writeRollup(filname, dcube):
+    plc.outputLocal(filname, getRollupRows(dcube))
+
+
+# ----------------------------------------------------------------------
+# Purpose: Save the cube of the finest bucket size and write the rollup
+#   of every bucket size, each rolled up from the cube.
+# Input: Dict of the cube, sorted list of bucket sizes (the first being
+#   the bucket size of the cube), parsed command line args and output dir.
+# Output: None. Totals of the coarsest rollup are logged.
+def outputRollups(dcube, lrollup_mins, args, out_dir):
+
+    saveCube(out_dir + args.rollup_cube_file, dcube, lrollup_mins[0])
+    for bucket_mins in lrollup_mins:
+        drollup = dcube if bucket_mins == lrollup_mins[0] else rollupCube(dcube, bucket_mins)
+        writeRollup(out_dir + getRollupFileName(args.rollup_file, bucket_mins), drollup)
+        plc.log.info('Wrote ' + str(len(drollup)) + ' rollup cells of ' + str(bucket_mins) + ' min buckets')
+
+#------------------------------------------------------------------------
+
+
+if __name__ == '__main__':
+
+    # e.g. run as "python rollups.py --cube_file /home/jphilip/PyCharms/Projects/Proj1/out/Session_Rollups.pkl --bucket_mins 1440"
+
+    parser = argparse.ArgumentParser(description='Roll up the session cube saved with --rollup_mins to coarser time buckets.')
+    parser.add_argument('--cube_file', dest='cube_file', type=str, required=True, help='Full path of the session cube (rollup_cube_file) written with --rollup_mins.')
+    parser.add_argument('--bucket_mins', dest='bucket_mins', type=int, required=True, help='Bucket size in mins to roll up to. Must be a multiple of the bucket size of the cube.')
+    parser.add_argument('--out_file', dest='out_file', type=str, default=None, help='Full path of the rollup output file. Defaults to the cube file with the bucket size appended and a .txt extension.')
+
+    args = parser.parse_args()
+
+    dcube, cube_mins = loadCube(args.cube_file)
+    if args.bucket_mins % cube_mins:
+        parser.error('bucket_mins must be a multiple of the bucket size of the cube (' + str(cube_mins) + ' mins)')
+    out_file = args.out_file or getRollupFileName(os.path.splitext(args.cube_file)[0] + '.txt', args.bucket_mins)
+    drollup = rollupCube(dcube, args.bucket_mins)
+    writeRollup(out_file, drollup)
+    print 'Wrote ' + str(len(drollup)) + ' rollup cells of ' + str(args.bucket_mins) + ' min buckets to ' + out_file
@@ -0,0 +1,229 @@
+# PaytmLabs/WeblogChallenge
+#
+# Per IP index of the sessionized output file of PaytmLabs_challenge.py.
+# Built by calling: bin/spark-submit <working_dir_path>/code/PaytmLabs_challenge.py --session_index <optional params>
+# Queried by calling: python <working_dir_path>/code/session_index.py --index_file <out_dir>/Sessionized_Customer_File.txt.idx \
+#                         --ip <IP> <optional params>
+#
+# Finding what one customer did means scanning the whole (multi-GB) sessionized output file. With
+# --session_index the sessions are written with their byte offsets tracked, in the same pass as the
+# output (by the executors for the merged and parts output writers), and the runs of consecutive
+# sessions of each IP are saved as an (IP, file, offset, length, number of sessions) table sorted and
+# indexed by IP in a SQLite database next to the output file (<output file>.idx). A lookup reads only
+# the byte ranges of the IP's runs, so it takes milliseconds whatever the size of the output.
+# The sessions of an IP are usually one run; hot IPs split into time ranges (--skew_mode split) may
+# have several. Only text output is indexed -- Parquet output is already sorted by IP within each file
+# and can be filtered by IP.
+###########################################################################################################################
+
+
+import argparse
+import ast
+import os
+import shutil
+import sqlite3
+import sys
+import time
+from datetime import datetime
+
+import PaytmLabs_challenge as plc
+
+
+# suffix of the index file added to the name of the sessionized output file
+INDEX_SUFFIX = '.idx'
+
+
+# ----------------------------------------------------------------------
+# Purpose: Write a session as a line of the sessionized output file and
+#   track the run of sessions of its IP it belongs to.
+# Input: Open output file (binary mode), session tuple of (IP, session)
+#   and the list of runs of the file so far.
+# Output: None. The run list is updated in place: each run is a list of
+#   IP, byte offset, length in bytes and number of sessions.
+def writeIndexedLine(f, ele, lruns):
+
+    lin = plc.getOutputLine(ele)
+    if isinstance(lin, unicode):
+        lin = lin.encode('utf-8')
+    if lruns and lruns[-1][0] == ele[0]:
+        lruns[-1][2] += len(lin)
+        lruns[-1][3] += 1
+    else:
+        lruns.append([ele[0], f.tell(), len(lin), 1])
+    f.write(lin)
+
+
+# ----------------------------------------------------------------------
+# Purpose: Write sessions to a file, tracking the runs of each IP.
+# Input: Open output file (binary mode) and iterable of sessions.
+# Output: List of runs (see writeIndexedLine()).
+def writeIndexedLines(f, it):
+
+    lruns = []
+    for ele in it:
+        writeIndexedLine(f, ele, lruns)
+    return lruns
+
+
+# ----------------------------------------------------------------------
+# Purpose: Write a partition of sessions as a part file, in the same
+#   format as saveAsTextFile() in outputRDD().
+# Input: Partition index, iterator over the partition and the dir of the
+#   part files.
+# Output: List with one tuple of the part file path and its runs.
+def writeIndexedPart(idx, it, parts_dir):
+
+    part_file = os.path.join(parts_dir, 'part-%05d' % idx)
+    f = open(part_file, 'wb')
+    lruns = writeIndexedLines(f, it)
+    f.close()
+    return [(part_file, lruns)]
+
+
+# ----------------------------------------------------------------------
+# Purpose: Get the index entries of part files concatenated (in order)
+#   into a single output file. Must be called before the part files are
+#   removed.
+# Input: List of tuples of part file path and its runs, in the order the
+#   parts are concatenated, and the name of the output file.
+# Output: List of (IP, file, offset, length, number of sessions) tuples.
+def getMergedIndexEntries(lpart_runs, filname):
+
+    lentries = []
+    base_offset = 0
+    for part_file, lruns in lpart_runs:
+        for cid, offset, length, num_sessions in lruns:
+            lentries.append((cid, os.path.basename(filname), base_offset + offset, length, num_sessions))
+        base_offset += os.path.getsize(part_file)
+    return lentries
+
+
+# ----------------------------------------------------------------------
+# Purpose: Save the index entries as a SQLite table sorted and indexed by
+#   IP, replacing an existing index.
+# Input: Full path of the index file and list of index entries, with
+#   file names relative to the dir of the index.
+# Output: None
+def saveSessionIndex(index_file, lentries):
+
+    tmp_file = index_file + '.tmp'
+    if os.path.exists(tmp_file):
+        os.remove(tmp_file)
+    conn = sqlite3.connect(tmp_file)
+    conn.execute('CREATE TABLE sessions (cid TEXT, file TEXT, offset INTEGER, length INTEGER, num_sessions INTEGER)')
+    conn.executemany('INSERT INTO sessions VALUES (?, ?, ?, ?, ?)', sorted(lentries))
+    conn.execute('CREATE INDEX sessions_cid ON sessions (cid)')
+    conn.commit()
+    conn.close()
+    os.rename(tmp_file, index_file)
+    plc.log.info('Wrote session index of ' + str(len(lentries)) + ' runs to ' + index_file)
+
+
+# ----------------------------------------------------------------------
+# Purpose: Write a RDD of sessions to the sessionized output file as in
+#   outputRDD(), and build its index in the same pass.
+# Input: Filename to save to, a RDD of sessions and the output writer
+#   (see outputRDD()). The part files are written by the executors
+#   directly, so the merged and parts writers need an output dir shared
+#   with the executors (e.g. a local master).
+# Output: None
+def outputIndexedRDD(filname, rdd, output_writer):
+
+    if output_writer == 'collect':
+        f = open(filname, 'wb')
+        lruns = writeIndexedLines(f, rdd.collect())
+        f.close()
+        lentries = [(cid, os.path.basename(filname), offset, length, num_sessions)
+                    for cid, offset, length, num_sessions in lruns]
+    else:
+        parts_dir = filname + '.parts'
+        shutil.rmtree(parts_dir, ignore_errors=True)
+        os.makedirs(parts_dir)
+        rdd.context.addPyFile(__file__.replace('.pyc', '.py'))
+        lpart_runs = sorted(rdd.mapPartitionsWithIndex(lambda idx, it: writeIndexedPart(idx, it, parts_dir)).collect())
+        if output_writer == 'merged':
+            lentries = getMergedIndexEntries(lpart_runs, filname)
+            plc.mergeOutputParts(parts_dir, filname)
+        else:
+            lentries = [(cid, os.path.join(os.path.basename(parts_dir), os.path.basename(part_file)), offset, length, num_sessions)
+                        for part_file, lruns in lpart_runs for cid, offset, length, num_sessions in lruns]
+    saveSessionIndex(filname + INDEX_SUFFIX, lentries)
+
+
+# ----------------------------------------------------------------------
+# Purpose: Convert a timestamp of a session line back to a datetime.
+# Input: AST node of the timestamp: a datetime.datetime(...) call, wrapped
+#   in a list for all but a customer's first page visit.
+# Output: Python datetime (without its time zone).
+def getNodeTimestamp(node):
+
+    if isinstance(node, ast.List):
+        node = node.elts[0]
+    return datetime(*[ast.literal_eval(arg) for arg in node.args])
+
+
+# ----------------------------------------------------------------------
+# Purpose: Parse a line of the sessionized output file. The line is
+#   parsed as a Python expression but never evaluated, so it is safe for
+#   any URLs in the log.
+# Input: A line of the sessionized output file.
+# Output: Tuple of IP, list of durations, list of urls, and the start and
+#   end timestamps of the session.
+def parseSessionLine(lin):
+
+    cid, dat = lin.rstrip('\n').split(' ', 1)
+    ldurs_node, lurls_node, lts_node = ast.parse(dat, mode='eval').body.elts
+    return (cid, ast.literal_eval(ldurs_node), ast.literal_eval(lurls_node),
+            getNodeTimestamp(lts_node.elts[0]), getNodeTimestamp(lts_node.elts[-1]))
+
+
+# ----------------------------------------------------------------------
+# Purpose: Look up the sessions of an IP.
+# Input: Full path of the index file and the IP.
+# Output: List of sessions from parseSessionLine(), in timestamp order.
+def lookupSessions(index_file, cid):
+
+    index_dir = os.path.dirname(os.path.abspath(index_file))
+    conn = sqlite3.connect(index_file)
+    lrows = conn.execute('SELECT file, offset, length FROM sessions WHERE cid = ?', (cid,)).fetchall()
+    conn.close()
+    lsessions = []
+    for filname, offset, length in lrows:
+        f = open(os.path.join(index_dir, filname), 'rb')
+        f.seek(offset)
+        dat = f.read(length)
+        f.close()
+        lsessions.extend(parseSessionLine(lin) for lin in dat.splitlines())
+    return sorted(lsessions, key=lambda sess: sess[3])
+
+#------------------------------------------------------------------------
+
+
+if __name__ == '__main__':
+
+    # e.g. run as "python session_index.py --index_file /home/jphilip/PyCharms/Projects/Proj1/out/Sessionized_Customer_File.txt.idx --ip 1.186.41.1"
+
+    parser = argparse.ArgumentParser(description='Look up the sessions of a customer IP in the session index.')
+    parser.add_argument('--index_file', dest='index_file', type=str, required=True, help='Full path of the session index (<sessionized output file>.idx) written with --session_index.')
+    parser.add_argument('--ip', dest='ip', type=str, required=True, help='Customer IP to look up.')
+    parser.add_argument('--show_urls', action='store_true', default=False, help='Also print the unique URLs visited in each session.')
+
+    args = parser.parse_args()
+
+    t_start = time.time()
+    lsessions = lookupSessions(args.index_file, args.ip)
+    elapsed_ms = (time.time() - t_start) * 1000.0
+
+    if not lsessions:
+        print 'No sessions found for ' + args.ip + ' (%.1f ms).' % elapsed_ms
+        sys.exit(1)
+    print '%-26s %-26s %14s %7s %12s' % ('Session Start', 'Session End', 'Duration (min)', 'Visits', 'Unique URLs')
+    for cid, ldurs, lurls, start_dt, end_dt in lsessions:
+        print '%-26s %-26s %14.2f %7d %12d' % (start_dt, end_dt, sum(ldurs), len(lurls), len(set(lurls)))
+        if args.show_urls:
+            for url in sorted(set(lurls)):
+                print '    ' + (url.encode('utf-8') if isinstance(url, unicode) else url)
+    print '\n' + args.ip + ': ' + str(len(lsessions)) + ' sessions, total duration (mins): ' + \
+          str(sum(sum(ldurs) for cid, ldurs, lurls, start_dt, end_dt in lsessions)) + \
+          ', unique URLs across sessions: ' + str(len(set(url for sess in lsessions for url in sess[2]))) + \
+          ' (looked up in %.1f ms)' % elapsed_ms
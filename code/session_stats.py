@@ -0,0 +1,157 @@
+# PaytmLabs/WeblogChallenge
+#
+# Global session time stats of PaytmLabs_challenge.py (sum, count, mean and quantiles).
+#
+# The sum of all session times and the number of sessions used to be added to accumulators inside a
+# map (getSessionTime()). Spark only applies accumulator updates made in actions exactly once, so a
+# task that is retried, speculatively run twice, or recomputed because its lineage was not persisted
+# adds its sessions again and the average drifts with no error shown. Instead the stats are computed
+# as a reduction over the session times: each partition builds the stats of its sessions, and the
+# partition stats are merged in partition order (RDD.reduce()), so the result is the same however
+# often a task is run. The quantiles come from a histogram of log spaced buckets, where bucket i holds
+# the times in (gamma^(i-1), gamma^i] for gamma = (1 + e) / (1 - e), so the quantiles are within a
+# relative error e (--quantile_error) of the true value, with zero length sessions (a single page
+# visit) counted in a bucket of their own. Histograms are merged by adding their bucket counts, so
+# they are mergeable and their quantiles do not depend on the partitioning or merge order.
+###########################################################################################################################
+
+
+import math
+
+
+# ----------------------------------------------------------------------
+# Purpose: Start the stats of a set of session times.
+# Input: Relative error of the quantiles (e.g. 0.01 for 1%).
+# Output: Stats as a list of the relative error, number of sessions, sum
+#   of session times, min and max session time, number of zero length
+#   sessions and dict of histogram bucket index to number of sessions.
+def newDurationStats(rel_error):
+    return [rel_error, 0, 0.0, None, None, 0, {}]
+
+
+# ----------------------------------------------------------------------
+# Purpose: Get the log base of the histogram buckets for an error bound.
+# Input: Relative error of the quantiles.
+# Output: Float gamma, the ratio of the bounds of each bucket.
+def getBucketBase(rel_error):
+    return (1.0 + rel_error) / (1.0 - rel_error)
+
+
+# ----------------------------------------------------------------------
+# Purpose: Add a session time to the stats.
+# Input: Stats from newDurationStats() and the session time in mins.
+# Output: The stats, updated in place.
+def addDuration(dstats, dur):
+
+    dstats[1] += 1
+    dstats[2] += dur
+    dstats[3] = dur if dstats[3] is None else min(dstats[3], dur)
+    dstats[4] = dur if dstats[4] is None else max(dstats[4], dur)
+    if dur <= 0:
+        dstats[5] += 1
+    else:
+        ind = int(math.ceil(math.log(dur, getBucketBase(dstats[0]))))
+        dstats[6][ind] = dstats[6].get(ind, 0) + 1
+    return dstats
+
+
+# ----------------------------------------------------------------------
+# Purpose: Build the stats of a partition of session times.
+# Input: Iterator over session times and the relative error.
+# Output: List with the stats of the partition.
+def getPartitionStats(it, rel_error):
+
+    dstats = newDurationStats(rel_error)
+    for dur in it:
+        addDuration(dstats, dur)
+    return [dstats]
+
+
+# ----------------------------------------------------------------------
+# Purpose: Merge two stats (e.g. of two partitions).
+# Input: Two stats from newDurationStats() with the same relative error.
+# Output: New stats of the session times of both.
+def mergeDurationStats(a, b):
+
+    dhist = dict(a[6])
+    for ind, num in b[6].iteritems():
+        dhist[ind] = dhist.get(ind, 0) + num
+    lmins = [x for x in (a[3], b[3]) if x is not None]
+    lmaxs = [x for x in (a[4], b[4]) if x is not None]
+    return [a[0], a[1] + b[1], a[2] + b[2], min(lmins) if lmins else None, max(lmaxs) if lmaxs else None,
+            a[5] + b[5], dhist]
+
+
+# ----------------------------------------------------------------------
+# Purpose: Compute the stats of the session times as a reduction. Each
+#   partition's stats are built on its own and merged in partition order,
+#   so retried or recomputed tasks do not change the result.
+# Input: RDD of session times in mins and the relative error.
+# Output: Stats of all the session times.
+def getDurationStats(durations_RDD, rel_error):
+
+    return durations_RDD.mapPartitions(lambda it: getPartitionStats(it, rel_error)) \
+                        .reduce(mergeDurationStats)
+
+
+# ----------------------------------------------------------------------
+# Purpose: Estimate a quantile of the session times.
+# Input: Stats and the quantile (0 to 1).
+# Output: Float session time in mins, within the relative error of the
+#   session time of that rank. None if there are no sessions.
+def getQuantile(dstats, q):
+
+    rel_error, num, total, min_dur, max_dur, num_zeros, dhist = dstats
+    if num == 0:
+        return None
+    rank = int(q * (num - 1))
+    if rank < num_zeros:
+        return 0.0
+    gamma = getBucketBase(rel_error)
+    cum = num_zeros
+    for ind in sorted(dhist):
+        cum += dhist[ind]
+        if rank < cum:
+            # midpoint (in relative terms) of the bucket, kept within the range seen
+            return min(max(2.0 * gamma ** ind / (gamma + 1.0), min_dur), max_dur)
+    return max_dur
+
+
+# ----------------------------------------------------------------------
+# Purpose: Parse the list of quantiles to report.
+# Input: Comma separated string of quantiles (e.g. 0.5,0.9,0.99).
+# Output: Sorted list of the quantiles as floats. Raises ValueError if a
+#   quantile is not in 0 to 1.
+def getQuantiles(quantiles):
+
+    lquantiles = sorted(set(float(q) for q in quantiles.split(',')))
+    if lquantiles[0] < 0 or lquantiles[-1] > 1:
+        raise ValueError('Quantiles must be in 0 to 1: ' + quantiles)
+    return lquantiles
+
+
+# ----------------------------------------------------------------------
+# Purpose: Get the sum, count, mean and quantiles of the session times.
+# Input: Stats and the list of quantiles.
+# Output: Tuple of the sum of session times, number of sessions, mean
+#   session time and list of (quantile, session time) tuples.
+def getSummary(dstats, lquantiles):
+
+    num, total = dstats[1], dstats[2]
+    return total, num, total / num if num else 0.0, [(q, getQuantile(dstats, q)) for q in lquantiles]
+
+
+# ----------------------------------------------------------------------
+# Purpose: Print the sum, count, mean and quantiles of the session times
+#   to std output, as the engines print the session totals.
+# Input: Stats and the list of quantiles.
+# Output: Tuple of the sum of session times and number of sessions.
+def printSummary(dstats, lquantiles):
+
+    total, num, mean, lquantile_durs = getSummary(dstats, lquantiles)
+    print '\n\nSum of All Session Times (mins): ', str(total)
+    print 'Total Number of Sessions: ', str(num)
+    print 'Avg Session Time (mins): ', str(mean)
+    print 'Session Time Quantiles (mins, within %g%%): ' % (dstats[0] * 100) + \
+          ', '.join('p%g %.4f' % (q * 100, dur) for q, dur in lquantile_durs if dur is not None), '\n'
+    return total, num
@@ -0,0 +1,193 @@
+# PaytmLabs/WeblogChallenge
+#
+# Per stage metrics of the RDD engine of PaytmLabs_challenge.py.
+# Enabled by calling: bin/spark-submit <working_dir_path>/code/PaytmLabs_challenge.py --metrics_file <file> <optional params>
+#
+# RDD transformations are lazy, so the log messages of the RDD engine are logged when each RDD is
+# defined rather than when its work is done. With metrics enabled each logical stage of the engine
+# (parse, sort, durations, window heuristic, sessionize, aggregate and each output) is persisted and
+# run on its own, inside a Spark job group named after the stage, and its wall time, records out and
+# the driver's peak memory are recorded. When the run is done the Spark status REST API (the Spark UI)
+# is asked for the input, shuffle and spill bytes and peak execution memory of the jobs of each job
+# group, and the metrics of the run are written as a JSON report.
+# With a baseline report given, stages that take longer than the baseline by more than a tolerance
+# are flagged as regressions in the report and on std output.
+# Running each stage on its own adds a count of each stage's output, so timings with metrics enabled
+# are somewhat higher than without.
+###########################################################################################################################
+
+
+import json
+import resource
+import time
+import urllib2
+
+import PaytmLabs_challenge as plc
+
+
+# metrics of a Spark stage (as returned by the status REST API) summed over the jobs of a logical stage
+SPARK_STAGE_METRICS = ['executorRunTime', 'inputBytes', 'inputRecords', 'outputBytes', 'shuffleReadBytes',
+                       'shuffleReadRecords', 'shuffleWriteBytes', 'shuffleWriteRecords', 'memoryBytesSpilled',
+                       'diskBytesSpilled', 'peakExecutionMemory']
+
+# stages faster than this many secs are never flagged as regressions (too noisy to compare)
+REGRESSION_MIN_SECS = 1.0
+
+
+# ----------------------------------------------------------------------
+# Purpose: Start collecting the metrics of a run.
+# Input: SparkContext and parsed command line args.
+# Output: Dict holding the run info and the list of stage metrics, to be
+#   passed to the other functions of this module.
+def newRunMetrics(sc, args):
+
+    return {'sc': sc,
+            'run': {'infile': args.infile, 'per_ip_mode': args.per_ip_mode, 'master': sc.master,
+                    'start_time': time.time()},
+            'stages': []}
+
+
+# ----------------------------------------------------------------------
+# Purpose: Get the peak memory of the driver so far.
+# Input: None
+# Output: Max RSS of the driver (Python) process in MB.
+def getDriverMaxRssMB():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+# ----------------------------------------------------------------------
+# Purpose: Run a logical stage in its own job group and record its wall
+#   time. Does nothing but call the function if metrics are disabled.
+# Input: Dict from newRunMetrics() (None if metrics are disabled), stage
+#   name, function running the stage's actions and the name of the
+#   stage whose output is this stage's input (optional).
+# Output: The return value of the function. It is recorded as the
+#   records out of the stage if it is a number of records.
+def timeStage(dmetrics, name, fn, input_stage=None):
+
+    if dmetrics is None:
+        return fn()
+    sc = dmetrics['sc']
+    sc.setJobGroup(name, 'Stage ' + name)
+    t_start = time.time()
+    result = fn()
+    secs = time.time() - t_start
+    sc.setLocalProperty('spark.jobGroup.id', None)
+
+    records_out = result if isinstance(result, (int, long)) and not isinstance(result, bool) else None
+    records_in = None
+    for dstage in dmetrics['stages']:
+        if dstage['name'] == input_stage:
+            records_in = dstage['records_out']
+    dmetrics['stages'].append({'name': name, 'secs': secs, 'records_in': records_in, 'records_out': records_out,
+                               'records_per_sec': records_out / secs if records_out is not None and secs > 0 else None,
+                               'driver_max_rss_mb': getDriverMaxRssMB()})
+    plc.log.info('Stage ' + name + ' done in %.2f secs' % secs +
+                 (' (' + str(records_out) + ' records)' if records_out is not None else ''))
+    return result
+
+
+# ----------------------------------------------------------------------
+# Purpose: Persist a RDD and run it as a logical stage (see timeStage()).
+#   Does nothing if metrics are disabled, so the RDD is only computed
+#   when the engine needs it.
+# Input: Dict from newRunMetrics() (or None), stage name, RDD of the
+#   stage's output and the name of the stage its input comes from.
+# Output: None
+def runStage(dmetrics, name, rdd, input_stage=None):
+
+    if dmetrics is None:
+        return
+    rdd.persist()
+    timeStage(dmetrics, name, rdd.count, input_stage)
+
+
+# ----------------------------------------------------------------------
+# Purpose: Add to the run info of the metrics.
+# Input: Dict from newRunMetrics() (or None) and the key and value.
+# Output: None
+def setRunInfo(dmetrics, key, value):
+
+    if dmetrics is not None:
+        dmetrics['run'][key] = value
+
+
+# ----------------------------------------------------------------------
+# Purpose: Get the Spark stage metrics of the jobs of a job group from
+#   the status REST API.
+# Input: SparkContext and job group name.
+# Output: Dict of the SPARK_STAGE_METRICS summed over all attempts of
+#   all Spark stages of the jobs, or None if they are not available
+#   (e.g. the Spark UI is disabled).
+def getJobGroupMetrics(sc, group):
+
+    try:
+        tracker = sc.statusTracker()
+        api_url = sc.uiWebUrl + '/api/v1/applications/' + sc.applicationId + '/stages/'
+        dspark = dict((key, 0) for key in SPARK_STAGE_METRICS)
+        for job_id in tracker.getJobIdsForGroup(group):
+            job_info = tracker.getJobInfo(job_id)
+            if job_info is None:
+                continue
+            for stage_id in job_info.stageIds:
+                for dattempt in json.load(urllib2.urlopen(api_url + str(stage_id), timeout=10)):
+                    if dattempt.get('status') == 'SKIPPED':
+                        continue
+                    for key in SPARK_STAGE_METRICS:
+                        dspark[key] += dattempt.get(key, 0) or 0
+        return dspark
+    except:
+        return None
+
+
+# ----------------------------------------------------------------------
+# Purpose: Compare the stage timings of a run against a baseline report.
+# Input: List of stage metrics dicts, full path of the baseline JSON
+#   report and relative tolerance (e.g. 0.2 for 20% slower).
+# Output: List of dicts of the stages that took longer than the baseline
+#   by more than the tolerance (and REGRESSION_MIN_SECS).
+def getRegressions(lstages, baseline_file, tolerance):
+
+    f = open(baseline_file, 'r')
+    dbaseline = dict((dstage['name'], dstage) for dstage in json.load(f)['stages'])
+    f.close()
+    lregressions = []
+    for dstage in lstages:
+        dbase = dbaseline.get(dstage['name'])
+        if dbase is None:
+            continue
+        if dstage['secs'] > dbase['secs'] * (1 + tolerance) and dstage['secs'] - dbase['secs'] > REGRESSION_MIN_SECS:
+            lregressions.append({'name': dstage['name'], 'secs': dstage['secs'], 'baseline_secs': dbase['secs'],
+                                 'slowdown': dstage['secs'] / max(dbase['secs'], 1e-6)})
+    return lregressions
+
+
+# ----------------------------------------------------------------------
+# Purpose: Finish the metrics of a run and write the JSON report.
+# Input: Dict from newRunMetrics() (or None), full path of the report
+#   file, full path of a baseline report to check for regressions
+#   against (or None) and the regression tolerance.
+# Output: None. Regressions are also printed to std output.
+def writeReport(dmetrics, metrics_file, baseline_file, tolerance):
+
+    if dmetrics is None:
+        return
+    sc = dmetrics['sc']
+    for dstage in dmetrics['stages']:
+        dstage['spark'] = getJobGroupMetrics(sc, dstage['name'])
+    drun = dmetrics['run']
+    drun['total_secs'] = time.time() - drun['start_time']
+    drun['driver_max_rss_mb'] = getDriverMaxRssMB()
+    dreport = {'run': drun, 'stages': dmetrics['stages']}
+
+    if baseline_file is not None:
+        dreport['baseline'] = baseline_file
+        dreport['regressions'] = getRegressions(dmetrics['stages'], baseline_file, tolerance)
+        for dreg in dreport['regressions']:
+            print 'Regression in stage %s: %.2f secs vs %.2f secs in baseline (%.2fx)' % \
+                  (dreg['name'], dreg['secs'], dreg['baseline_secs'], dreg['slowdown'])
+
+    f = open(metrics_file, 'w')
+    json.dump(dreport, f, indent=1, sort_keys=True)
+    f.close()
+    plc.log.info('Wrote stage metrics to ' + metrics_file)
@@ -0,0 +1,220 @@
+# PaytmLabs/WeblogChallenge
+#
+# Streaming sessionization for PaytmLabs_challenge.py.
+# Selected by calling: bin/spark-submit <working_dir_path>/code/PaytmLabs_challenge.py --engine stream \
+#                          --stream_dir <dir log files arrive in> <optional params>
+#
+# A Structured Streaming file source tails the stream dir and each micro-batch of newly arrived log
+# files is sessionized on top of the open session of each customer, with the same steps as the
+# incremental engine (see code/incremental_engine.py) but with the open sessions and engagement totals
+# kept in memory between micro-batches instead of in a state store:
+# 1) The event-time watermark is the latest page visit timestamp seen less --stream_lateness_mins.
+#    Page visits older than the watermark of the previous micro-batch are late and dropped, since the
+#    session they belong to may already have been emitted. Later ones are added to their customer's
+#    open session as in a batch run, even if they come before its start.
+# 2) A customer's open session times out and is closed once the watermark is at least a session period
+#    past its last page visit, since no on time page visit can extend it any more.
+# 3) Closed sessions are appended to the finalized sessions output file and the customer duration and
+#    engagement output files are rewritten from the rolling totals after every micro-batch.
+# 4) The latency from each log file arriving in the stream dir (its modification time) to the end of
+#    the micro-batch that emitted its sessions is appended to the stream latency output file.
+# 5) With --top_k_window_mins the total session time of each customer in each time window (by the
+#    window the session starts in) is added up from the closed sessions, and a window's top K most
+#    engaged customers are appended to --top_k_window_file as soon as no more sessions can start in
+#    it, i.e. it ends before both the watermark and the start of the earliest open session.
+# When the query stops (after --stream_timeout_secs, if set) all remaining open sessions are closed
+# and emitted, so replaying a log through the stream dir gives the same sessions as a batch run.
+###########################################################################################################################
+
+
+import os
+import time
+from datetime import timedelta
+from urlparse import urlparse
+
+from pyspark.rdd import portable_hash
+from pyspark.sql import SparkSession
+import pyspark.sql.functions as F
+
+import PaytmLabs_challenge as plc
+import incremental_engine as ie
+import top_k
+
+
+# ----------------------------------------------------------------------
+# Purpose: Get the arrival time of a log file in the stream dir.
+# Input: File URI as given by input_file_name()
+# Output: Modification time of the file in secs since the epoch, or
+#   None if it is not a local file that still exists.
+def getArrivalTime(file_uri):
+
+    try:
+        return os.path.getmtime(urlparse(file_uri).path)
+    except:
+        return None
+
+
+# ----------------------------------------------------------------------
+# Purpose: Sessionize one micro-batch of newly arrived log lines and
+#   write the closed sessions, updated totals and latency.
+# Input: SparkContext, parsed command line args, output dir, dict of the
+#   stream state (open sessions and totals RDDs, watermark and counts)
+#   carried between micro-batches, and the micro-batch DataFrame of lines
+#   with the file each came from and its id.
+# Output: None
+def processStreamBatch(sc, args, out_dir, dstream_state, batch_df, batch_id):
+
+    lfiles = [row.path for row in batch_df.select('path').distinct().collect()]
+    if not lfiles:
+        return
+    session_window = args.session_period
+
+    parsed_RDD = batch_df.rdd.map(lambda row: ie.getVisit(row.value))
+    visits_RDD, num_malformed = plc.getValidLines(parsed_RDD)
+
+    lmax_ts = visits_RDD.map(lambda (key, url): key[1]).top(1)
+    dstream_state['num_malformed'] += num_malformed
+    prev_watermark = dstream_state['watermark']
+    if prev_watermark is not None:
+        num_late = visits_RDD.filter(lambda (key, url): key[1] < prev_watermark).count()
+        visits_RDD = visits_RDD.filter(lambda (key, url): key[1] >= prev_watermark)
+    else:
+        num_late = 0
+    if lmax_ts and (dstream_state['max_ts'] is None or lmax_ts[0] > dstream_state['max_ts']):
+        dstream_state['max_ts'] = lmax_ts[0]
+    if dstream_state['max_ts'] is None:
+        # nothing parsed yet, so no sessions can be started or closed
+        return
+    watermark = dstream_state['max_ts'] - timedelta(minutes=args.stream_lateness_mins)
+    dstream_state['watermark'] = watermark
+
+    lclosed, num_late_sessions = closeStreamSessions(sc, args, dstream_state, visits_RDD, session_window, watermark,
+                                                       prev_watermark)
+    ie.writeSessionOutputs(lclosed, dstream_state['totals_RDD'], args, out_dir)
+    if args.top_k_window_mins:
+        writeFinalWindows(args, out_dir, dstream_state, lclosed, watermark)
+    parsed_RDD.unpersist()
+
+    t_emit = time.time()
+    llatency = [t_emit - t_arrive for t_arrive in map(getArrivalTime, lfiles) if t_arrive is not None]
+    f = open(out_dir + args.stream_latency_file, 'a')
+    f.write(plc.getOutputLine((str(batch_id), [len(lfiles), len(lclosed), min(llatency) if llatency else None,
+                                                max(llatency) if llatency else None])))
+    f.close()
+
+    dstream_state['num_late'] += num_late + num_late_sessions
+    plc.log.info('Micro-batch ' + str(batch_id) + ': ' + str(len(lfiles)) + ' file(s), ' + str(len(lclosed)) +
+                 ' session(s) closed, ' + str(num_late + num_late_sessions) + ' late page visit(s), watermark ' +
+                 str(watermark) + (', max latency (s): %.2f' % max(llatency) if llatency else ''))
+
+
+# ----------------------------------------------------------------------
+# Purpose: Sessionize page visits on top of the open sessions, close the
+#   sessions that timed out and update the stream state.
+# Input: SparkContext, parsed command line args, dict of the stream
+#   state, RDD of page visit records from getVisit() (may be empty), the
+#   session window in mins, and the watermark and the watermark of the
+#   previous micro-batch (None if there is none) as Python datetimes.
+# Output: Tuple of the list of (IP, closed session) tuples and the number
+#   of late page visits dropped by getIncrementalSessions().
+def closeStreamSessions(sc, args, dstream_state, visits_RDD, session_window, watermark, prev_watermark):
+
+    events_RDD = visits_RDD
+    if dstream_state['open_RDD'] is not None:
+        events_RDD = events_RDD.union(dstream_state['open_RDD'].map(lambda (cid, state): ((cid, ie.STATE_SORT_TS, ie.REC_STATE), state)))
+    sessions_RDD = events_RDD.repartitionAndSortWithinPartitions(args.num_partitions,
+                                                                 partitionFunc=lambda key: portable_hash(key[0])) \
+                             .mapPartitions(lambda it: ie.getIncrementalSessions(it, session_window, watermark, prev_watermark))
+    sessions_RDD.persist()
+
+    # truncate the lineage of the state carried to the next micro-batch
+    open_RDD = sessions_RDD.filter(lambda (tag, cid, val): tag == ie.TAG_OPEN).map(lambda (tag, cid, val): (cid, val))
+    open_RDD.localCheckpoint()
+    open_RDD.count()
+    closed_RDD = sessions_RDD.filter(lambda (tag, cid, val): tag == ie.TAG_CLOSED).map(lambda (tag, cid, val): (cid, val))
+    totals_RDD = ie.getTotalsRDD(closed_RDD, dstream_state['totals_RDD'])
+    totals_RDD.localCheckpoint()
+    totals_RDD.count()
+
+    lclosed = closed_RDD.collect()
+    num_late = sessions_RDD.filter(lambda (tag, cid, val): tag == ie.TAG_LATE).count()
+    sessions_RDD.unpersist()
+
+    dstream_state['open_RDD'] = open_RDD
+    dstream_state['totals_RDD'] = totals_RDD
+    dstream_state['sum_session_time'] += sum(sess[0] for cid, sess in lclosed)
+    dstream_state['total_sessions'] += len(lclosed)
+    return lclosed, num_late
+
+
+# ----------------------------------------------------------------------
+# Purpose: Add closed sessions to the window totals and append the top K
+#   of the windows no more sessions can start in to the window top K
+#   output file.
+# Input: Parsed command line args, output dir, dict of the stream state,
+#   list of (IP, closed session) tuples and the watermark (None once the
+#   query has stopped and all sessions are closed).
+# Output: None
+def writeFinalWindows(args, out_dir, dstream_state, lclosed, watermark):
+
+    top_k.addWindowTotals(dstream_state['window_totals'], lclosed, args.top_k_window_mins)
+    final_before = watermark
+    open_RDD = dstream_state['open_RDD']
+    if watermark is not None and open_RDD is not None and not open_RDD.isEmpty():
+        final_before = min(watermark, open_RDD.map(lambda (cid, state): state[0]).min())
+    lwindow_top = top_k.popFinalWindows(dstream_state['window_totals'], final_before, args.top_k_window_mins, args.top_k)
+    if lwindow_top:
+        top_k.writeWindowTopK(out_dir + args.top_k_window_file, lwindow_top, 'a')
+
+
+# ----------------------------------------------------------------------
+# Purpose: Run the streaming sessionization until the query stops.
+# Input: SparkContext, parsed command line args and output dir.
+# Output: None. Closed sessions, rolling totals and latencies are
+#   written to the output files as micro-batches complete, and the totals
+#   printed to std output when the query stops.
+def runStreamEngine(sc, args, out_dir):
+
+    sc.addPyFile(plc.__file__.replace('.pyc', '.py'))
+    sc.addPyFile(ie.__file__.replace('.pyc', '.py'))
+    sc.addPyFile(top_k.__file__.replace('.pyc', '.py'))
+
+    if not os.path.exists(args.stream_dir):
+        os.makedirs(args.stream_dir)
+    for filname in [args.finalized_sessions_file, args.stream_latency_file, args.top_k_window_file]:
+        if os.path.exists(out_dir + filname):
+            os.remove(out_dir + filname)
+
+    spark = SparkSession(sc)
+    dstream_state = {'open_RDD': None, 'totals_RDD': None, 'max_ts': None, 'watermark': None,
+                     'sum_session_time': 0, 'total_sessions': 0, 'num_late': 0, 'num_malformed': 0,
+                     'window_totals': {}}
+
+    lines_df = spark.readStream.text(args.stream_dir).select('value', F.input_file_name().alias('path'))
+    query = lines_df.writeStream \
+                    .foreachBatch(lambda batch_df, batch_id: processStreamBatch(sc, args, out_dir, dstream_state, batch_df, batch_id)) \
+                    .trigger(processingTime=str(args.stream_trigger_secs) + ' seconds') \
+                    .start()
+    plc.log.info('Tailing ' + args.stream_dir + ' for log files...')
+    if args.stream_timeout_secs is not None:
+        query.awaitTermination(args.stream_timeout_secs)
+    else:
+        query.awaitTermination()
+    query.stop()
+
+    # no more page visits will arrive, so close the remaining open sessions
+    if dstream_state['open_RDD'] is not None:
+        plc.log.info('Closing open sessions...')
+        watermark = dstream_state['max_ts'] + timedelta(minutes=args.session_period)
+        lclosed, num_late = closeStreamSessions(sc, args, dstream_state, sc.emptyRDD(), args.session_period, watermark,
+                                             None)
+        ie.writeSessionOutputs(lclosed, dstream_state['totals_RDD'], args, out_dir)
+        if args.top_k_window_mins:
+            writeFinalWindows(args, out_dir, dstream_state, lclosed, None)
+
+    print '\n\nLate Page Visits Dropped: ', str(dstream_state['num_late'])
+    print 'Malformed Lines Skipped: ', str(dstream_state['num_malformed'])
+    print 'Sum of All Session Times (mins): ', str(dstream_state['sum_session_time'])
+    print 'Total Number of Sessions: ', str(dstream_state['total_sessions'])
+    if dstream_state['total_sessions'] > 0:
+        print 'Avg Session Time (mins): ', str(dstream_state['sum_session_time'] / (0.0 + dstream_state['total_sessions'])), '\n'
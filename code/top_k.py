@@ -0,0 +1,133 @@
+# PaytmLabs/WeblogChallenge
+#
+# Top K most engaged customers per time window for PaytmLabs_challenge.py.
+# Enabled by calling: bin/spark-submit <working_dir_path>/code/PaytmLabs_challenge.py --top_k_window_mins 60 <optional params>
+#
+# The most engaged customers of each time window (e.g. hour) are ranked by the total time of their
+# sessions that started in the window. Only the top --top_k of each window are kept, in a bounded
+# min-heap of (session time, IP) whose smallest entry is replaced when a larger one arrives, so the
+# memory for a window does not grow with the number of customers. Heaps are built per partition (or per
+# worker) and merged, and the stream engine emits the top K of a window as soon as no more sessions
+# can start in it (see popFinalWindows()), keeping only the totals of the windows that are still open.
+# The rankings are written to --top_k_window_file, one line per window. Windows are counted from the
+# epoch (see getBucketStart()), so daily windows (1440) start at midnight UTC.
+###########################################################################################################################
+
+
+import heapq
+from datetime import timedelta
+from operator import add
+
+import PaytmLabs_challenge as plc
+
+
+# ----------------------------------------------------------------------
+# Purpose: Add an entry to a bounded top K heap.
+# Input: Min-heap (list) of at most k (value, IP) tuples, the (value, IP)
+#   tuple and k.
+# Output: The heap, updated in place.
+def pushTopK(heap, item, k):
+
+    if len(heap) < k:
+        heapq.heappush(heap, item)
+    elif item > heap[0]:
+        heapq.heappushpop(heap, item)
+    return heap
+
+
+# ----------------------------------------------------------------------
+# Purpose: Merge two bounded top K heaps (e.g. of two partitions).
+# Input: Two heaps from pushTopK() and k.
+# Output: The first heap, updated in place.
+def mergeTopK(heap_a, heap_b, k):
+
+    for item in heap_b:
+        pushTopK(heap_a, item, k)
+    return heap_a
+
+
+# ----------------------------------------------------------------------
+# Purpose: Get the ranking of a top K heap.
+# Input: Heap from pushTopK()
+# Output: List of (IP, value) tuples in descending order of value.
+def getSortedTopK(heap):
+    return [(cid, val) for val, cid in sorted(heap, reverse=True)]
+
+
+# ----------------------------------------------------------------------
+# Purpose: Rank the customers of each time window by their total session
+#   time.
+# Input: RDD of ((window start, IP), session time) tuples, one per session,
+#   and k.
+# Output: List of (window start, ranking from getSortedTopK()) tuples in
+#   window order.
+def getWindowTopK(window_sessions_RDD, k):
+
+    return window_sessions_RDD.reduceByKey(add) \
+                              .map(lambda ((window, cid), dur): (window, (dur, cid))) \
+                              .aggregateByKey([], lambda heap, item: pushTopK(heap, item, k),
+                                              lambda heap_a, heap_b: mergeTopK(heap_a, heap_b, k)) \
+                              .mapValues(getSortedTopK) \
+                              .sortByKey() \
+                              .collect()
+
+
+# ----------------------------------------------------------------------
+# Purpose: Build the top K heaps of each window from the total session
+#   times of customers in windows.
+# Input: Dict of (window start, IP) to total session time and k.
+# Output: Dict of window start to heap from pushTopK().
+def getWindowHeaps(dwindow_totals, k):
+
+    dheaps = {}
+    for (window, cid), dur in dwindow_totals.iteritems():
+        pushTopK(dheaps.setdefault(window, []), (dur, cid), k)
+    return dheaps
+
+
+# ----------------------------------------------------------------------
+# Purpose: Add closed sessions to the total session times of customers
+#   in the open windows of the stream engine.
+# Input: Dict of window start to a dict of IP to total session time, list
+#   of (IP, closed session) tuples (see getClosedSession()) and the window
+#   size in mins.
+# Output: None, the dict is updated in place.
+def addWindowTotals(dwindow_totals, lclosed, window_mins):
+
+    for cid, sess in lclosed:
+        dcust_totals = dwindow_totals.setdefault(plc.getBucketStart(sess[3], window_mins), {})
+        dcust_totals[cid] = dcust_totals.get(cid, 0) + sess[0]
+
+
+# ----------------------------------------------------------------------
+# Purpose: Rank and remove the windows no more sessions can start in.
+# Input: Dict of window totals from addWindowTotals(), the time before
+#   which no more sessions can start (the earlier of the watermark and
+#   the start of the earliest open session, or None to rank all windows),
+#   window size in mins and k.
+# Output: List of (window start, ranking from getSortedTopK()) tuples of
+#   the removed windows in window order.
+def popFinalWindows(dwindow_totals, final_before, window_mins, k):
+
+    lfinal = []
+    for window in sorted(dwindow_totals):
+        if final_before is not None and window + timedelta(minutes=window_mins) > final_before:
+            break
+        heap = []
+        for cid, dur in dwindow_totals.pop(window).iteritems():
+            pushTopK(heap, (dur, cid), k)
+        lfinal.append((window, getSortedTopK(heap)))
+    return lfinal
+
+
+# ----------------------------------------------------------------------
+# Purpose: Write the rankings of windows to the window top K output file.
+# Input: Full path of the output file, list of (window start, ranking)
+#   tuples and the file mode ('w' to rewrite, 'a' to append).
+# Output: None
+def writeWindowTopK(filname, lwindow_top, mode):
+
+    f = open(filname, mode)
+    for window, ltop in lwindow_top:
+        f.write(window.strftime('%Y-%m-%dT%H:%M') + ' ' + str(ltop) + '\n')
+    f.close()
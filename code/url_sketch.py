@@ -0,0 +1,173 @@
+# PaytmLabs/WeblogChallenge
+#
+# HyperLogLog sketches of the URLs of a session for PaytmLabs_challenge.py.
+# Used by calling: bin/spark-submit <working_dir_path>/code/PaytmLabs_challenge.py --url_count_mode hll <optional params>
+#
+# Counting the unique URLs of a session exactly builds a set of all its URLs, which for bot sessions
+# holds thousands of long strings, and combining the counts of sessions into per IP or overall counts
+# needs the union of those sets. A HyperLogLog sketch estimates the number of distinct URLs from a
+# fixed size array of 2^p registers (one byte each) with a relative standard error of about
+# 1.04 / sqrt(2^p), and sketches are merged by taking the max of each register, so session sketches
+# can be combined into per IP and overall sketches without materializing any set of URLs.
+# Sessions with few URLs (most of them) are kept as a small set of 64 bit URL hashes instead, which
+# counts them exactly, until that would be bigger than the registers. A hash in a Python set takes
+# about SPARSE_HASH_BYTES (the long object and its slot in the set's table), not the 8 bytes of the
+# hash, so a sketch switches to registers after (2^p) / SPARSE_HASH_BYTES hashes.
+###########################################################################################################################
+
+
+import hashlib
+import math
+import struct
+
+import numpy as np
+
+
+# bits of the 64 bit URL hash
+HASH_BITS = 64
+
+# bounds of the number of register index bits p
+HLL_MIN_PRECISION = 4
+HLL_MAX_PRECISION = 16
+
+# bytes taken by a 64 bit hash in a set (measured with sys.getsizeof() on CPython 2.7 x64: 70 to 100)
+SPARSE_HASH_BYTES = 96
+
+
+# ----------------------------------------------------------------------
+# Purpose: Determine the number of register index bits for an error
+#   bound.
+# Input: Relative standard error wanted (e.g. 0.01 for 1%).
+# Output: The smallest p for which 1.04 / sqrt(2^p) is within the
+#   error, bounded to HLL_MIN_PRECISION..HLL_MAX_PRECISION.
+def getHLLPrecision(rel_error):
+
+    p = int(math.ceil(math.log((1.04 / rel_error) ** 2, 2)))
+    return max(HLL_MIN_PRECISION, min(HLL_MAX_PRECISION, p))
+
+
+# ----------------------------------------------------------------------
+# Purpose: Get the max number of URL hashes a sparse sketch holds.
+# Input: Number of register index bits p.
+# Output: Int number of hashes taking no more memory than the 2^p
+#   registers of a dense sketch.
+def getMaxSparse(p):
+    return (1 << p) // SPARSE_HASH_BYTES
+
+
+# ----------------------------------------------------------------------
+# Purpose: Hash a URL to 64 bits.
+# Input: String URL
+# Output: Int hash of the URL (the first 8 bytes of its md5 digest).
+def getURLHash(url):
+
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    return struct.unpack('<Q', hashlib.md5(url).digest()[:8])[0]
+
+
+# ----------------------------------------------------------------------
+# Purpose: Build the sketch of a list of URLs.
+# Input: List of string URLs and the number of register index bits p.
+# Output: Sketch as a list of p, the set of URL hashes (None once the
+#   sketch is dense) and the uint8 array of 2^p registers (None while the
+#   sketch is sparse).
+def getURLSketch(lurls, p):
+
+    sketch = [p, set(), None]
+    for url in lurls:
+        addURLHash(sketch, getURLHash(url))
+    return sketch
+
+
+# ----------------------------------------------------------------------
+# Purpose: Add a URL hash to a sketch, switching the sketch to registers
+#   once its hashes would take more space than them.
+# Input: Sketch from getURLSketch() and int URL hash.
+# Output: None. The sketch is updated in place.
+def addURLHash(sketch, h):
+
+    p, hashes, regs = sketch
+    if hashes is not None:
+        hashes.add(h)
+        if len(hashes) > getMaxSparse(p):
+            sketch[2] = getRegisters(hashes, p)
+            sketch[1] = None
+        return
+    ind = h >> (HASH_BITS - p)
+    rank = (HASH_BITS - p) - (h & ((1 << (HASH_BITS - p)) - 1)).bit_length() + 1
+    if rank > regs[ind]:
+        regs[ind] = rank
+
+
+# ----------------------------------------------------------------------
+# Purpose: Build the registers of a set of URL hashes.
+# Input: Iterable of int URL hashes and the number of register index
+#   bits p.
+# Output: uint8 array of 2^p registers holding, for the hashes whose top
+#   p bits select the register, the max position of the first 1 bit in
+#   the remaining bits.
+def getRegisters(hashes, p):
+
+    regs = np.zeros(1 << p, dtype=np.uint8)
+    for h in hashes:
+        ind = h >> (HASH_BITS - p)
+        rank = (HASH_BITS - p) - (h & ((1 << (HASH_BITS - p)) - 1)).bit_length() + 1
+        if rank > regs[ind]:
+            regs[ind] = rank
+    return regs
+
+
+# ----------------------------------------------------------------------
+# Purpose: Merge two sketches (e.g. of two sessions of an IP).
+# Input: Two sketches from getURLSketch() with the same p.
+# Output: A new sketch of the union of their URLs.
+def mergeURLSketches(a, b):
+
+    p = a[0]
+    if a[1] is not None and b[1] is not None:
+        hashes = a[1] | b[1]
+        if len(hashes) <= getMaxSparse(p):
+            return [p, hashes, None]
+        return [p, None, getRegisters(hashes, p)]
+    regs_a = a[2] if a[2] is not None else getRegisters(a[1], p)
+    regs_b = b[2] if b[2] is not None else getRegisters(b[1], p)
+    return [p, None, np.maximum(regs_a, regs_b)]
+
+
+# ----------------------------------------------------------------------
+# Purpose: Estimate the number of distinct URLs of a sketch.
+# Input: Sketch from getURLSketch()
+# Output: Int count, exact while the sketch is sparse. Dense sketches use
+#   the HyperLogLog estimate, or linear counting of the empty registers
+#   when that is more accurate (small counts).
+def getSketchCount(sketch):
+
+    p, hashes, regs = sketch
+    if hashes is not None:
+        return len(hashes)
+    m = float(1 << p)
+    alpha = 0.7213 / (1 + 1.079 / m)
+    estimate = alpha * m * m / np.sum(np.power(2.0, -regs.astype(np.float64)))
+    num_zeros = int(np.sum(regs == 0))
+    if estimate <= 2.5 * m and num_zeros > 0:
+        estimate = m * math.log(m / num_zeros)
+    return int(round(estimate))
+
+
+# ----------------------------------------------------------------------
+# Purpose: Summarize the error of approximate counts against exact ones.
+# Input: RDD of (exact count, approx count) tuples.
+# Output: Tuple of the number of counts, mean and max relative error, and
+#   the number of counts that are not exact.
+def getCountErrorStats(counts_RDD):
+
+    def seqOp(acc, (exact, approx)):
+        err = abs(approx - exact) / float(max(exact, 1))
+        return (acc[0] + 1, acc[1] + err, max(acc[2], err), acc[3] + (approx != exact))
+
+    def combOp(a, b):
+        return (a[0] + b[0], a[1] + b[1], max(a[2], b[2]), a[3] + b[3])
+
+    num, sum_err, max_err, num_inexact = counts_RDD.aggregate((0, 0.0, 0.0, 0), seqOp, combOp)
+    return num, sum_err / max(num, 1), max_err, num_inexact
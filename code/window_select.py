@@ -0,0 +1,345 @@
+# PaytmLabs/WeblogChallenge
+#
+# Session window selection for PaytmLabs_challenge.py.
+# Selected by calling: bin/spark-submit <working_dir_path>/code/PaytmLabs_challenge.py --window_heuristic <name> <optional params>
+#
+# A window heuristic scores a grid of candidate session windows from stats collected over the
+# page visits and returns the windows it picks, best first. Heuristics are registered in
+# WINDOW_HEURISTICS with the kind of stats they score, so each engine only collects the stats the
+# selected heuristic needs:
+# - url_hits: the number of sessions with 1, 2, .., 6+ unique URLs for each whole minute window up to
+#   SESSION_WINDOW_MAX, from a multi-window pass over every customer's page visits (see
+#   getSessionsURLHitsStream()). Scored by first_rise, the original heuristic described in
+#   getOptimalSessionWindow().
+# - gaps: a histogram of the times between a customer's consecutive page visits over a fine grid of
+#   windows (--window_step_secs up to --window_max_mins), per cohort of customers with a similar
+#   number of page visits. The number of sessions for every window of the grid follows from the
+#   histogram (a page visit starts a session for all windows up to its gap), so one pass over the
+#   page visits is enough whatever the number of windows. Scored by
+#   knee: the knee (elbow) of the number of sessions against the window (on log scales), where
+#     making the window longer stops merging many sessions, i.e. the end of the within session gaps.
+#   cohort: the knee of each cohort of customers, as customers that visit a few pages and crawlers
+#     that visit thousands tend to have different gaps between sessions. The knee of the cohort with
+#     the most page visits is picked and the others are logged.
+# Plotting the stats and the picked windows is a separate step that can be skipped
+# (--skip_window_plots).
+###########################################################################################################################
+
+
+from bisect import bisect_right
+
+import numpy as np
+import matplotlib.pyplot as plt
+
+import PaytmLabs_challenge as plc
+
+
+# cohorts of customers by their number of page visits, given as the least number of page visits
+# of each cohort
+COHORT_MIN_VISITS = [1, 2, 10, 100, 1000]
+
+
+# ----------------------------------------------------------------------
+# Purpose: Build the grid of session windows scored from gap stats.
+# Input: Step between windows in secs and the largest window in mins.
+# Output: Float array of the windows in mins (step, 2 * step, ...).
+def getWindowGrid(step_secs, max_mins):
+
+    num_windows = int(max_mins * 60 / step_secs)
+    return np.arange(1, num_windows + 1) * (step_secs / 60.0)
+
+
+# ----------------------------------------------------------------------
+# Purpose: Get the cohort of a customer.
+# Input: Number of page visits of the customer.
+# Output: Index of the cohort in COHORT_MIN_VISITS.
+def getCohort(num_visits):
+    return bisect_right(COHORT_MIN_VISITS, num_visits) - 1
+
+
+# ----------------------------------------------------------------------
+# Purpose: Get the label of a cohort.
+# Input: Index of the cohort in COHORT_MIN_VISITS.
+# Output: String label, e.g. '10-99 visits'.
+def getCohortLabel(cohort):
+
+    lo = COHORT_MIN_VISITS[cohort]
+    if cohort == len(COHORT_MIN_VISITS) - 1:
+        return str(lo) + '+ visits'
+    hi = COHORT_MIN_VISITS[cohort + 1] - 1
+    return (str(lo) if lo == hi else str(lo) + '-' + str(hi)) + ' visits'
+
+
+# ----------------------------------------------------------------------
+# Purpose: Histogram gaps between page visits over the window grid.
+# Input: Float array of gaps in mins and the window grid.
+# Output: Int array of len(lwindows) + 1 counts. Entry k counts the gaps
+#   of at least k window steps and less than k + 1 (the last entry all
+#   gaps of at least the largest window), so a gap in entry k starts a
+#   session for windows 1 to k.
+def getGapHistogram(gaps, lwindows):
+
+    num_windows = len(lwindows)
+    bins = np.minimum((np.asarray(gaps, dtype=np.float64) / lwindows[0]).astype(np.int64), num_windows)
+    return np.bincount(bins, minlength=num_windows + 1)
+
+
+# ----------------------------------------------------------------------
+# Purpose: Collect the gap stats of a partition of page visits.
+# Input: Iterator of page visits in the format of getPageDurationsStream()
+#   output with all the visits of a customer next to each other, and the
+#   window grid. A visit whose timestamp is not wrapped in a list is a
+#   customer's first; visits of a customer split over partitions (hot IPs
+#   in skew mode) are counted as separate customers of the cohort of
+#   their share of the visits.
+# Output: Iterator of tuples with the cohort as key and a list of the
+#   number of customers and the gap histogram (see getGapHistogram()) as
+#   value.
+def getGapHistograms(it, lwindows):
+
+    dgaps = {}
+    cid_cur = None
+    for cid, (url, ts, dur) in it:
+        if cid != cid_cur:
+            if cid_cur is not None:
+                addCohortGaps(dgaps, num_visits, num_first, lgaps)
+            cid_cur = cid
+            num_visits = 0
+            num_first = 0
+            lgaps = []
+        num_visits += 1
+        if isinstance(ts, list):
+            lgaps.append(dur)
+        else:
+            num_first += 1
+    if cid_cur is not None:
+        addCohortGaps(dgaps, num_visits, num_first, lgaps)
+
+    for cohort, (num_ips, lcohort_gaps) in dgaps.iteritems():
+        yield (cohort, [num_ips, getGapHistogram(np.concatenate(lcohort_gaps), lwindows)])
+
+
+# ----------------------------------------------------------------------
+# Purpose: Add the gaps of a customer to the gaps of its cohort.
+# Input: Dict of cohort to [number of customers, list of gap arrays], and
+#   the customer's number of page visits, number of first visits (0 or 1)
+#   and gaps.
+# Output: None, the dict is updated in place.
+def addCohortGaps(dgaps, num_visits, num_first, lgaps):
+
+    cohort = getCohort(num_visits)
+    if cohort not in dgaps:
+        dgaps[cohort] = [0, [np.zeros(0)]]
+    dgaps[cohort][0] += num_first
+    dgaps[cohort][1].append(np.array(lgaps, dtype=np.float64))
+
+
+# ----------------------------------------------------------------------
+# Purpose: Columnar version of getGapHistograms().
+# Input: Iterator over customer records from getColumnarRecords() and the
+#   window grid.
+# Output: Iterator of tuples as for getGapHistograms().
+def getGapHistogramsColumnar(it, lwindows):
+
+    dgaps = {}
+    for cid, (lurl_dict, ts, url_ids) in it:
+        cohort = getCohort(len(ts))
+        if cohort not in dgaps:
+            dgaps[cohort] = [0, [np.zeros(0)]]
+        dgaps[cohort][0] += 1
+        dgaps[cohort][1].append(np.diff(ts) / (60.0 * plc.US_PER_SEC))
+
+    for cohort, (num_ips, lcohort_gaps) in dgaps.iteritems():
+        yield (cohort, [num_ips, getGapHistogram(np.concatenate(lcohort_gaps), lwindows)])
+
+
+# ----------------------------------------------------------------------
+# Purpose: Add up the gap stats of a cohort.
+# Input: Two lists of number of customers and gap histogram.
+# Output: The element wise sum.
+def addGapStats(a, b):
+    return [a[0] + b[0], a[1] + b[1]]
+
+
+# ----------------------------------------------------------------------
+# Purpose: Merge two dicts of gap stats (e.g. of two partitions).
+# Input: Two dicts of cohort to gap stats (either may be None).
+# Output: Dict of cohort to the summed gap stats.
+def mergeGapStats(dgap_stats_a, dgap_stats_b):
+
+    if dgap_stats_a is None:
+        return dgap_stats_b
+    if dgap_stats_b is None:
+        return dgap_stats_a
+    dmerged = dict(dgap_stats_a)
+    for cohort, stats in dgap_stats_b.iteritems():
+        dmerged[cohort] = addGapStats(dmerged[cohort], stats) if cohort in dmerged else stats
+    return dmerged
+
+
+# ----------------------------------------------------------------------
+# Purpose: Collect the gap stats of all customers.
+# Input: RDD of getGapHistograms() output.
+# Output: Dict of cohort to a list of the number of customers and the gap
+#   histogram of the cohort.
+def getGapStats(gap_hist_RDD):
+    return gap_hist_RDD.reduceByKey(addGapStats).collectAsMap()
+
+
+# ----------------------------------------------------------------------
+# Purpose: Calculate the number of sessions for each window of the grid.
+# Input: The window grid, number of customers and gap histogram.
+# Output: Int array with the number of sessions for each window. Every
+#   customer has at least one session and each gap of at least the
+#   window starts another.
+def getSessionCounts(lwindows, num_ips, hist):
+    return num_ips + np.cumsum(hist[::-1])[::-1][1:]
+
+
+# ----------------------------------------------------------------------
+# Purpose: Find the knee of the number of sessions against the window.
+#   With both on a log scale (gaps between page visits span seconds to
+#   hours and the number of sessions orders of magnitude) and scaled to
+#   [0, 1], the knee is the window where the curve is furthest below the
+#   straight line between its ends.
+# Input: The window grid and array of session counts for each window.
+# Output: Index of the knee in the grid, or None if the number of
+#   sessions does not change over the grid.
+def getKneeIndex(lwindows, counts):
+
+    if len(counts) < 3 or counts[0] == counts[-1]:
+        return None
+    log_windows = np.log(lwindows)
+    log_counts = np.log(np.maximum(counts, 1).astype(np.float64))
+    x = (log_windows - log_windows[0]) / (log_windows[-1] - log_windows[0])
+    y = (log_counts - log_counts[-1]) / (log_counts[0] - log_counts[-1])
+    dist = (1.0 - x) - y
+    ind = int(np.argmax(dist))
+    return ind if dist[ind] > 0 else None
+
+
+# ----------------------------------------------------------------------
+# Purpose: first_rise heuristic (see getOptimalSessionWindow()).
+# Input: The whole minute windows and the session window stats (see
+#   getSessionsURLHits()) summed over all customers.
+# Output: List of picked windows in mins, best first.
+def selectFirstRise(lwindows, lsess_window_stats):
+
+    lind = plc.getOptimalSessionWindow(plc.getSessionWindowStats(lsess_window_stats))
+    return [lwindows[k] for k in lind]
+
+
+# ----------------------------------------------------------------------
+# Purpose: knee heuristic. Knee of the number of sessions of all
+#   customers against the window.
+# Input: The window grid and dict of gap stats from getGapStats().
+# Output: List of picked windows in mins (empty if there is no knee).
+def selectGapKnee(lwindows, dgap_stats):
+
+    num_ips, hist = reduce(addGapStats, dgap_stats.values())
+    ind = getKneeIndex(lwindows, getSessionCounts(lwindows, num_ips, hist))
+    return [float(lwindows[ind])] if ind is not None else []
+
+
+# ----------------------------------------------------------------------
+# Purpose: cohort heuristic. Knee of the number of sessions of each
+#   cohort against the window.
+# Input: The window grid and dict of gap stats from getGapStats().
+# Output: List of picked windows in mins, one per cohort with a knee, in
+#   order of the number of page visits of the cohort.
+def selectCohortWindows(lwindows, dgap_stats):
+
+    lcohort_windows = []
+    for cohort, (num_ips, hist) in sorted(dgap_stats.items(), key=lambda (cohort, stats): -stats[1].sum()):
+        ind = getKneeIndex(lwindows, getSessionCounts(lwindows, num_ips, hist))
+        if ind is None:
+            continue
+        plc.log.info('Cohort ' + getCohortLabel(cohort) + ' (' + str(num_ips) + ' IPs, ' + str(int(hist.sum())) +
+                     ' gaps): session period ' + str(float(lwindows[ind])) + ' mins.')
+        lcohort_windows.append(float(lwindows[ind]))
+    return lcohort_windows
+
+
+# window heuristics, keyed by the --window_heuristic name, with the function picking the windows
+# and the kind of stats it scores
+WINDOW_HEURISTICS = {'first_rise': (selectFirstRise, 'url_hits'),
+                     'knee': (selectGapKnee, 'gaps'),
+                     'cohort': (selectCohortWindows, 'gaps')}
+
+
+# ----------------------------------------------------------------------
+# Purpose: Get the kind of stats and the windows scored by the selected
+#   heuristic.
+# Input: Parsed command line args.
+# Output: Tuple of the kind of stats (url_hits or gaps) and the windows
+#   in mins.
+def getHeuristicWindows(args):
+
+    stats_kind = WINDOW_HEURISTICS[args.window_heuristic][1]
+    if stats_kind == 'url_hits':
+        return stats_kind, range(1, plc.SESSION_WINDOW_MAX)
+    return stats_kind, getWindowGrid(args.window_step_secs, args.window_max_mins)
+
+
+# ----------------------------------------------------------------------
+# Purpose: Plot the gap stats: the number of sessions of all customers
+#   and of each cohort against the window (relative to the smallest
+#   window), and the picked windows.
+# Input: Name of the pdf file to save, the window grid, dict of gap stats
+#   and list of picked windows.
+# Output: None
+def plotGapStats(pdf_file, lwindows, dgap_stats, lopt_windows):
+
+    num_ips, hist = reduce(addGapStats, dgap_stats.values())
+    lcurves = [('All IPs', getSessionCounts(lwindows, num_ips, hist))]
+    for cohort in sorted(dgap_stats):
+        counts = getSessionCounts(lwindows, *dgap_stats[cohort])
+        if counts[0] > counts[-1]:
+            lcurves.append((getCohortLabel(cohort), counts))
+    for label, counts in lcurves:
+        plt.plot(lwindows, counts / float(counts[0]), label=label)
+    for window in lopt_windows:
+        plt.axvline(window, color='k', linestyle='--')
+    plt.xscale('log')
+    plt.legend()
+    plt.xlabel('Session Period (mins)')
+    plt.ylabel('Sessions Relative to ' + str(float(lwindows[0])) + ' Min Session Period')
+    plt.title('Plot of Number of Sessions by Session Period')
+    plt.savefig(pdf_file, bbox_inches='tight')
+    plt.close()
+
+
+# ----------------------------------------------------------------------
+# Purpose: Plot the window stats of a heuristic and the picked windows.
+# Input: Parsed command line args, output dir, kind of stats, windows,
+#   the stats and list of picked windows.
+# Output: None
+def plotWindowStats(args, out_dir, stats_kind, lwindows, window_stats, lopt_windows):
+
+    if stats_kind == 'url_hits':
+        lpg_sess_stats = plc.getSessionWindowStats(window_stats)
+        plc.plotSessionWindowStats(lpg_sess_stats, out_dir + args.session_window_bar_chart_file)
+        plc.plotOptimalSessionWindow(lpg_sess_stats, [lwindows.index(window) for window in lopt_windows],
+                                     out_dir + plc.one_pg_sess_change_fl)
+    else:
+        plotGapStats(out_dir + args.session_window_gap_plot_file, lwindows, window_stats, lopt_windows)
+
+
+# ----------------------------------------------------------------------
+# Purpose: Pick the session window with the selected heuristic and plot
+#   its stats (unless skipped).
+# Input: Parsed command line args, output dir, kind of stats, windows and
+#   the stats collected for the heuristic.
+# Output: The picked session window in mins, or None if the heuristic
+#   did not find one.
+def selectSessionWindow(args, out_dir, stats_kind, lwindows, window_stats):
+
+    heuristic_fn = WINDOW_HEURISTICS[args.window_heuristic][0]
+    lopt_windows = heuristic_fn(lwindows, window_stats)
+    if not args.skip_window_plots:
+        plotWindowStats(args, out_dir, stats_kind, lwindows, window_stats, lopt_windows)
+    if len(lopt_windows) == 0:
+        plc.log.info('No optimal session period found by the ' + args.window_heuristic + ' heuristic.')
+        return None
+    plc.log.info('Optimal session period is determined to be ' + str(lopt_windows[0]) + ' mins.')
+    return lopt_windows[0]